@@ -0,0 +1,220 @@
+"""Feeds a SessionChangeWatcher more sessions than its limits allow and checks the throttles hold
+
+Run from the repository root with ``python -m benchmarks.session_watcher_limits``. No Plex server is needed, the
+sessions are built from /status/sessions XML and published through a real SessionPoller, so the watcher sees them
+exactly as it would from a server. The limits checked are the class defaults, max_sessions, max_per_user,
+max_new_per_tick and callback_queue_size. Any assertion failing exits with a traceback, otherwise the timings of the
+stages are printed.
+"""
+import asyncio
+import collections
+import time
+import xml.etree.ElementTree as ElementTree
+
+import plexapi.server  # noqa: F401  SessionChangeWatchers reads plexapi.server at import, main.py loads it first
+from loguru import logger as logging
+
+from wrappers_utils.SessionChangeWatchers import SessionChangeWatcher
+from wrappers_utils.SessionPoller import SessionPoller
+from wrappers_utils.SessionSnapshot import SessionSnapshot
+
+USERS = 300
+SESSIONS_PER_USER = 3  # One over max_per_user, so every user has a session that must be throttled
+EXPIRE_AT_ONCE = 150  # More than callback_queue_size + callback_workers, so expiry has to wait on the callback
+
+
+def session_element(session_key: int, user: int, device: int) -> ElementTree.Element:
+    video = ElementTree.Element("Video", type="movie", title=f"Movie {session_key}", year="2020",
+                                guid=f"plex://movie/{session_key}", key=f"/library/metadata/{session_key}",
+                                ratingKey=str(session_key), sessionKey=str(session_key), viewOffset="0")
+    ElementTree.SubElement(video, "Media", bitrate="8000", container="mkv")
+    ElementTree.SubElement(video, "User", id=str(user + 2), title=f"user{user}")
+    ElementTree.SubElement(video, "Player", machineIdentifier=f"device-{user}-{device}", state="playing",
+                           userID=str(user + 2))
+    return video
+
+
+def element_key(elem: ElementTree.Element) -> tuple:
+    """The watcher key the session parsed from elem will have"""
+    return elem.get("guid"), elem.find("User").get("title"), elem.find("Player").get("machineIdentifier")
+
+
+class FakeListener:
+
+    @staticmethod
+    def is_alive() -> bool:
+        return True
+
+
+class FakeDeviceActivity:
+
+    def seen(self, account_id, device_id, when=None) -> None:
+        pass
+
+
+class FakeAio:
+    """Runs the calls the watcher and poller make on the server's executor inline"""
+
+    def __init__(self, server) -> None:
+        self.server = server
+
+    async def run(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    async def sessionSnapshots(self):
+        return self.server.sessionSnapshots()
+
+
+class FakeServer:
+    """Serves /status/sessions from self.elements, the poller only polls when asked to with refresh()"""
+
+    friendlyName = "benchmark"
+    online = True
+    _timeout = 10
+    # Keep the poller's own timer out of the way so every tick is one that the benchmark published
+    poll_min_interval = 3600
+    poll_max_interval = 3600
+
+    def __init__(self) -> None:
+        self.elements = []
+        self.alert_listener = FakeListener()
+        self.device_activity = FakeDeviceActivity()
+        self.aio = FakeAio(self)
+        self.session_poller = SessionPoller(self)
+
+    def sessionSnapshots(self):
+        return [SessionSnapshot(self, elem) for elem in self.elements]
+
+
+async def tick(server: FakeServer, elements: list, settle: float = 0.05) -> None:
+    """Publish a new list of sessions and give the watcher time to act on it"""
+    server.elements = elements
+    generation = server.session_poller.generation
+    server.session_poller.refresh()
+    while server.session_poller.generation == generation:
+        await asyncio.sleep(0)
+    await asyncio.sleep(settle)
+
+
+def tracked_per_user(watcher: SessionChangeWatcher) -> collections.Counter:
+    return collections.Counter(key[1] for key in watcher.watchers)
+
+
+async def main() -> None:
+    logging.disable("wrappers_utils")  # One warning per throttled session is thousands of lines here
+    server = FakeServer()
+    await asyncio.sleep(0)  # Let the poller publish the empty server once
+
+    delivered = []
+    gate = asyncio.Event()
+    gate.set()
+
+    async def history_callback(watcher, channel):
+        await gate.wait()
+        delivered.append(watcher.key)
+
+    watcher = SessionChangeWatcher(server, history_callback, channel=None)
+    limits = (watcher.max_sessions, watcher.max_per_user, watcher.max_new_per_tick, watcher.callback_queue_size)
+    print(f"Limits: max_sessions={limits[0]} max_per_user={limits[1]} max_new_per_tick={limits[2]} "
+          f"callback_queue_size={limits[3]}")
+
+    elements = [session_element(user * SESSIONS_PER_USER + device + 1, user, device)
+                for user in range(USERS) for device in range(SESSIONS_PER_USER)]
+    assert len(elements) > watcher.max_sessions
+    assert SESSIONS_PER_USER > watcher.max_per_user
+    live = {element_key(elem) for elem in elements}
+
+    # Ramp up, at most max_new_per_tick watchers start per poll and the watcher asks for quick polls while it's behind
+    start = time.perf_counter()
+    ticks = 0
+    while True:
+        before = len(watcher.watchers)
+        await tick(server, elements)
+        ticks += 1
+        started = len(watcher.watchers) - before
+        assert started <= watcher.max_new_per_tick, f"{started} watchers started in one tick"
+        assert max(tracked_per_user(watcher).values()) <= watcher.max_per_user
+        assert len(watcher.watchers) <= watcher.max_sessions
+        if not watcher.backlogged:
+            break
+        assert started == watcher.max_new_per_tick, "backlogged with free slots but a tick started fewer watchers"
+        assert watcher.interval == watcher.poll_interval, "backlogged watcher isn't asking for quick polls"
+        assert ticks < 100, "watcher never worked through its backlog"
+    ramp_time = time.perf_counter() - start
+
+    expected = min(watcher.max_sessions, USERS * watcher.max_per_user)
+    assert len(watcher.watchers) == expected, f"tracking {len(watcher.watchers)} sessions, expected {expected}"
+    assert ticks >= expected // watcher.max_new_per_tick
+    assert watcher.interval == watcher.reconcile_interval, "watcher kept polling quickly after the backlog cleared"
+    # Every live session that isn't tracked is waiting on a slot and is recorded as throttled, and nothing else is
+    assert watcher.throttled == live - watcher.watchers.keys(), "throttled doesn't match the untracked sessions"
+    assert not watcher.throttled & watcher.watchers.keys()
+    print(f"Ramp up: {len(elements)} sessions, {len(watcher.watchers)} tracked and {len(watcher.throttled)} throttled "
+          f"after {ticks} ticks in {ramp_time:.2f}s")
+
+    # A throttled session that ends is forgotten rather than started later
+    dropped = next(iter(watcher.throttled))
+    elements = [elem for elem in elements if element_key(elem) != dropped]
+    live.discard(dropped)
+    await tick(server, elements)
+    assert dropped not in watcher.throttled, "ended session is still throttled"
+    assert watcher.throttled == live - watcher.watchers.keys()
+
+    # Stop a batch of tracked sessions while the history callback is stuck, the callback queue fills up and expiry
+    # waits on it instead of queueing without limit
+    gate.clear()
+    expiring = set(list(watcher.watchers)[:EXPIRE_AT_ONCE])
+    elements = [elem for elem in elements if element_key(elem) not in expiring]
+    live -= expiring
+    await tick(server, elements)
+    assert watcher.callback_queue.full(), "callback queue didn't fill while the callback was stuck"
+    assert watcher.callbacks_backed_up, "callbacks_backed_up wasn't set with a full queue"
+    accepted = watcher.callback_queue.qsize() + watcher.callback_workers
+    # The watcher that couldn't be queued has already left the registry, the rest are waiting behind it
+    waiting = len(expiring & watcher.watchers.keys())
+    assert waiting == EXPIRE_AT_ONCE - accepted - 1, \
+        f"{waiting} expired sessions still tracked, expected {EXPIRE_AT_ONCE - accepted - 1} behind the full queue"
+    assert not delivered
+
+    # The observer is held up, so newer polls aren't acted on until the callback catches up
+    tracked = len(watcher.watchers)
+    await tick(server, elements)
+    assert len(watcher.watchers) == tracked, "observer kept going while expiry was blocked on the callback queue"
+
+    start = time.perf_counter()
+    gate.set()
+    while len(delivered) < EXPIRE_AT_ONCE:
+        await asyncio.sleep(0.01)
+    drain_time = time.perf_counter() - start
+    await watcher.callback_queue.join()
+    assert sorted(delivered) == sorted(expiring), "expired sessions weren't each delivered once"
+    assert not watcher.callbacks_backed_up, "callbacks_backed_up wasn't cleared once the queue drained"
+    print(f"Backpressure: {EXPIRE_AT_ONCE} expired with the callback stuck, {accepted} accepted and "
+          f"{EXPIRE_AT_ONCE - accepted} held back, drained in {drain_time:.2f}s")
+
+    # The freed slots go to throttled sessions, still no more than max_new_per_tick per poll or max_per_user each
+    ticks = 0
+    while True:
+        before = len(watcher.watchers)
+        await tick(server, elements)
+        ticks += 1
+        assert len(watcher.watchers) - before <= watcher.max_new_per_tick
+        assert max(tracked_per_user(watcher).values()) <= watcher.max_per_user
+        if not watcher.backlogged:
+            break
+        assert watcher.interval == watcher.poll_interval, "watcher isn't asking for quick polls while refilling"
+        assert ticks < 100, "watcher never refilled the freed slots"
+    expected = min(watcher.max_sessions, sum(min(watcher.max_per_user, count)
+                                             for count in collections.Counter(key[1] for key in live).values()))
+    assert len(watcher.watchers) == expected, f"tracking {len(watcher.watchers)} sessions, expected {expected}"
+    assert watcher.throttled == live - watcher.watchers.keys()
+    assert not watcher.throttled & watcher.watchers.keys()
+    print(f"Refill: {len(watcher.watchers)} tracked and {len(watcher.throttled)} throttled after {ticks} ticks")
+
+    await watcher.bot_shutdown()
+    server.session_poller.stop()
+    print("All session watcher limit checks passed")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -11,6 +11,10 @@ import discord
 
 import ConcurrentDatabase
 
+import database_migrations
+
+from wrappers_utils.DatabaseGateway import DatabaseGateway
+
 
 def table_str_generator(ret):
     # Calculate the longest string in each column
@@ -92,6 +96,7 @@ class maintCog(Cog):
         self.bot.backup_database.backup(target=second_backup)
 
         # Close all database connections
+        await self.bot.db.close()
         self.bot.database.close()
         self.bot.backup_database.close()
         second_backup.close()
@@ -102,6 +107,7 @@ class maintCog(Cog):
 
         # Reopen the database connections
         self.bot.database = ConcurrentDatabase.Database('plex_bot.db')
+        self.bot.db = DatabaseGateway(self.bot.database)
         self.bot.backup_database = sqlite3.connect('../plex_bot.db.bak')
         second_backup = sqlite3.connect('plex_bot.db.bak2')
         second_backup.backup(target=self.bot.backup_database)
@@ -202,6 +208,37 @@ class maintCog(Cog):
         await self.bot.logout()
         exit(69)
 
+    @is_owner()
+    @command(name='db_stats')
+    async def db_stats(self, ctx):
+        """Show how busy the database writer and reader pools are"""
+        stats = self.bot.db.stats()
+        writer = stats["writer"]
+        e = discord.Embed(title='Database Gateway', color=0x00FF00)
+        e.add_field(name='Writer', value=f"Queued: `{writer['queued']}`\n"
+                                         f"Batches: `{writer['batches']}` (largest `{writer['largest_batch']}`)\n"
+                                         f"Statements: `{writer['statements']}`, Calls: `{writer['calls']}`\n"
+                                         f"Failed: `{writer['failed']}`", inline=False)
+        for name, pool in (("Readers", stats["reads"]), ("Statistics Readers", stats["stats_reads"])):
+            e.add_field(name=name, value=f"Reads: `{pool['reads']}`\n"
+                                         f"Time: `{pool['read_time']}s` (max `{pool['max_read_time']}s`)")
+        await ctx.send(embed=e)
+
+    @is_owner()
+    @command(name='query_plans')
+    async def query_plans(self, ctx):
+        """Check that none of the hot queries fall back to a full table scan"""
+        try:
+            await self.bot.db.call(database_migrations.check_query_plans, self.bot.database)
+        except database_migrations.QueryPlanError as e:
+            embed = discord.Embed(title='Query Plans - Table Scans',
+                                  description='```\n%s\n```' % str(e)[:4000], color=0xFF0000)
+        else:
+            embed = discord.Embed(title='Query Plans - OK',
+                                  description='All %s hot queries are answered from an index'
+                                              % len(database_migrations.HOT_QUERIES), color=0x00FF00)
+        await ctx.send(embed=embed)
+
     @is_owner()
     @command(name='su', pass_context=True)
     async def su(self, ctx, user: discord.Member, *, command):
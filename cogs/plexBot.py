@@ -9,7 +9,7 @@ from discord.ext.commands import command, has_permissions, Cog, BadArgument
 import discord.errors as discord_errors
 import discord
 
-from utils import get_all_library, session_embed, base_user_layer, get_from_media_index, base_info_layer, safe_field
+from utils import session_embed, base_user_layer, get_from_media_index, base_info_layer, safe_field
 
 from loguru import logger as logging
 
@@ -21,8 +21,8 @@ class PlexBot(Cog):
     @has_permissions(administrator=True)
     @command(name="user_add", aliases=["add_user", "adduser", "useradd"])
     async def user_add(self, ctx, plex_id):
-        celery = ctx.plex().myPlexAccount()
-        pending = celery.pendingInvites()
+        celery = await ctx.plex.aio.myPlexAccount()
+        pending = await ctx.plex.aio.run(celery.pendingInvites)
         if len(pending) == 0:
             embed = discord.Embed(title="Add User", description="There are currently no pending invites, "
                                                                 "user was not added", color=0xFF0000)
@@ -33,21 +33,22 @@ class PlexBot(Cog):
             if invite.username == plex_id:
                 embed = discord.Embed(title="Add User", description=f"User `{invite.username}` was added",
                                       color=0x00ff00)
-                celery.acceptInvite(invite.username)
-                celery.inviteFriend(invite.email, ctx.plex, get_all_library(ctx.plex))
+                await ctx.plex.aio.run(celery.acceptInvite, invite.username)
+                libraries = await ctx.plex.aio.sections()
+                await ctx.plex.aio.run(celery.inviteFriend, invite.email, ctx.plex, libraries)
                 movie_library_string = ""
-                for library in get_all_library(ctx.plex):
+                for library in libraries:
                     if library.type == "movie":
                         movie_library_string += f"`{library.title}` (Size: `{library.totalSize}`)\n"
                 embed.add_field(name="Movie Library's", value=movie_library_string, inline=True)
                 show_library_string = ""
-                for library in get_all_library(ctx.plex):
+                for library in libraries:
                     if library.type == "show":
                         show_library_string += f"`{library.title}` (Size: `{library.totalSize}`)\n"
                 embed.add_field(name="Show Library's", value=show_library_string, inline=True)
                 embed.timestamp = datetime.datetime.now()
                 await ctx.send(embed=embed)
-                return ctx.plex().getUser(plex_id)
+                return await ctx.plex.aio.run(celery.user, plex_id)
 
         embed = discord.Embed(title="Add User", description="User was not found in pending invites", color=0xFF0000)
         embed.timestamp = datetime.datetime.now()
@@ -56,18 +57,22 @@ class PlexBot(Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        table = self.bot.database.get_table("activity_messages")
-        self.activity_messages = table.get_all()
 
     @Cog.listener('on_ready')
     async def on_ready(self):
         logging.info("Cog: PlexBot is ready")
-        for message_config in self.activity_messages:
+        activity_messages = await self.bot.db.read("SELECT guild_id, channel_id, message_id FROM activity_messages")
+        for message_config in activity_messages:
             self.bot.loop.create_task(self.monitor_plex(message_config[0], message_config[1], message_config[2]))
         self.bot.loop.create_task(self.status_update())
 
     async def status_update(self):
-        """Update plexbots status every 10 seconds to show the current number of sessions across all servers"""
+        """Update plexbots status every 10 seconds to show the current number of sessions across all servers
+
+        The counts come from each server's session poller so this doesn't cause any polling of its own, and the
+        presence is only sent to discord when the counts change
+        """
+        last_counts = None
         while True:
             try:
                 await asyncio.sleep(10)
@@ -78,12 +83,15 @@ class PlexBot(Cog):
                         plex = await self.bot.fetch_plex(guild)
                         if not plex.online:
                             continue
-                        total_sessions += len(plex.sessions())
+                        total_sessions += len(plex.session_poller.snapshot)
                         total_servers += 1
                     except PlexNotLinked:
                         continue
                     except PlexNotReachable:
                         continue
+                if (total_sessions, total_servers) == last_counts:
+                    continue
+                last_counts = (total_sessions, total_servers)
                 if total_servers == 0:
                     await self.bot.change_presence(activity=discord.Activity(type=discord.ActivityType.watching,
                                                                              name="No Servers Online"),
@@ -101,6 +109,7 @@ class PlexBot(Cog):
                                                                              name=f"{total_sessions} sessions"),
                                                    status=discord.Status.online)
             except Exception as e:
+                last_counts = None
                 logging.error(e)
                 logging.exception(e)
 
@@ -113,9 +122,8 @@ class PlexBot(Cog):
 
             async def create_message():
                 new_message = await channel.send(f"Initializing activity monitor")
-                self.bot.database.execute("UPDATE activity_messages SET message_id = ? WHERE channel_id = ?",
-                                          (new_message.id, channel_id))
-                self.bot.database.commit()
+                await self.bot.db.write("UPDATE activity_messages SET message_id = ? WHERE channel_id = ?",
+                                        (new_message.id, channel_id))
                 # Pin the new message to the channel
                 await new_message.pin()
                 # Find the "Message was pinned" message
@@ -131,12 +139,20 @@ class PlexBot(Cog):
                 except discord_errors.NotFound:
                     message = await create_message()
 
+            poller = plex.session_poller
+            poller.request_interval(("monitor_plex", channel_id), 10)
             while True:
                 # Check if we still have a connection to discord
                 try:
                     embed = await session_embed(plex)
                     await message.edit(embed=embed, content="")
+                    generation = poller.generation
                     await asyncio.sleep(10)
+                    # Only edit again once the poller has something new, it backs off while the server is idle
+                    try:
+                        await poller.wait_for_update(timeout=poller.max_interval, after=generation)
+                    except asyncio.TimeoutError:
+                        pass
                     # await log_scan()
                     # Dynamic sleep based on our current discord rate limit
                 except discord_errors.NotFound:
@@ -183,10 +199,10 @@ class PlexBot(Cog):
 
     @command(name="pending_invites", aliases=["pendinginvites", "pendinginvite", "pending"])
     async def pending_invites(self, ctx):
-        celery = ctx.plex.myPlexAccount()
-        invites = celery.pendingInvites()
-        incoming = celery.pendingInvites(includeSent=False)
-        outgoing = celery.pendingInvites(includeReceived=False)
+        celery = await ctx.plex.aio.myPlexAccount()
+        invites = await ctx.plex.aio.run(celery.pendingInvites)
+        incoming = await ctx.plex.aio.run(celery.pendingInvites, includeSent=False)
+        outgoing = await ctx.plex.aio.run(celery.pendingInvites, includeReceived=False)
         if len(invites) == 0:
             embed = discord.Embed(title="Pending Invites",
                                   description="There are currently no pending invites", color=0x00ff00)
@@ -218,16 +234,17 @@ class PlexBot(Cog):
     @has_permissions(manage_guild=True)
     @command(name="invite_friend", aliases=["invite", "invite_user"])
     async def invite_friend(self, ctx, *, plex_id: str):
-        celery = ctx.plex.myPlexAccount()
-        celery.inviteFriend(plex_id, ctx.plex, get_all_library(ctx.plex))
+        celery = await ctx.plex.aio.myPlexAccount()
+        libraries = await ctx.plex.aio.sections()
+        await ctx.plex.aio.run(celery.inviteFriend, plex_id, ctx.plex, libraries)
         movie_library_string = ""
-        for library in get_all_library(ctx.plex):
+        for library in libraries:
             if library.type == "movie":
                 movie_library_string += f"`{library.title}` (Size: `{library.totalSize}`)\n"
         embed = discord.Embed(title="Invite Friend", description="Friend was invited", color=0x00ff00)
         embed.add_field(name="Movie Library's", value=movie_library_string, inline=True)
         show_library_string = ""
-        for library in get_all_library(ctx.plex):
+        for library in libraries:
             if library.type == "show":
                 show_library_string += f"`{library.title}` (Size: `{library.totalSize}`)\n"
         embed.add_field(name="Show Library's", value=show_library_string, inline=True)
@@ -238,8 +255,8 @@ class PlexBot(Cog):
     @has_permissions(manage_guild=True)
     @command(name="cancel_invite", aliases=["cancel"])
     async def cancel_invite(self, ctx, *, plex_id: str):
-        celery = ctx.plex.myPlexAccount()
-        invite = celery.cancelInvite(plex_id)
+        celery = await ctx.plex.aio.myPlexAccount()
+        invite = await ctx.plex.aio.run(celery.cancelInvite, plex_id)
         embed = discord.Embed(title="Cancel Invite", description="Invite was canceled", color=0x00ff00)
         embed.timestamp = datetime.datetime.now()
 
@@ -253,8 +270,8 @@ class PlexBot(Cog):
     @has_permissions(administrator=True)
     @command(name="remove_user", aliases=["removeuser", "ru"])
     async def remove_user(self, ctx, user_id):
-        celery = ctx.plex.myPlexAccount()
-        users = ctx.plex.systemAccounts()
+        celery = await ctx.plex.aio.myPlexAccount()
+        users = await ctx.plex.aio.systemAccounts()
         for user in users[2:]:
             if user.name == user_id:
                 embed = discord.Embed(title="Remove User",
@@ -271,7 +288,7 @@ class PlexBot(Cog):
                     reaction, msg_user = await self.bot.wait_for('reaction_add', timeout=30.0, check=check)
                     if str(reaction.emoji) == "✅":
                         try:
-                            celery.removeFriend(user.id)
+                            await ctx.plex.aio.run(celery.removeFriend, user.id)
                             embed = discord.Embed(title="Remove User",
                                                   description=f"User `{user.name}` was removed from "
                                                               f"{ctx.plex.friendlyName}",
@@ -303,8 +320,8 @@ class PlexBot(Cog):
     @has_permissions(manage_guild=True)
     @command(name='users')
     async def users(self, ctx):
-        celery = ctx.plex.myPlexAccount()
-        users = celery.users()
+        celery = await ctx.plex.aio.myPlexAccount()
+        users = await ctx.plex.aio.run(celery.users)
         for chunked_users in [users[i:i + 20] for i in range(0, len(users), 20)]:
             embed = discord.Embed(title="Users", description="", color=0x00ff00)
             for user in chunked_users:
@@ -329,7 +346,7 @@ class PlexBot(Cog):
             await ctx.send(embed=embed)
             return
         user = ctx.plex.associations.get(user)
-        embed = base_user_layer(user, self.bot.database)
+        embed = await base_user_layer(user, self.bot.db)
         await ctx.send(embed=embed)
 
     @has_permissions(manage_guild=True)
@@ -339,8 +356,9 @@ class PlexBot(Cog):
         if isinstance(discord_user, discord.Role):
             raise BadArgument("You can't link a role to a plex user")
         print(f"{discord_user.name} is linking to {plex_id}")
-        plex_users = ctx.plex_host.users()
-        plex_users.append(ctx.plex_host)
+        plex_host = await ctx.plex.aio.myPlexAccount()
+        plex_users = await ctx.plex.aio.run(plex_host.users)
+        plex_users.append(plex_host)
         plex_user = None
 
         for user in plex_users:
@@ -397,18 +415,43 @@ class PlexBot(Cog):
 
     @command(name='sessions')
     async def sessions(self, ctx):
-        embed = await session_embed(ctx.plex)
+        embed = await session_embed(ctx.plex, max_age=2)
         await ctx.send(embed=embed)
 
     @has_permissions(manage_guild=True)
     @command(name='plex')
     async def plex_status(self, ctx):
         embed = discord.Embed(title="Plex Status", description="", color=0x00ff00)
-        embed.add_field(name="Clients", value=f"{len(ctx.plex().systemAccounts())}", inline=False)
-        for client in ctx.plex().systemAccounts():
+        accounts = await ctx.plex.aio.systemAccounts()
+        embed.add_field(name="Clients", value=f"{len(accounts)}", inline=False)
+        for client in accounts:
             if len(client.name) < 1:
                 client.name = "Unknown"
             embed.add_field(name=client.name, value=client.key, inline=False)
+        for lane, stats in ctx.plex.aio.executor.stats().items():
+            embed.add_field(name=f"{lane.capitalize()} executor",
+                            value=f"Pending: `{stats['pending']}` Waiting: `{stats['waiting']}`\n"
+                                  f"Completed: `{stats['completed']}` Failed: `{stats['failed']}` "
+                                  f"Rejected: `{stats['rejected']}`\n"
+                                  f"Busy: `{stats['busy_time']}s` Longest wait: `{stats['max_wait']}s`",
+                            inline=True)
+        index = ctx.plex.media_index.stats()
+        embed.add_field(name="Media index",
+                        value=f"Entries: `{index['entries']}` Direct: `{index['direct_hits']}`\n"
+                              f"Scans: `{index['scans']}` Found: `{index['scan_hits']}` Missed: `{index['misses']}`\n"
+                              f"Scan time: `{index['scan_time']}s` Longest: `{index['max_scan_time']}s`",
+                        inline=True)
+        cache = ctx.plex.metadata_cache.stats()
+        embed.add_field(name="Metadata cache",
+                        value=f"Entries: `{cache['entries']}` Items: `{cache['items']}`\n"
+                              f"Hits: `{cache['hits']}` Misses: `{cache['misses']}`\n"
+                              f"Evicted: `{cache['evictions']}` Invalidated: `{cache['invalidations']}`",
+                        inline=True)
+        devices = ctx.plex.device_activity.stats()
+        embed.add_field(name="Device sightings",
+                        value=f"Pending: `{devices['pending']}` Seen: `{devices['sightings']}`\n"
+                              f"Flushes: `{devices['flushes']}` Rows written: `{devices['rows_written']}`",
+                        inline=True)
 
         await ctx.send(embed=embed)
 
@@ -417,7 +460,7 @@ class PlexBot(Cog):
     async def set_activity_channel(self, ctx, channel: discord.TextChannel):
         """Adds a plex activity channel to the database"""
         table = self.bot.database.get_table("activity_messages")
-        table.update_or_add(guild_id=ctx.guild.id, channel_id=channel.id)
+        await self.bot.db.call(table.update_or_add, guild_id=ctx.guild.id, channel_id=channel.id)
         embed = discord.Embed(title="Set Activity Channel", description=f"Set activity channel to {channel.mention}",
                               color=0x00ff00)
         embed.timestamp = datetime.datetime.now()
@@ -428,10 +471,9 @@ class PlexBot(Cog):
     @command(name="set_alert_channel", aliases=["setalertchannel", "setalert"])
     async def set_alert_channel(self, ctx, channel: discord.TextChannel):
         """Adds a plex alert channel to the database"""
-        self.bot.database.execute(
+        await self.bot.db.write(
             "INSERT INTO plex_alert_channel (guild_id, channel_id) VALUES (?, ?)",
             (ctx.guild.id, channel.id))
-        self.bot.database.commit()
         embed = discord.Embed(title="Set Alert Channel", description=f"Set alert channel to {channel.mention}",
                               color=0x00ff00)
         embed.timestamp = datetime.datetime.now()
@@ -446,7 +488,7 @@ class PlexBot(Cog):
             raise BadArgument("Invalid plex url, must be http://<ip>:<port>")
         # Update the plex server in the database with the new values if it exists or create a new entry if it doesn't
         table = self.bot.database.get_table("plex_servers")
-        table.update_or_add(guild_id=ctx.guild.id, server_url=plex_url, server_token=plex_token)
+        await self.bot.db.call(table.update_or_add, guild_id=ctx.guild.id, server_url=plex_url, server_token=plex_token)
         embed = discord.Embed(title="Set Plex Server", description=f"Set plex server to {plex_url}",
                               color=0x00ff00)
         embed.timestamp = datetime.datetime.now()
@@ -454,6 +496,29 @@ class PlexBot(Cog):
         # Delete the command message as it contains the servers token
         await ctx.message.delete()
 
+    @has_permissions(administrator=True)
+    @command(name='set_poll_interval', aliases=['setpollinterval', 'spi'])
+    async def set_poll_interval(self, ctx, min_interval: float, max_interval: float):
+        """Sets the shortest and longest time in seconds between session polls for this server"""
+        if min_interval < 0.5:
+            raise BadArgument("The minimum interval must be at least 0.5 seconds")
+        if max_interval < min_interval:
+            raise BadArgument("The maximum interval can't be shorter than the minimum interval")
+        if await self.bot.db.read_one("SELECT guild_id FROM plex_servers WHERE guild_id = ?", (ctx.guild.id,)) is None:
+            raise PlexNotLinked()
+        table = self.bot.database.get_table("plex_servers")
+        await self.bot.db.call(table.update_or_add, guild_id=ctx.guild.id, poll_min_interval=min_interval,
+                               poll_max_interval=max_interval)
+        plex = await self.bot.fetch_plex(ctx.guild)
+        plex.poll_min_interval = min_interval
+        plex.poll_max_interval = max_interval
+        embed = discord.Embed(title="Set Poll Interval",
+                              description=f"Sessions will be polled every {min_interval}s to {max_interval}s "
+                                          f"depending on activity",
+                              color=0x00ff00)
+        embed.timestamp = datetime.datetime.now()
+        await ctx.send(embed=embed)
+
     @command(name='transcoding', aliases=['layer8', 'thespiel', 'therant', 'pebkac'], description="Just ask nic")
     async def transcoding(self, ctx):
         spiel_txt = """```Some video files are encoded in a way that the Plex player will lag or drop frames while 
@@ -468,7 +533,7 @@ class PlexBot(Cog):
     @command(name="run_butler_task", aliases=["rbt"])
     async def run_butler_task(self, ctx, *, task_name: str):
         """Runs a butler task"""
-        available_tasks = [task.name for task in ctx.plex.butlerTasks()]
+        available_tasks = [task.name for task in await ctx.plex.aio.butlerTasks()]
         if task_name == 'list':
             message = "Available tasks:\n"
             for task in available_tasks:
@@ -477,12 +542,12 @@ class PlexBot(Cog):
             return
         if task_name not in available_tasks:
             raise BadArgument("Task not found")
-        ctx.plex.runButlerTask(task_name)
+        await ctx.plex.aio.runButlerTask(task_name)
 
     @command(name="current_butler_tasks", aliases=["cbt"])
     async def current_butler_tasks(self, ctx):
         """Lists the current butler tasks"""
-        tasks = ctx.plex.butlerTasks()
+        tasks = await ctx.plex.aio.butlerTasks()
         if len(tasks) == 0:
             await ctx.send("No tasks currently running")
             return
@@ -495,7 +560,7 @@ class PlexBot(Cog):
     @command(name="deep_media_analysis", aliases=["dma"])
     async def deep_media_analysis(self, ctx):
         """Force the plex server to run a deep media analysis"""
-        ctx.plex.runButlerTask("DeepMediaAnalysis")
+        await ctx.plex.aio.runButlerTask("DeepMediaAnalysis")
         await ctx.send("Deep media analysis started")
 
 
@@ -11,13 +11,25 @@ from discord.ext.commands import command, has_permissions, Cog, BadArgument, is_
 from loguru import logger as logging
 
 
-from utils import get_from_media_index
+from utils import fetch_from_media_index, scan_for_media_index
 from wrappers_utils import EventDecorator
+from wrappers_utils.BotExceptions import PlexExecutorBusy
 from wrappers_utils.EventDecorator import EventManager, event_manager
+from wrappers_utils.AlertListenerSupervisor import AlertListenerSupervisor
 from wrappers_utils.MediaEmbedifier import media_details
 
 
 class PlexEvents(Cog):
+    heartbeat_interval = 30  # Seconds between websocket pings to the alert listener
+    heartbeat_timeout = 10  # Seconds to wait for a pong before the websocket is considered dead
+    heartbeat_dead_after = 120  # Restart a listener that has gone this long without a pong or message
+    event_debounce = 2  # Seconds to wait for another library event before handling a batch
+    event_batch_window = 10  # Longest a batch of library events is held open
+    busy_retry_delay = 15  # Seconds to wait before retrying a lookup the server's heavy executor had no room for
+    busy_max_retries = 40
+    parent_update_delay = 15  # Seconds without new episodes before a show's series and season messages are updated
+    parent_update_max_delay = 60
+
     class PlexMediaEvent:
 
         def __init__(self, itemID, message):
@@ -42,7 +54,16 @@ class PlexEvents(Cog):
         self.event_listener_warning_messages = {}
 
         self.event_tracker = {}
-        self.listener_tasks = {}
+        self.listener_tasks = {}  # Guild ID -> task posting that guild's events
+        self.event_queues = {}  # Guild ID -> (shared PlexServer, queue of timeline entries for the guild)
+        self.server_listeners = {}  # id(PlexServer) -> AlertListenerSupervisor for the server
+        self.parent_updates = {}  # Channel ID -> {ratingKey: ("show" or "season", episode, library)}
+        self.parent_update_tasks = {}  # Channel ID -> (task flushing parent_updates, monotonic deadline)
+
+    async def cog_unload(self):
+        event_manager.remove_instance(self)
+        for supervisor in self.server_listeners.values():
+            supervisor.stop()
 
     @Cog.listener()
     async def on_ready(self):
@@ -56,10 +77,10 @@ class PlexEvents(Cog):
         # Used to start the event listener
         # logging.info(f"Connection established with {plex.friendlyName}, starting event listener")
         guild = plex.host_guild
-        table = self.bot.database.get_table("plex_alert_channel")
-        if table.get_row(guild_id=guild.id) is None:
+        config = await self.bot.db.read_one("SELECT channel_id FROM plex_alert_channel WHERE guild_id = ?", (guild.id,))
+        if config is None:
             return
-        channel_id = table.get_row(guild_id=guild.id)['channel_id']
+        channel_id = config[0]
         logging.info(f"Starting event listener for {guild.name} ({plex.friendlyName})")
         self.bot.loop.create_task(self.start_event_listener(guild.id, channel_id))
 
@@ -74,55 +95,68 @@ class PlexEvents(Cog):
             logging.info(f"Stopped event listener for {guild.name} - {plex.friendlyName}")
 
     async def start_event_listener(self, guild_id, channel_id):
-        """Starts the event listener"""
+        """Subscribes a guild's alert channel to its server's event listener and posts the events it receives
+
+        Guilds linked to the same server share one websocket, this task only lives as long as the guild's
+        subscription does.
+        """
+        current = asyncio.current_task()
+        existing = self.listener_tasks.get(guild_id)
+        if existing is not None and existing is not current and not existing.done():
+            existing.cancel()
+        self.listener_tasks[guild_id] = current
 
         channel = self.bot.get_channel(channel_id)
         guild = self.bot.get_guild(guild_id)
         plex = await self.bot.fetch_plex(guild)
 
         event_queue = asyncio.Queue()
-        last_event = time.time()
+        self.event_queues[guild_id] = (plex.connection, event_queue)
+        try:
+            self.ensure_server_listener(plex.connection)
+            logging.info(f"Started event listener for {guild.name}")
+            await self.event_message_loop(plex, event_queue, channel)
+        finally:
+            if guild_id in self.event_queues and self.event_queues[guild_id][1] is event_queue:
+                del self.event_queues[guild_id]
+            if not self.server_subscribed(plex.connection) and id(plex.connection) in self.server_listeners:
+                self.server_listeners.pop(id(plex.connection)).stop()
+
+    def ensure_server_listener(self, server):
+        """Starts the websocket listener for a server if no other guild has already"""
+        supervisor = self.server_listeners.get(id(server))
+        if supervisor is None:
+            supervisor = AlertListenerSupervisor(server, self.event_callback(server), self.event_error,
+                                                 ping_interval=self.heartbeat_interval,
+                                                 ping_timeout=self.heartbeat_timeout,
+                                                 dead_after=self.heartbeat_dead_after)
+            self.server_listeners[id(server)] = supervisor
+        supervisor.start()
+
+    def server_subscribed(self, server) -> bool:
+        return any(connection is server for connection, _ in self.event_queues.values())
+
+    def event_callback(self, server):
+        """Makes the callback that fans a server's alerts out to every guild subscribed to it"""
 
         def event_callback(data):
-            nonlocal last_event
-            last_event = time.time()
             if data['type'] == 'timeline':
                 entry = data['TimelineEntry'][0]
                 if entry['identifier'] == 'com.plexapp.plugins.library':
-                    event_queue.put_nowait(entry)
-
-        listener = plexapi.alert.AlertListener(plex, event_callback, self.event_error)
-        listener.name = f"EventListener-{guild.name}"
-        listener.start()
-        task = self.bot.loop.create_task(self.event_message_loop(plex, event_queue, channel))
-        self.listener_tasks[guild_id] = task
-        logging.info(f"Started event listener for {guild.name}")
-        # print([task.name for task in plex.butlerTasks()])
-
-        try:
-            while listener.is_alive():
-                # Check when the last event was received
-                if time.time() - last_event > 300:
-                    logging.info(f"Event listener for {guild.name} has been inactive for 5 minutes, sending trigger")
-                    # Send an action to the plex server that will trigger an event message
-                    plex.runButlerTask('LoudnessAnalysis')
-                elif time.time() - last_event > 500:
-                    logging.warning(f"Event trigger for {guild.name} was unsuccessful, restarting event listener")
-                    listener.stop()
-                    break
-                await asyncio.sleep(1)
-            task.cancel()
-            logging.warning(f"Event listener for {guild.name} has stopped")
-            # Check if the plex server is offline
-            if not plex.online:
-                logging.warning(f"Plex server {plex.friendlyName} is offline, discontinuing attempts to restart event "
-                                f"listener")
-                return
-        except Exception as e:
-            logging.error(e)
-            logging.exception(e)
-        finally:
-            await self.start_event_listener(guild_id, channel_id)
+                    server.metadata_cache.invalidate_timeline_entry(entry, server.media_index)
+                    server.media_index.add_timeline_entry(entry)
+                    server.library_census.invalidate_timeline_entry(entry)
+                    for connection, queue in list(self.event_queues.values()):
+                        if connection is server:
+                            self.bot.loop.call_soon_threadsafe(queue.put_nowait, entry)
+            elif data['type'] == 'playing':
+                # Forward session state changes to the session watchers so they don't need to poll
+                notifications = data.get('PlaySessionStateNotification', [])
+                for watcher in self.bot.session_watchers:
+                    if watcher.server.connection is server:
+                        asyncio.run_coroutine_threadsafe(watcher.on_playing(notifications), self.bot.loop)
+
+        return event_callback
 
     def event_error(self, error):
         logging.error(error)
@@ -130,21 +164,62 @@ class PlexEvents(Cog):
 
     async def event_message_loop(self, plex, queue, channel):
         self.event_tracker[channel.guild.id] = []
-        lock = asyncio.Lock()
         while True:
+            batch = await self.collect_event_batch(queue)
+            # Plex repeats timeline entries, only handle each state of each item once per batch
+            events = {}
+            for event in batch:
+                if event is not None and int(event['sectionID']) != -1:
+                    events[(event['itemID'], event['state'])] = event
+            matched = []
+            for event in events.values():
+                try:
+                    await self.send_event_message(plex, channel, event, matched)
+                except Exception as e:
+                    logging.error(e)
+                    logging.exception(e)
+            if matched:
+                asyncio.ensure_future(self.apply_media_batch(channel, matched))
+            if None in batch:
+                break
+
+    async def collect_event_batch(self, queue):
+        """Waits for a library event then keeps collecting until the queue goes quiet, so an import is one batch"""
+        batch = [await queue.get()]
+        deadline = time.monotonic() + self.event_batch_window
+        while batch[-1] is not None:
+            timeout = min(self.event_debounce, deadline - time.monotonic())
+            if timeout <= 0:
+                break
             try:
-                event = await queue.get()  # type: dict
-                if event is None:
+                batch.append(await asyncio.wait_for(queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def apply_media_batch(self, channel, matched):
+        """Applies the media info for a batch of matched items one at a time, so an import doesn't swamp the
+        server's heavy executor"""
+        for event_obj, library in matched:
+            for attempt in range(self.busy_max_retries + 1):
+                try:
+                    await self.apply_media_info(channel, event_obj, library)
+                except PlexExecutorBusy as e:
+                    # The library scan fallback couldn't be queued, likely a metadata refresh is hogging the heavy
+                    # executor, wait for it rather than leaving the message unfilled
+                    if attempt == self.busy_max_retries:
+                        logging.error(f"Gave up applying media info for {event_obj.itemID} after "
+                                      f"{attempt + 1} attempts: {e}")
+                        break
+                    logging.warning(f"Heavy executor busy looking up {event_obj.itemID}, "
+                                    f"retrying in {self.busy_retry_delay}s")
+                    await asyncio.sleep(self.busy_retry_delay)
+                except Exception as e:
+                    logging.error(e)
+                    logging.exception(e)
+                    break
+                else:
                     break
-                if int(event['sectionID']) == -1:
-                    continue
-                # print(event)
-                await lock.acquire()  # Ensure only one event is processed at a time
-                await self.send_event_message(plex, channel, event)
-                lock.release()
-            except Exception as e:
-                logging.error(e)
-                logging.exception(e)
 
     def get_media_event(self, guild_id, itemID, title=None):
         for event in self.event_tracker[guild_id]:
@@ -155,17 +230,21 @@ class PlexEvents(Cog):
     async def safe_mediaID_search(self, library, mediaID):
         """Because searching by mediaID is blocking and takes awhile we need to do it asyncio safe to prevent
         blocking the event loop"""
-        # Use get_from_media_index(library, mediaID)
-        return await self.bot.loop.run_in_executor(None, get_from_media_index, library, mediaID, True)
+        # The direct fetch is a single request so it goes on the light executor, only the library scan it falls
+        # back to is heavy and can raise PlexExecutorBusy
+        media = await library._server.aio.run(fetch_from_media_index, library, mediaID)
+        if media is None:
+            media = await library._server.aio.run_heavy(scan_for_media_index, library, mediaID, True)
+        return media
 
     async def get_message_from_plex_id(self, plex_media_id):
         """Searches the database for a message with the given itemID"""
-        table = self.bot.database.get_table("plex_media_event_messages")
-        row = table.get_row(plex_media_id=plex_media_id)
+        row = await self.bot.db.read_one("SELECT channel_id, message_id FROM plex_media_event_messages "
+                                         "WHERE plex_media_id = ?", (plex_media_id,))
         if row is None:
             return None
-        channel = self.bot.get_channel(row['channel_id'])
-        message = await channel.fetch_message(row['message_id'])
+        channel = self.bot.get_channel(row[0])
+        message = await channel.fetch_message(row[1])
         return message
 
     async def apply_media_info(self, channel, event_obj=None, library=None, edit=False, media_obj=None, msg=None):
@@ -178,22 +257,11 @@ class PlexEvents(Cog):
         if media is not None:
             # If media is an episode update the series and season embeds that were sent previously
             if media.type == 'episode':
-                series_message = await self.get_message_from_plex_id(media.grandparentRatingKey)
-                if series_message is not None:
-                    await self.apply_media_info(channel, library=library, edit=True, media_obj=media.show(),
-                                                msg=series_message)
-                else:
-                    logging.warning(f"Could not find series message for {media.grandparentTitle}")
-                season_message = await self.get_message_from_plex_id(media.parentRatingKey)
-                if season_message is not None:
-                    await self.apply_media_info(channel, library=library, edit=True, media_obj=media.season(),
-                                                msg=season_message)
-                else:
-                    logging.warning(f"Could not find season message for {media.parentTitle}")
+                self.queue_parent_update(channel, library, media)
             # Save the message info for the season
-            self.event_message_table.update_or_add(plex_media_id=media.ratingKey, guild_id=channel.guild.id,
-                                                   channel_id=channel.id,
-                                                   message_id=event_obj.message.id if event_obj is not None else msg.id)
+            await self.bot.db.call(self.event_message_table.update_or_add, plex_media_id=media.ratingKey,
+                                   guild_id=channel.guild.id, channel_id=channel.id,
+                                   message_id=event_obj.message.id if event_obj is not None else msg.id)
             try:
                 await self.download_thumbnails(channel, media)
             except Exception as e:
@@ -209,10 +277,47 @@ class PlexEvents(Cog):
         else:
             await msg.edit(embed=embed)
 
+    def queue_parent_update(self, channel, library, episode):
+        """Schedules the series and season messages of an episode to be updated once its show stops receiving
+        episodes, so importing a season edits each of them once rather than once per episode"""
+        pending = self.parent_updates.setdefault(channel.id, {})
+        pending[episode.grandparentRatingKey] = ("show", episode, library)
+        pending[episode.parentRatingKey] = ("season", episode, library)
+        task, _ = self.parent_update_tasks.get(channel.id, (None, None))
+        deadline = time.monotonic() + self.parent_update_delay
+        if task is None or task.done():
+            task = asyncio.ensure_future(self.flush_parent_updates(channel))
+        self.parent_update_tasks[channel.id] = (task, deadline)
+
+    async def flush_parent_updates(self, channel):
+        while self.parent_updates.get(channel.id):
+            started = time.monotonic()
+            while True:
+                _, deadline = self.parent_update_tasks[channel.id]
+                deadline = min(deadline, started + self.parent_update_max_delay)
+                if time.monotonic() >= deadline:
+                    break
+                await asyncio.sleep(deadline - time.monotonic())
+            pending = self.parent_updates.pop(channel.id, {})
+            for rating_key, (kind, episode, library) in pending.items():
+                try:
+                    message = await self.get_message_from_plex_id(rating_key)
+                    if message is None:
+                        title = episode.grandparentTitle if kind == "show" else episode.parentTitle
+                        logging.warning(f"Could not find {kind} message for {title}")
+                        continue
+                    parent = await episode._server.aio.run(episode.show if kind == "show" else episode.season)
+                    await self.apply_media_info(channel, library=library, edit=True, media_obj=parent, msg=message)
+                except Exception as e:
+                    logging.error(e)
+                    logging.exception(e)
+
     async def download_thumbnails(self, channel, media):
         """Downloads thumbnails for media into the webserver path"""
-        server_info = self.bot.database.get_table("plex_servers").get_row(guild_id=channel.guild.id)
-        if not server_info['webserver_path']:
+        server_info = await self.bot.db.read_one("SELECT webserver_path, server_url FROM plex_servers "
+                                                 "WHERE guild_id = ?", (channel.guild.id,))
+        webserver_path, plex_url = server_info
+        if not webserver_path:
             logging.warning(f"Webserver path not set for guild {channel.guild.id}, cannot create thumbnails")
             return
         urls, paths = [], []
@@ -222,10 +327,9 @@ class PlexEvents(Cog):
             urls.append(media.artUrl)
         if media.thumbUrl:
             urls.append(media.thumbUrl)
-        plex_url = server_info['server_url']
         if plex_url.endswith('/'):
             plex_url = plex_url[:-1]
-        paths = [os.path.join(server_info['webserver_path'],
+        paths = [os.path.join(webserver_path,
                               url[len(plex_url) + 1:url.find('?')] + ".jpg") for url in urls]
         for i in range(len(urls)):
             if not os.path.exists(paths[i]):
@@ -235,7 +339,9 @@ class PlexEvents(Cog):
                 with open(paths[i], 'wb') as f:
                     f.write(r.content)
 
-    async def send_event_message(self, plex, channel, event):
+    async def send_event_message(self, plex, channel, event, matched=None):
+        """Posts or updates the message for a library event, items that finish matching are appended to matched
+        to have their media info applied once the batch is done, or applied straight away if it isn't given"""
 
         # only include messages with an ID of 0, 5, 9
         if int(event['sectionID']) < 0:
@@ -244,7 +350,7 @@ class PlexEvents(Cog):
                                   description=f"Received event with invalid sectionID: {event['sectionID']}")
             await channel.send(embed=embed)
             return
-        library = plex.library.sectionByID(int(event['sectionID']))
+        library = await plex.aio.sectionByID(int(event['sectionID']))
 
         match event['state']:
             case 0:
@@ -306,8 +412,11 @@ class PlexEvents(Cog):
                                           description=f"Searching for media `{event['title']}` in `{library.title}`")
                     embed.set_footer(text=f"Metadata download complete searching for media ID: {event['itemID']}")
                     await event_obj.message.edit(embed=embed)
-                    # Start a new task to search for the media
-                    asyncio.ensure_future(self.apply_media_info(channel, event_obj, library))
+                    if matched is not None:
+                        matched.append((event_obj, library))
+                    else:
+                        # Start a new task to search for the media
+                        asyncio.ensure_future(self.apply_media_info(channel, event_obj, library))
                     event_obj.last_state = 5
                     await asyncio.sleep(1)
             case 9:
@@ -338,7 +447,7 @@ class PlexEvents(Cog):
     @command(name="config_event_listener", aliases=["sel"])
     async def config_event_listener(self, ctx, channel: discord.TextChannel = None):
         table = self.bot.database.get_table("plex_alert_channel")
-        table.update_or_add(guild_id=ctx.guild.id, channel_id=channel.id)
+        await self.bot.db.call(table.update_or_add, guild_id=ctx.guild.id, channel_id=channel.id)
         # Stop any existing event listeners
         if ctx.guild.id in self.listener_tasks:
             self.listener_tasks[ctx.guild.id].cancel()
@@ -352,7 +461,7 @@ class PlexEvents(Cog):
     @command(name="stop_event_listener", aliases=["stel"])
     async def stop_event_listener(self, ctx):
         table = self.bot.database.get_table("plex_alert_channel")
-        table.delete(guild_id=ctx.guild.id)
+        await self.bot.db.call(table.delete, guild_id=ctx.guild.id)
         # actually stop the event listener
         task = self.listener_tasks[ctx.guild.id]
         task.cancel()
@@ -361,8 +470,8 @@ class PlexEvents(Cog):
     @has_permissions(manage_guild=True)
     @command(name="restart_event_listener", aliases=["rel"])
     async def restart_event_listener(self, ctx):
-        table = self.bot.database.get_table("plex_alert_channel")
-        config = table.get_row(guild_id=ctx.guild.id)
+        config = await self.bot.db.read_one("SELECT channel_id FROM plex_alert_channel WHERE guild_id = ?",
+                                            (ctx.guild.id,))
         if config is None:
             await ctx.send("No event listener configured")
         else:
@@ -371,32 +480,43 @@ class PlexEvents(Cog):
             task.cancel()
             await ctx.send("Stopped existing event listener")
             # actually start the event listener
-            task = self.bot.loop.create_task(self.start_event_listener(ctx.guild.id, config['channel_id']))
+            task = self.bot.loop.create_task(self.start_event_listener(ctx.guild.id, config[0]))
             self.listener_tasks[ctx.guild.id] = task
             await ctx.send("Started event listener")
 
     @has_permissions(manage_guild=True)
     @command(name="event_listener_status", aliases=["els"])
     async def event_listener_status(self, ctx):
-        table = self.bot.database.get_table("plex_alert_channel")
-        config = table.get_row(guild_id=ctx.guild.id)
+        config = await self.bot.db.read_one("SELECT channel_id FROM plex_alert_channel WHERE guild_id = ?",
+                                            (ctx.guild.id,))
         if config is None:
             await ctx.send("No event listener configured")
         else:
             # Check the if the task is still running
-            task = self.listener_tasks[ctx.guild.id]
-            if task.done():
+            task = self.listener_tasks.get(ctx.guild.id)
+            if task is None or task.done():
                 await ctx.send("Event listener is configured for channel "
-                               f"<#{config['channel_id']}> but is not running")
-            else:
+                               f"<#{config[0]}> but is not running")
+                return
+            supervisor = self.server_listeners.get(id(ctx.plex.connection))
+            if supervisor is None:
                 await ctx.send("Event listener is configured for channel "
-                               f"<#{config['channel_id']}> and is running")
+                               f"<#{config[0]}> and is running")
+                return
+            status = supervisor.status()
+            heartbeat = f"{status['heartbeat_age']:.0f}s ago" if status['heartbeat_age'] is not None else "never"
+            await ctx.send("Event listener is configured for channel "
+                           f"<#{config[0]}> and is running\n"
+                           f"Websocket for `{ctx.plex.friendlyName}` is {status['state']}, "
+                           f"up for {datetime.timedelta(seconds=int(status['uptime']))}\n"
+                           f"Reconnects: {status['reconnects']}, events: {status['events']} "
+                           f"({status['events_per_second']:.2f}/s over the last minute), last heartbeat {heartbeat}")
 
     @is_owner()
     @command(name="set_webserver_path")
     async def set_webserver_path(self, ctx, path):
         table = self.bot.database.get_table("plex_servers")
-        table.update_or_add(guild_id=ctx.guild.id, webserver_path=path)
+        await self.bot.db.call(table.update_or_add, guild_id=ctx.guild.id, webserver_path=path)
         await ctx.send("Updated webserver path")
 
 
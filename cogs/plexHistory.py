@@ -5,7 +5,6 @@ import re
 import traceback
 from urllib import request
 
-import aiohttp
 import discord
 import plexapi.video
 from discord import Interaction, ButtonStyle, ActionRow
@@ -16,6 +15,7 @@ from discord.ext.commands import Cog, command, has_permissions
 from discord.ui import Button, View, Select
 
 from wrappers_utils.BotExceptions import PlexNotLinked, PlexNotReachable
+from wrappers_utils.HistoryOutbox import HistoryOutbox
 from wrappers_utils.Modals import ReviewModal
 from wrappers_utils.SessionChangeWatchers import SessionChangeWatcher, SessionWatcher
 from utils import base_info_layer,cleanup_url, text_progress_bar_maker, \
@@ -40,13 +40,12 @@ class PlexHistory(commands.Cog):
         @discord.ui.button(label="Media Info", style=ButtonStyle.blurple, custom_id="mediainfo",
                            emoji="📹")
         async def media_info_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-            # Get the message ID
-            event = self.get_event(interaction)
+            # Get the event and its media from the database
+            client = interaction.client
+            event, media_entry = await client.db.call(self.get_event, client.database, interaction.message.id)
             if event is None:
                 return await interaction.response.send_message(
                     f"PlexBot was unable to find this media event {interaction.message.id} in the database.", ephemeral=True)
-            # Get the media from the database
-            media_entry = event.get("plex_watched_media")
             # Get the media object
             if len(media_entry) == 1:
                 await interaction.response.defer(thinking=True, ephemeral=True)
@@ -55,7 +54,7 @@ class PlexHistory(commands.Cog):
                                                    media_entry[0])
                 if media:
                     # Get the embed
-                    embed = self.media_embed(media, interaction.client.database, media_entry[0]["media_id"])
+                    embed = await self.media_embed(media, interaction.client.db, media_entry[0]["media_id"])
                     # Send the embed
                     await original_response.edit(embed=embed)
                 else:
@@ -66,14 +65,15 @@ class PlexHistory(commands.Cog):
         @discord.ui.button(label="User Info", style=ButtonStyle.green, custom_id="userinfo",
                            emoji="\N{BUSTS IN SILHOUETTE}")
         async def user_info_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-            event = self.get_event(interaction)
+            client = interaction.client
+            event, _ = await client.db.call(self.get_event, client.database, interaction.message.id)
             if event:
                 # Get the user ID
                 account_id = event["account_id"]
                 guild = interaction.guild
                 plex = await interaction.client.fetch_plex(guild)
                 user = plex.associations.get(account_id)
-                embed = base_user_layer(user, interaction.client.database)
+                embed = await base_user_layer(user, interaction.client.db)
                 await interaction.response.send_message(embed=embed, ephemeral=True)
             else:
                 await interaction.response.send_message("PlexBot was unable to find this media event in the database.",
@@ -83,8 +83,8 @@ class PlexHistory(commands.Cog):
                            emoji="📝")
         async def add_rating_button(self, interaction: discord.Interaction, button: discord.ui.Button):
             # Verify that the user clicking the button is the same user who watched the media
-            # Get the message ID
-            event = self.get_event(interaction)
+            client = interaction.client
+            event, media_entry = await client.db.call(self.get_event, client.database, interaction.message.id)
             if event:
                 # Get the user ID
                 account_id = event["account_id"]
@@ -92,8 +92,6 @@ class PlexHistory(commands.Cog):
                 plex = await interaction.client.fetch_plex(guild)
                 user = plex.associations.get(account_id)
                 if interaction.user.id == user.discord_id:
-                    # Get the media from the database
-                    media_entry = event.get("plex_watched_media")
                     # Get the media object
                     if len(media_entry) == 1:
                         # Create a popup view
@@ -110,34 +108,42 @@ class PlexHistory(commands.Cog):
                 await interaction.response.send_message("PlexBot was unable to find this media event in the database.",
                                                         ephemeral=True)
 
-        def get_event(self, interaction: discord.Interaction):
-            # Get the message ID
-            message_id = interaction.message.id
-            # Get the event from the database
-            table = interaction.client.database.get_table("plex_history_messages")
+        @staticmethod
+        def get_event(database, message_id):
+            """The watch event of a history message and the event's media entries, this blocks so run it through the
+            gateway"""
+            table = database.get_table("plex_history_messages")
             message = table.get_row(message_id=message_id)
             if message is None:
-                return None
+                return None, []
             event = message.get("plex_history_events")
             if len(event) == 0:
-                return None
+                return None, []
             event = event[0]
-            return event
+            return event, event.get("plex_watched_media")
 
         @staticmethod
         async def media_from_guid(guild, client, entry):
             plex = await client.fetch_plex(guild)
+            if entry["rating_key"]:
+                try:
+                    media = await plex.aio.fetchItem(int(entry["rating_key"]))
+                    if media is not None:
+                        return media
+                except plexapi.exceptions.NotFound:
+                    logging.debug(f"Rating key {entry['rating_key']} for {entry['title']} no longer exists")
             if entry["library_id"] == "N/A" or entry["media_guid"] == "N/A":
                 return None
-            library = plex.library.sectionByID(int(entry["library_id"]))
+            library = await plex.aio.sectionByID(int(entry["library_id"]))
             if entry["media_type"] == "episode":
-                show_entry = client.database.get_table("plex_watched_media").get_row(media_id=entry["show_id"])
+                show_entry = await client.db.read_one("SELECT media_guid FROM plex_watched_media WHERE media_id = ?",
+                                                      (entry["show_id"],))
                 if show_entry:
                     # tell discord we are thinking
-                    show = get_from_guid(library, show_entry["media_guid"])
+                    show = await plex.aio.run(get_from_guid, library, show_entry[0])
                     if show:
-                        media = show.episode(
-                            title=entry["title"], season=int(entry["season_num"]), episode=int(entry["ep_num"]))
+                        media = await plex.aio.run(show.episode, title=entry["title"], season=int(entry["season_num"]),
+                                                   episode=int(entry["ep_num"]))
                     else:
                         return None
                 else:
@@ -146,11 +152,13 @@ class PlexHistory(commands.Cog):
             elif entry["media_type"] == "clip":
                 return None  # Find a way to get clips
             else:
-                media = get_from_guid(library, entry["media_guid"])
+                media = await plex.aio.run(get_from_guid, library, entry["media_guid"])
+            if media:
+                await client.db.call(entry.set, rating_key=media.ratingKey)
             return media
 
         @staticmethod
-        def media_embed(content, database, media_id):
+        async def media_embed(content, db, media_id):
 
             if content.isPartialObject():  # If the media is only partially loaded
                 content.reload()  # do it correctly this time
@@ -158,14 +166,14 @@ class PlexHistory(commands.Cog):
             if isinstance(content, plexapi.video.Movie):
                 embed = discord.Embed(title=f"{content.title} ({content.year})",
                                       description=f"{content.tagline}", color=0x00ff00)
-                base_info_layer(embed, content, database=database)  # Add the base info layer to the embed
+                await base_info_layer(embed, content, db=db)  # Add the base info layer to the embed
 
             elif isinstance(content, plexapi.video.Episode):  # ------------------------------------------------------
                 """Format the embed being sent for an episode"""
                 embed = discord.Embed(title=f"{content.grandparentTitle}\n{content.title} "
                                             f"(S{content.parentIndex}E{content.index})",
                                       description=f"{content.summary}", color=0x00ff00)
-                base_info_layer(embed, content, database=database)
+                await base_info_layer(embed, content, db=db)
 
             else:
                 embed = discord.Embed(title=f"Unknown media type", color=0x00ff00)
@@ -188,6 +196,8 @@ class PlexHistory(commands.Cog):
         self.sent_hashes = []
         self.history_channels = []
 
+        self.outbox = HistoryOutbox(bot, self.HistoryOptions)
+
         # Create variable to check the rate of history updates (if it is being flooded with requests we kill it)
         self.history_update_rate = 0
         self.history_update_rate_limit = 10
@@ -195,47 +205,44 @@ class PlexHistory(commands.Cog):
     @Cog.listener('on_ready')
     async def on_ready(self):
         logging.info("Cog: PlexHistory is ready")
-        table = self.bot.database.get_table("plex_history_channel")
-        for row in table.get_all():
+        for row in await self.bot.db.read("SELECT guild_id, channel_id FROM plex_history_channel"):
             # Validate that there is not already a task for this channel
-            if row["channel_id"] not in self.history_tasks:
+            if row[1] not in self.history_tasks:
                 task = asyncio.get_event_loop().create_task(self.history_watcher(row[0], row[1]))
                 self.history_tasks[row[0]] = task
+        self.outbox.start()
         logging.info("PlexHistory startup complete")
 
+    async def cog_unload(self):
+        await self.outbox.stop()
+
     @Cog.listener('on_raw_message_delete')
     async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
         # Check if the message was in a history channel
         if payload.channel_id in self.history_channels:
-            table = self.bot.database.get_table("plex_history_messages")
-            message_entry = table.get_row(message_id=payload.message_id)
-            if message_entry:
-                history_entry = message_entry.get("plex_history_events")
-                if len(history_entry) == 1:
-                    # Delete the history entry
-                    history_entry[0].delete()
-                    table.delete(message_id=payload.message_id)
-                    logging.info(f"Deleted history entry for message {payload.message_id}")
-                else:
-                    logging.error("Found multiple history entries for a single message")
+            await self.bot.db.call(self.delete_history_message, payload.message_id)
 
     @Cog.listener('on_raw_bulk_message_delete')
     async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
         # Check if the message was in a history channel
         if payload.channel_id in self.history_channels:
             logging.info(f"Bulk delete in history channel {payload.channel_id}, deleting associated records")
-            table = self.bot.database.get_table("plex_history_messages")
             for message_id in payload.message_ids:
-                message_entry = table.get_row(message_id=message_id)
-                if message_entry:
-                    history_entry = message_entry.get("plex_history_events")
-                    if len(history_entry) == 1:
-                        # Delete the history entry
-                        history_entry[0].delete()
-                        table.delete(message_id=message_id)
-                        logging.info(f"Deleted history entry for message {message_id}")
-                    else:
-                        logging.error("Found multiple history entries for a single message")
+                await self.bot.db.call(self.delete_history_message, message_id)
+
+    def delete_history_message(self, message_id):
+        """Delete a history message's entry and its watch event, this blocks so run it through the gateway"""
+        table = self.bot.database.get_table("plex_history_messages")
+        message_entry = table.get_row(message_id=message_id)
+        if message_entry:
+            history_entry = message_entry.get("plex_history_events")
+            if len(history_entry) == 1:
+                # Delete the history entry
+                history_entry[0].delete()
+                table.delete(message_id=message_id)
+                logging.info(f"Deleted history entry for message {message_id}")
+            else:
+                logging.error("Found multiple history entries for a single message")
 
     async def history_watcher(self, guild_id, channel_id):
         channel = await self.bot.fetch_channel(channel_id)
@@ -252,7 +259,7 @@ class PlexHistory(commands.Cog):
         # Check if there is already a watcher for this guild
         if self.bot.session_watchers:
             for watcher in self.bot.session_watchers:
-                if watcher.server.friendlyName == plex.friendlyName:
+                if watcher.server is plex:
                     logging.info(f"History watcher for {guild.name} already exists")
                     return
         self.bot.session_watchers.append(SessionChangeWatcher(plex, self.on_watched, channel))
@@ -285,7 +292,7 @@ class PlexHistory(commands.Cog):
         if len(session.players) >= 1:
             device_name = session.players[0].machineIdentifier
             device = None
-            for sys_device in plex.systemDevices():
+            for sys_device in await plex.aio.systemDevices():
                 if sys_device.clientIdentifier == device_name:
                     device = sys_device
                     break
@@ -332,71 +339,69 @@ class PlexHistory(commands.Cog):
         embed.set_footer(text=f"This session was alive for {alive_time}, Started")
 
         if hasattr(session, "thumb"):
-            thumb_url = cleanup_url(session.thumb)
-            # Validate that there is an image hosted at the URL by trying to open it
-            # noinspection PyBroadException
-            try:
-                # Check if a file is hosted at the URL
-                async with aiohttp.ClientSession() as web_session:
-                    async with web_session.get(thumb_url) as r:
-                        if r.status != 200:
-                            thumb_url = "https://cdn.discordapp.com/attachments/1191806535861538948/1191806693621911572/bad_thumb.png"
-                            logging.warning(f"Bad thumb URL: {thumb_url}")
-            except Exception as e:
-                logging.warning(f"Error validating thumb URL: {thumb_url} - {e}")
-                thumb_url = "https://cdn.discordapp.com/attachments/1191806535861538948/1191806693621911572/bad_thumb.png"
-            embed.set_thumbnail(url=thumb_url)
+            # The outbox checks there's an image at the URL before the message is sent
+            embed.set_thumbnail(url=cleanup_url(session.thumb))
 
         m_hash = hash_media_event(session)
 
-        view = self.HistoryOptions()
-
         media_table = self.bot.database.get_table("plex_watched_media")
 
-        media_entry = media_table.get_row(media_guid=session.guid, guild_id=guild.id)
-        if not media_entry:  # If no media entry exists with this guid, fallback to the media name
-            logging.debug(f"Could not find GUID {session.guid} in database, falling back to media name")
-            if session.type == "episode":
-                media_entry = media_table.get_row(title=session.grandparentTitle, season_num=session.parentIndex,
-                                                  ep_num=session.index, guild_id=guild.id)
-            else:
-                media_entry = media_table.get_row(title=session.title, media_year=session.year,
-                                                  media_type=session.type, guild_id=guild.id)
-        if not media_entry:  # If no media entry exists at all, insert a new one
-            logging.debug(f"Could not find media entry for {session.title} in database, creating new entry")
-            media_table.add(guild_id=guild.id, media_guid=session.guid,
-                            title=session.title, media_year=session.year,
-                            media_length=round(session.duration / 1000),
-                            media_type=session.type, library_id=session.librarySectionID or -1)
+        def store_media():
             media_entry = media_table.get_row(media_guid=session.guid, guild_id=guild.id)
-
-        if session.type == "episode":
-            parent_show = media_table.get_row(title=session.grandparentTitle, guild_id=guild.id,
-                                              media_type="show")
-            if not parent_show:
-                media_table.add(guild_id=guild.id, media_guid=session.grandparentGuid,
-                                title=session.grandparentTitle, media_year=session.show().year,
-                                media_length=round(get_series_duration(session.show()) / 1000),
-                                media_type="show", library_id=session.librarySectionID)
+            if not media_entry:  # If no media entry exists with this guid, fallback to the media name
+                logging.debug(f"Could not find GUID {session.guid} in database, falling back to media name")
+                if session.type == "episode":
+                    media_entry = media_table.get_row(title=session.grandparentTitle, season_num=session.parentIndex,
+                                                      ep_num=session.index, guild_id=guild.id)
+                else:
+                    media_entry = media_table.get_row(title=session.title, media_year=session.year,
+                                                      media_type=session.type, guild_id=guild.id)
+            if not media_entry:  # If no media entry exists at all, insert a new one
+                logging.debug(f"Could not find media entry for {session.title} in database, creating new entry")
+                media_table.add(guild_id=guild.id, media_guid=session.guid,
+                                title=session.title, media_year=session.year,
+                                media_length=round(session.duration / 1000),
+                                media_type=session.type, library_id=session.librarySectionID or -1,
+                                rating_key=session.ratingKey)
+                media_entry = media_table.get_row(media_guid=session.guid, guild_id=guild.id)
+            elif media_entry["rating_key"] != session.ratingKey:
+                media_entry.set(rating_key=session.ratingKey)
+            parent_show = None
+            if session.type == "episode":
                 parent_show = media_table.get_row(title=session.grandparentTitle, guild_id=guild.id,
                                                   media_type="show")
-            media_entry.set(season_num=session.parentIndex, ep_num=session.index, show_id=parent_show["media_id"])
-
-        event_table = self.bot.database.get_table("plex_history_events")
-        entry = event_table.add(event_id=m_hash, guild_id=guild.id,
-                                history_time=datetime.datetime.now().timestamp(),
-                                account_id=account_id, media_id=media_entry["media_id"],
-                                pb_start_offset=raw_start_position,
-                                pb_end_offset=raw_current_position,
-                                session_duration=alive_time.seconds * 1000,
-                                device_id=watcher.device_id,
-                                watch_time=round(watch_time * 1000))
-
-
-        msg = await channel.send(embed=embed, view=view)
-
-        msg_table = self.bot.database.get_table("plex_history_messages")
-        msg_table.add(guild_id=msg.guild.id, message_id=msg.id, event_id=entry["event_id"])
+                if parent_show and parent_show["rating_key"] != session.grandparentRatingKey:
+                    parent_show.set(rating_key=session.grandparentRatingKey)
+            return media_entry, parent_show
+
+        def store_show(show, series_duration):
+            media_table.add(guild_id=guild.id, media_guid=session.grandparentGuid,
+                            title=session.grandparentTitle, media_year=show.year,
+                            media_length=round(series_duration / 1000),
+                            media_type="show", library_id=session.librarySectionID or -1,
+                            rating_key=session.grandparentRatingKey)
+            return media_table.get_row(title=session.grandparentTitle, guild_id=guild.id, media_type="show")
+
+        # The database work runs on the gateway's writer, only the show lookup has to go to Plex in between
+        media_entry, parent_show = await self.bot.db.call(store_media)
+        if session.type == "episode":
+            if not parent_show:
+                show = await plex.aio.run(session.show)
+                series_duration = await plex.aio.run(get_series_duration, show)
+                parent_show = await self.bot.db.call(store_show, show, series_duration)
+            await self.bot.db.call(media_entry.set, season_num=session.parentIndex, ep_num=session.index,
+                                   show_id=parent_show["media_id"])
+
+        # The event and its message are queued together, the outbox sends the message and records its ID
+        await self.bot.db.transaction([
+            ("INSERT INTO plex_history_events (event_id, guild_id, history_time, account_id, media_id, "
+             "pb_start_offset, pb_end_offset, session_duration, device_id, watch_time) "
+             "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+             (m_hash, guild.id, datetime.datetime.now().timestamp(), account_id, media_entry["media_id"],
+              raw_start_position, raw_current_position, alive_time.seconds * 1000, watcher.device_id,
+              round(watch_time * 1000))),
+            HistoryOutbox.enqueue_statement(guild.id, channel.id, m_hash, embed)])
+        self.outbox.wake()
 
     @commands.command(name="watched_together", aliases=["wt"])
     async def watched_together(self, ctx, message_id: int):
@@ -407,47 +412,48 @@ class PlexHistory(commands.Cog):
         try:
             msg_table = self.bot.database.get_table("plex_history_messages")
             event_table = self.bot.database.get_table("plex_history_events")
-            msg_entry = msg_table.get_row(message_id=message_id)
+            media_table = self.bot.database.get_table("plex_watched_media")
+            msg_entry = await self.bot.db.call(msg_table.get_row, message_id=message_id)
             # The watcher is the person who sent the message
             watch_user = ctx.plex.associations.get(ctx.author.id)
             if not msg_entry:
                 return await ctx.send("Could not find a message with that ID")
-            event_entry = event_table.get_row(event_id=msg_entry["event_id"])
+            event_entry = await self.bot.db.call(event_table.get_row, event_id=msg_entry["event_id"])
             if not event_entry:
                 return await ctx.send("Could not find an event with that ID")
             if not watch_user:
                 return await ctx.send("You are not associated with a Plex account")
             origin_user = ctx.plex.associations.get(event_entry["account_id"])
             try:
-                new_entry = event_table.add(event_id=event_entry["event_id"] + watch_user.account_id,
-                                            guild_id=ctx.guild.id,
-                                            history_time=event_entry["history_time"] + 1,
-                                            account_id=watch_user.account_id, media_id=event_entry["media_id"],
-                                            pb_start_offset=event_entry["pb_start_offset"],
-                                            pb_end_offset=event_entry["pb_end_offset"],
-                                            session_duration=event_entry["session_duration"],
-                                            device_id=event_entry["device_id"],
-                                            watch_time=event_entry["watch_time"])
+                new_entry = await self.bot.db.call(event_table.add,
+                                                   event_id=event_entry["event_id"] + watch_user.account_id,
+                                                   guild_id=ctx.guild.id,
+                                                   history_time=event_entry["history_time"] + 1,
+                                                   account_id=watch_user.account_id, media_id=event_entry["media_id"],
+                                                   pb_start_offset=event_entry["pb_start_offset"],
+                                                   pb_end_offset=event_entry["pb_end_offset"],
+                                                   session_duration=event_entry["session_duration"],
+                                                   device_id=event_entry["device_id"],
+                                                   watch_time=event_entry["watch_time"])
             except ValueError:
                 return await ctx.send("You have already created a watched together event for this message")
             # Create a new message with the same data
-            history_channel_id = self.bot.database.get_table(
-                "plex_history_channel").get_row(guild_id=ctx.guild.id)["channel_id"]
+            history_channel_id = (await self.bot.db.read_one(
+                "SELECT channel_id FROM plex_history_channel WHERE guild_id = ?", (ctx.guild.id,)))[0]
             history_channel = self.bot.get_channel(history_channel_id)
             if not history_channel:
                 return await ctx.send("Could not find the history channel")
             original_msg = await history_channel.fetch_message(message_id)
-            devices = ctx.plex.systemDevices()
+            devices = await ctx.plex.aio.systemDevices()
             watcher = [device for device in devices if device.clientIdentifier == event_entry["device_id"]][0]
-            media = self.bot.database.get_table("plex_watched_media").get_row(media_id=event_entry["media_id"])
+            media = await self.bot.db.call(media_table.get_row, media_id=event_entry["media_id"])
             length = datetime.timedelta(seconds=media["media_length"])
 
             text = f"{watch_user.mention()} watched this with {origin_user.mention()} on `{watcher.name}`\n" \
                    f"They watched `{length}` of `{length}`"
             embed = discord.Embed(description=text, color=discord.Color.blue())
             if media["media_type"] == "episode":
-                show = self.bot.database.get_table("plex_watched_media").get_row(
-                    media_id=media["show_id"], guild_id=ctx.guild.id)
+                show = await self.bot.db.call(media_table.get_row, media_id=media["show_id"], guild_id=ctx.guild.id)
                 embed.set_author(name=f"{show['title']} - S{media['season_num']}E{media['ep_num']}",
                                  icon_url=watch_user.avatar_url())
                 embed.title = f"{media['title']}"
@@ -468,8 +474,8 @@ class PlexHistory(commands.Cog):
             view = self.HistoryOptions()
             # embed.set_footer(text="This session was added manually")
             msg = await history_channel.send(embed=embed, view=view, reference=original_msg.to_reference())
-            msg_table.add(guild_id=ctx.guild.id, message_id=msg.id,
-                          event_id=event_entry["event_id"] + watch_user.account_id)
+            await self.bot.db.call(msg_table.add, guild_id=ctx.guild.id, message_id=msg.id,
+                                   event_id=event_entry["event_id"] + watch_user.account_id)
 
         except Exception as e:
             logging.exception(e)
@@ -480,10 +486,11 @@ class PlexHistory(commands.Cog):
     @commands.command(name="manual_history", aliases=["add_event"],
                       description="Manually add a history entry if it was missed")
     async def manual_history(self, ctx, user_id: int, media_id, device_name=None):
-        history_channel_id = self.bot.database.get_table(
-            "plex_history_channel").get_row(guild_id=ctx.guild.id)["channel_id"]
+        history_channel_id = (await self.bot.db.read_one(
+            "SELECT channel_id FROM plex_history_channel WHERE guild_id = ?", (ctx.guild.id,)))[0]
         history_channel = self.bot.get_channel(history_channel_id)
-        media = self.bot.database.get_table("plex_watched_media").get_row(media_id=media_id, guild_id=ctx.guild.id)
+        media_table = self.bot.database.get_table("plex_watched_media")
+        media = await self.bot.db.call(media_table.get_row, media_id=media_id, guild_id=ctx.guild.id)
         if not media:
             await ctx.send("Could not find media with that ID")
             return
@@ -497,20 +504,19 @@ class PlexHistory(commands.Cog):
         # Assume the user watched the whole thing and that the session was alive for the same amount of time
         event_table = self.bot.database.get_table("plex_history_events")
         message_table = self.bot.database.get_table("plex_history_messages")
-        event_table.add(event_id=media_hash, guild_id=ctx.guild.id,
-                        history_time=datetime.datetime.now().timestamp(),
-                        account_id=plex_user.id(plex_only=True), media_id=media["media_id"],
-                        pb_start_offset=0, pb_end_offset=media["media_length"] * 1000,
-                        session_duration=media["media_length"] * 1000,
-                        watch_time=media["media_length"] * 1000)
+        await self.bot.db.call(event_table.add, event_id=media_hash, guild_id=ctx.guild.id,
+                               history_time=datetime.datetime.now().timestamp(),
+                               account_id=plex_user.id(plex_only=True), media_id=media["media_id"],
+                               pb_start_offset=0, pb_end_offset=media["media_length"] * 1000,
+                               session_duration=media["media_length"] * 1000,
+                               watch_time=media["media_length"] * 1000)
 
         length = datetime.timedelta(seconds=media["media_length"])
         text = f"{plex_user.mention()} watched this with `Unknown` on `Unknown`\n" \
                f"They watched `{length}` of `{length}`"
         embed = discord.Embed(description=text, color=discord.Color.yellow())
         if media["media_type"] == "episode":
-            show = self.bot.database.get_table("plex_watched_media").get_row(
-                media_id=media["show_id"], guild_id=ctx.guild.id)
+            show = await self.bot.db.call(media_table.get_row, media_id=media["show_id"], guild_id=ctx.guild.id)
             embed.set_author(name=f"{show['title']} - S{media['season_num']}E{media['ep_num']}",
                              icon_url=plex_user.avatar_url())
             embed.title = f"{media['title']}"
@@ -527,15 +533,14 @@ class PlexHistory(commands.Cog):
         view = self.HistoryOptions()
         embed.set_footer(text="This session was added manually")
         msg = await history_channel.send(embed=embed, view=view)
-        message_table.add(guild_id=ctx.guild.id, message_id=msg.id, event_id=media_hash)
+        await self.bot.db.call(message_table.add, guild_id=ctx.guild.id, message_id=msg.id, event_id=media_hash)
         await ctx.send("Added history entry")
 
     @has_permissions(administrator=True)
     @command(name="set_history_channel", aliases=["shc"])
     async def set_history_channel(self, ctx, channel: discord.TextChannel):
-        cursor = self.bot.database.execute(
+        await self.bot.db.write(
             '''INSERT OR REPLACE INTO plex_history_channel VALUES (?, ?)''', (ctx.guild.id, channel.id))
-        self.bot.database.commit()
         await ctx.send(f"Set history channel to {channel.mention}")
 
     @has_permissions(administrator=True)
@@ -544,8 +549,8 @@ class PlexHistory(commands.Cog):
         """
         Updates the components on history messages to the new HistoryOptions view
         """
-        table = self.bot.database.get_table("plex_history_messages")
-        channel = self.bot.database.get_table("plex_history_channel").get_row(guild_id=ctx.guild.id)["channel_id"]
+        channel = (await self.bot.db.read_one(
+            "SELECT channel_id FROM plex_history_channel WHERE guild_id = ?", (ctx.guild.id,)))[0]
         message_cache = {}
         await ctx.send(f"Fetching messages from {ctx.guild.get_channel(channel).mention}")
         async for message in ctx.guild.get_channel(channel).history(limit=None):
@@ -555,9 +560,9 @@ class PlexHistory(commands.Cog):
         estimated_time = len(message_cache) * 7.5 / 60  # 0.5 seconds per message
         await ctx.send(f"Updating {len(message_cache)} messages, "
                        f"this will take about {round(estimated_time, 2)} minutes")
-        for entry in table.get_all(reverse=True):
-            if entry["message_id"] in message_cache:
-                message = message_cache[entry["message_id"]]
+        for (message_id,) in await self.bot.db.read("SELECT message_id FROM plex_history_messages ORDER BY rowid DESC"):
+            if message_id in message_cache:
+                message = message_cache[message_id]
                 # Check if the message's buttons have the right custom_id
                 if len(message.components) > 0:
                     if message.components[0].children[2].custom_id == "addrating":
@@ -573,33 +578,136 @@ class PlexHistory(commands.Cog):
         """
         Refreshes the media length attribute on entries in the plex_watched_media table
         """
-        table = self.bot.database.get_table("plex_watched_media")
+        rows = await self.bot.db.read("SELECT media_id, library_id, media_guid, title FROM plex_watched_media "
+                                      "WHERE media_type = 'show' AND library_id IS NOT NULL AND library_id != -1")
 
         def refresh():
-            for entry in table.select(where="media_type= 'show'"):
+            updates = []  # (media_length, media_id)
+            for media_id, library_id, media_guid, title in rows:
                 try:
-                    library = ctx.plex.library.sectionByID(int(entry["library_id"]))
-                    show = library.getGuid(entry["media_guid"])
-                    entry.set(media_length=round(get_series_duration(show) / 1000))
+                    library = ctx.plex.library.sectionByID(int(library_id))
+                    show = library.getGuid(media_guid)
+                    updates.append((round(get_series_duration(show) / 1000), media_id))
                 except plexapi.exceptions.NotFound:
-                    library = ctx.plex.library.sectionByID(int(entry["library_id"]))
-                    show = get_show(library, entry["title"])
+                    library = ctx.plex.library.sectionByID(int(library_id))
+                    show = get_show(library, title)
                     if show is None:
                         continue
-                    entry.set(media_length=round(get_series_duration(show) / 1000))
+                    updates.append((round(get_series_duration(show) / 1000), media_id))
+            return updates
 
         async with ctx.typing():
-            await self.bot.loop.run_in_executor(None, refresh)
+            # Plex is walked on the heavy executor, the results are written by the gateway's writer in one go
+            updates = await ctx.plex.aio.run_heavy(refresh)
+            if updates:
+                await self.bot.db.transaction([("UPDATE plex_watched_media SET media_length = ? WHERE media_id = ?",
+                                                update) for update in updates])
 
         await ctx.send("Refreshed metadata")
 
+    @has_permissions(administrator=True)
+    @command(name="backfill_rating_keys", aliases=["brk"])
+    async def backfill_rating_keys(self, ctx):
+        """
+        Looks up the Plex rating key of every watched media entry that doesn't have one yet
+        """
+        rows = await self.bot.db.read(
+            "SELECT media_id, media_type, library_id, media_guid, show_id, season_num, ep_num "
+            "FROM plex_watched_media WHERE guild_id = ? AND rating_key IS NULL AND library_id IS NOT NULL "
+            "AND library_id != -1 AND library_id != 'N/A' AND media_guid != 'N/A'", (ctx.guild.id,))
+        # The shows the episodes belong to, whether or not they still need a rating key themselves
+        show_rows = {media_id: (library_id, media_guid) for media_id, library_id, media_guid in await self.bot.db.read(
+            "SELECT media_id, library_id, media_guid FROM plex_watched_media "
+            "WHERE guild_id = ? AND media_type = 'show' AND library_id IS NOT NULL AND library_id != -1",
+            (ctx.guild.id,))}
+
+        def backfill():
+            found, missing = 0, 0
+            updates = []  # (rating_key, media_id)
+            shows = {}  # media_id -> show
+            episodes = {}  # media_id of the show -> {(season, episode): rating key}, listed once per show
+            # Shows first so the episodes can be found in them
+            for media_id, media_type, library_id, media_guid, show_id, season_num, ep_num in \
+                    sorted(rows, key=lambda row: row[1] != "show"):
+                try:
+                    if media_type == "episode":
+                        show = shows.get(show_id)
+                        if show is None:
+                            show_row = show_rows.get(show_id)
+                            if show_row is None:
+                                missing += 1
+                                continue
+                            library = ctx.plex.library.sectionByID(int(show_row[0]))
+                            show = shows[show_id] = get_from_guid(library, show_row[1])
+                        if show is None:
+                            missing += 1
+                            continue
+                        if show_id not in episodes:
+                            episodes[show_id] = {(episode.parentIndex, episode.index): episode.ratingKey
+                                                 for episode in show.episodes()}
+                        rating_key = episodes[show_id].get((int(season_num), int(ep_num)))
+                        if rating_key is None:
+                            missing += 1
+                            continue
+                        updates.append((rating_key, media_id))
+                        found += 1
+                        continue
+                    else:
+                        library = ctx.plex.library.sectionByID(int(library_id))
+                        media = get_from_guid(library, media_guid)
+                        if media is not None and media.type == "show":
+                            shows[media_id] = media
+                    if media is None:
+                        missing += 1
+                        continue
+                    updates.append((media.ratingKey, media_id))
+                    found += 1
+                except (plexapi.exceptions.NotFound, ValueError, TypeError):
+                    missing += 1
+            return found, missing, updates
+
+        async with ctx.typing():
+            found, missing, updates = await ctx.plex.aio.run_heavy(backfill)
+            if updates:
+                await self.bot.db.transaction([("UPDATE plex_watched_media SET rating_key = ? WHERE media_id = ?",
+                                                update) for update in updates])
+
+        await ctx.send(f"Stored rating keys for {found} entries, {missing} could not be found on Plex")
+
+    @has_permissions(administrator=True)
+    @command(name="history_outbox", aliases=["hob"])
+    async def history_outbox(self, ctx, action: str = None):
+        """
+        Shows the history messages waiting to be sent, use `retry` to requeue the ones that were given up on
+        """
+        if action == "retry":
+            await self.bot.db.write("UPDATE plex_history_outbox SET attempts = 0, next_attempt = ? "
+                                    "WHERE guild_id = ? AND next_attempt IS NULL",
+                                    (datetime.datetime.now().timestamp(), ctx.guild.id))
+            self.outbox.wake()
+        pending, failed = await self.bot.db.read_one(
+            "SELECT COUNT(next_attempt), COUNT(*) - COUNT(next_attempt) FROM plex_history_outbox WHERE guild_id = ?",
+            (ctx.guild.id,))
+        stats = self.outbox.stats()
+        embed = discord.Embed(title="History Outbox",
+                              description=f"Waiting: `{pending}` Given up on: `{failed}`\n"
+                                          f"Delivered: `{stats['delivered']}` Retried: `{stats['retried']}`\n"
+                                          f"Channels backing off: `{stats['blocked_channels']}`",
+                              color=0x00ff00)
+        errors = await self.bot.db.read("SELECT outbox_id, last_error FROM plex_history_outbox "
+                                        "WHERE guild_id = ? AND last_error IS NOT NULL ORDER BY outbox_id DESC "
+                                        "LIMIT 5", (ctx.guild.id,))
+        if errors:
+            embed.add_field(name="Recent errors", value="\n".join(f"`{outbox_id}` {error[:150]}"
+                                                                   for outbox_id, error in errors), inline=False)
+        await ctx.send(embed=embed)
+
     @has_permissions(administrator=True)
     @command(name="clean_history", aliases=["ch"])
     async def clean_history(self, ctx):
         """Check for any unmatched history messages and remove them from the database"""
-        message_table = self.bot.database.get_table("plex_history_messages")
-        history_table = self.bot.database.get_table("plex_history_events")
-        channel = self.bot.database.get_table("plex_history_channel").get_row(guild_id=ctx.guild.id)["channel_id"]
+        channel = (await self.bot.db.read_one(
+            "SELECT channel_id FROM plex_history_channel WHERE guild_id = ?", (ctx.guild.id,)))[0]
         message_cache = {}
         msg = await ctx.send(f"Fetching messages from {ctx.guild.get_channel(channel).mention}")
         async for message in ctx.guild.get_channel(channel).history(limit=None):
@@ -609,17 +717,23 @@ class PlexHistory(commands.Cog):
         await msg.edit(content=f"Checking {len(message_cache)} messages")
         # Check if any messages are in the database but not in the channel
         removed = 0
-        for entry in message_table.get_all():
-            if entry["message_id"] not in message_cache:
-                # Get the watch event
-                watch_event = history_table.get_row(event_id=entry["event_id"])
-                if watch_event is not None:
-                    logging.info(f"Removing {entry['message_id']}-({watch_event['event_id']}) from database")
-                    watch_event.delete()
+        statements = []
+        rows = await self.bot.db.read("SELECT messages.message_id, events.event_id FROM plex_history_messages AS "
+                                      "messages LEFT JOIN plex_history_events AS events "
+                                      "ON events.event_id = messages.event_id WHERE messages.guild_id = ?",
+                                      (ctx.guild.id,))
+        for message_id, event_id in rows:
+            if message_id not in message_cache:
+                # Remove the watch event along with the message
+                if event_id is not None:
+                    logging.info(f"Removing {message_id}-({event_id}) from database")
+                    statements.append(("DELETE FROM plex_history_events WHERE event_id = ?", (event_id,)))
                 else:
-                    logging.info(f"Removing only message {entry['message_id']} from database")
-                message_table.delete(message_id=entry["message_id"])
+                    logging.info(f"Removing only message {message_id} from database")
+                statements.append(("DELETE FROM plex_history_messages WHERE message_id = ?", (message_id,)))
                 removed += 1
+        if statements:
+            await self.bot.db.transaction(statements)
         await ctx.send(f"Removed {removed} unmatched watch logs from the database")
 
 
@@ -30,7 +30,7 @@ class PlexSearch(commands.Cog):
     @command(name="actor_search", aliases=["actor_info", "as"], brief="Search for an actor")
     async def actor_search(self, ctx, *, query: str):
         plex = ctx.plex
-        results = plex.search(query, mediatype="actor")
+        results = await plex.aio.search(query, mediatype="actor")
         if len(results) == 0:
             await ctx.send("No results found")
             return
@@ -40,7 +40,7 @@ class PlexSearch(commands.Cog):
     async def episode_search(self, ctx, *, query: str):
         """Search for an episode"""
         plex = ctx.plex
-        results = plex.search(query)
+        results = await plex.aio.search(query)
 
         # Remove anything that doesn't have a plexapi.video.Video base class
         results = [r for r in results if isinstance(r, plexapi.video.Video)]
@@ -55,7 +55,7 @@ class PlexSearch(commands.Cog):
         Searches Plex for a specific content.
         """
         plex = ctx.plex
-        results = plex.search(query)
+        results = await plex.aio.search(query)
 
         # Remove anything that doesn't have a plexapi.video.Video base class
         results = [r for r in results if isinstance(r, plexapi.video.Video)]
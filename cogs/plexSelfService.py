@@ -207,7 +207,7 @@ class PlexSelfService(Cog):
     async def find_potential_duplicates(self, plex, torrent_entry):
         # Search for the torrent title in the Plex library and return any potential matches
         logging.info(f"Searching for potential duplicates for `{torrent_entry.title}`")
-        results = plex.search(torrent_entry.title)
+        results = await plex.aio.search(torrent_entry.title)
         # Filter the results to only include movies or shows depending on the category of the torrent
         if type(torrent_entry) == MovieRelease:
             results = [r for r in results if r.type == "movie"]
@@ -352,7 +352,7 @@ class PlexSelfService(Cog):
             else:
                 raise ValueError("Invalid release entry type")
 
-            library = plex.library.section(target_library)
+            library = await plex.aio.section(target_library)
 
             embed = discord.Embed(title="Adding Torrent...",
                                   description=f"Adding `{release_entry.original_text}` to the `{target_library}` library.",
@@ -9,7 +9,7 @@ from discord.ext import commands
 
 from wrappers_utils.SessionChangeWatchers import SessionWatcher, SessionChangeWatcher
 from utils import base_info_layer, get_season, get_episode, cleanup_url, text_progress_bar_maker, stringify, \
-    base_user_layer, get_all_library, get_watch_time, get_session_count
+    base_user_layer, get_watch_time, get_session_count
 
 from loguru import logger as logging
 
@@ -18,7 +18,6 @@ class PlexStatistics(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.history_table = self.bot.database.get_table("plex_history_messages")
 
     @commands.hybrid_command(name="library_stats", description="Get library statics")
     async def library_stats(self, ctx, *, library_name):
@@ -29,7 +28,7 @@ class PlexStatistics(commands.Cog):
 
         # Send a typing indicator
         async with ctx.typing():
-            libraries = get_all_library(ctx.plex)
+            libraries = await ctx.plex.aio.sections()
             for library in libraries:
                 if library.title.lower() == library_name.lower():
                     library = library
@@ -38,34 +37,18 @@ class PlexStatistics(commands.Cog):
                 await ctx.send("Could not find library with that name.")
                 return
 
-            def get_library():
-                content = library.all()
-                media_length = round(library.totalDuration / 1000)
-                top_media_count = library.totalSize
-                # Because TV shows only count as one item, we need to get the total number of episodes for
-                # the total number of episodes
-                media_count = 0
-                for item in content:
-                    if isinstance(item, plexapi.video.Show):
-                        media_count += len(item.episodes())
-                    else:
-                        media_count += 1
-                media_size = library.totalStorage
-                return content, media_length, top_media_count, media_count, media_size
-
-            library_content, total_media_length, top_level_media_count, total_media_count, total_media_size \
-                = await self.bot.loop.run_in_executor(None, get_library)  # Run in executor to prevent blocking
+            # Counted from Plex's totals and cached until the library changes, shows are only one item each so
+            # the episode count is taken separately
+            census = await ctx.plex.aio.run(ctx.plex.library_census.count, library)
+            total_media_length = round(census.duration / 1000)
+            top_level_media_count = census.top_level_count
+            total_media_count = census.leaf_count
+            total_media_size = census.storage
 
             # Get the total watch time for the library
-            watch_time = self.bot.database.get("SELECT SUM(watch_time) FROM plex_history_events WHERE media_id IN "
-                                               f"(SELECT media_id FROM plex_watched_media WHERE"
-                                               f" library_id = {library.key})")[0][0]
-            session_count = self.bot.database.get("SELECT COUNT(*) FROM plex_history_events WHERE media_id IN "
-                                                  f"(SELECT media_id FROM plex_watched_media WHERE"
-                                                  f" library_id = {library.key})")[0][0]
-
-            if watch_time is None:
-                watch_time = 0
+            totals = await self.bot.db.read_one("SELECT watch_time, sessions FROM plex_rollup_library "
+                                                "WHERE library_id = ?", (str(library.key),))
+            watch_time, session_count = totals if totals else (0, 0)
 
             embed = discord.Embed(title=f"Library Statistics for {library.title}",
                                   description=f"Media Length: "
@@ -77,7 +60,7 @@ class PlexStatistics(commands.Cog):
                                               f"Media Size: `{humanize.naturalsize(total_media_size)}`",
                                   color=0x00ff00)
             if library.type == "show":
-                most_popular = self.bot.database.get("""
+                most_popular = await self.bot.db.read_stats("""
                 SELECT show.title, show.media_guid,
                 SUM(DISTINCT events.watch_time) / 1000 AS total_watch_time,
                 show.media_length AS length,
@@ -90,7 +73,7 @@ class PlexStatistics(commands.Cog):
                 GROUP BY show.media_id
                 ORDER BY (total_watch_time * 1000 / length) DESC LIMIT 15""", (library.key,))
             else:
-                most_popular = self.bot.database.get("""
+                most_popular = await self.bot.db.read_stats("""
                 SELECT media.title, media.media_guid,
                 SUM(events.watch_time) / 1000 AS total_watch_time,
                 media.media_length AS length
@@ -132,7 +115,7 @@ class PlexStatistics(commands.Cog):
             # print(user)
             # Get the user's watch history
             # print(user.account_id)
-            watch_history_movies = self.bot.database.get(f"""
+            watch_history_movies = await self.bot.db.read_stats(f"""
             SELECT media.title, media.media_guid,
             SUM(events.watch_time) / 1000 AS total_watch_time,
             media.media_length AS length
@@ -141,7 +124,7 @@ class PlexStatistics(commands.Cog):
             WHERE events.account_id = ? AND media.media_type = 'movie'
             GROUP BY media.media_id ORDER BY (total_watch_time * 1000 / length) DESC LIMIT 15;""", (user.account_id,))
 
-            watch_history_shows = self.bot.database.get(f"""
+            watch_history_shows = await self.bot.db.read_stats(f"""
             SELECT show.title, show.media_guid,
             SUM(DISTINCT events.watch_time) / 1000 AS total_watch_time, 
             show.media_length AS length,
@@ -160,20 +143,24 @@ class PlexStatistics(commands.Cog):
             # print(watch_history)
             watch_history = watch_history[:15]
 
-            server_sessions = self.bot.database.get("""SELECT COUNT(*) FROM plex_history_events""")[0][0]
-            session_percentage = round((len(user.sessions) / server_sessions) * 100, 2)
+            server_sessions, server_watch_time = await self.bot.db.read_one(
+                """SELECT SUM(sessions), SUM(watch_time) FROM plex_rollup_user""")
+            user_totals = await self.bot.db.read_one(
+                """SELECT sessions, watch_time FROM plex_rollup_user WHERE account_id = ?""", (user.account_id,))
+            session_count, user_watch_time = user_totals if user_totals else (0, 0)
+            session_percentage = round((session_count / server_sessions) * 100, 2)
+            media_count = (await self.bot.db.read_one(
+                """SELECT COUNT(DISTINCT media_id) FROM plex_history_events WHERE account_id = ?""",
+                (user.account_id,)))[0]
 
-            server_watch_time = self.bot.database.get("""SELECT SUM(watch_time) FROM plex_history_events""")[0][0]
-            user_watch_time = self.bot.database.get(
-                """SELECT SUM(watch_time) FROM plex_history_events WHERE account_id = ?""", (user.account_id,))[0][0]
             watch_time_percentage = round((user_watch_time / server_watch_time) * 100, 2)
 
             embed = discord.Embed(title=f"Watch Percentages for {user.display_name()}",
                                   description=f"Total Watch Time: "
-                                              f"`{datetime.timedelta(seconds=round(user.total_watch_time / 1000))} | "
+                                              f"`{datetime.timedelta(seconds=round(user_watch_time / 1000))} | "
                                               f"{watch_time_percentage}%`\n"
-                                              f"Session Count: `{len(user.sessions)} | {session_percentage}%`\n"
-                                              f"Media Count: `{user.unique_media_count}`", color=0x00ff00)
+                                              f"Session Count: `{session_count} | {session_percentage}%`\n"
+                                              f"Media Count: `{media_count}`", color=0x00ff00)
 
             embed.add_field(name="Top Media Elements",
                             value="\n".join([f"`{str(i + 1).zfill(2)}. "
@@ -193,7 +180,7 @@ class PlexStatistics(commands.Cog):
     async def who_watched(self, ctx, *, media_name):
         # Preform a search for the media
         async with ctx.typing():
-            search_results = ctx.plex.search(media_name)
+            search_results = await ctx.plex.aio.search(media_name)
             # Get the media object
             search_results = [r for r in search_results if isinstance(r, plexapi.video.Video)]
 
@@ -204,30 +191,32 @@ class PlexStatistics(commands.Cog):
                                   color=0x00ff00)
             for plex_media in search_results:
                 # Get the media history
-                media = self.bot.database.get_table("plex_watched_media").get_row(media_guid=plex_media.guid)
+                media = await self.bot.db.read_one("SELECT media_id, media_type FROM plex_watched_media "
+                                                   "WHERE media_guid = ?", (plex_media.guid,))
                 if media is None:
                     embed.add_field(name=f"Who Watched \"{plex_media.title}\" ({plex_media.year})",
                                     value="No one has watched this media yet.", inline=False)
                     continue
-                if media["media_type"] == "show":
-                    results = self.bot.database.get("""
+                media_id, media_type = media
+                if media_type == "show":
+                    results = await self.bot.db.read_stats("""
                     SELECT events.account_id,
                         SUM(events.watch_time) / 1000 AS total_watch_time,
                         COUNT(events.watch_time) AS total_watches
                     FROM plex_history_events AS events
                     JOIN plex_watched_media AS media ON media.media_id = events.media_id
                     WHERE media.media_type = 'episode' AND media.show_id = ?
-                    GROUP BY events.account_id ORDER BY total_watch_time DESC""", (media["media_id"],))
+                    GROUP BY events.account_id ORDER BY total_watch_time DESC""", (media_id,))
 
                 else:
-                    results = self.bot.database.get("""
+                    results = await self.bot.db.read_stats("""
                     SELECT events.account_id,
                         SUM(events.watch_time) / 1000 AS total_watch_time,
                         COUNT(events.watch_time) AS total_watches
                     FROM plex_history_events AS events
                     JOIN plex_watched_media AS media ON media.media_id = events.media_id
                     WHERE media.media_type = 'movie' AND media.media_id = ?
-                    GROUP BY events.account_id ORDER BY total_watch_time DESC""", (media["media_id"],))
+                    GROUP BY events.account_id ORDER BY total_watch_time DESC""", (media_id,))
 
                 if len(results) == 0:
                     embed.description = "No one has watched this media."
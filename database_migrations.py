@@ -1,10 +1,90 @@
 import os
+import re
 import sqlite3
 
 from loguru import logger as logging
 
 from ConcurrentDatabase.Database import CreateTableLink
 
+# The queries the stats commands and history lookups run most, each of them must be answered from an index.
+# Parameters are placeholders, only the shape of the query matters to the planner.
+HOT_QUERIES = [
+    ("SELECT sessions, session_duration, watch_time FROM plex_rollup_user WHERE account_id = ?", (0,)),
+    ("SELECT COUNT(DISTINCT media_id) FROM plex_history_events WHERE account_id = ?", (0,)),
+    ("SELECT events.history_time, media.title, show.title FROM plex_history_events AS events "
+     "JOIN plex_watched_media AS media ON media.media_id = events.media_id "
+     "LEFT JOIN plex_watched_media AS show ON show.media_id = media.show_id "
+     "WHERE events.account_id = ? ORDER BY events.history_time DESC LIMIT 6", (0,)),
+    ("SELECT SUM(watch_time) FROM plex_history_events WHERE account_id = ? AND device_id = ?", (0, "")),
+    ("SELECT watch_time, sessions FROM plex_rollup_media WHERE media_id = ?", (0,)),
+    ("SELECT SUM(watch_time), SUM(sessions) FROM plex_rollup_show WHERE show_id = ?", (0,)),
+    ("SELECT watch_time FROM plex_rollup_show WHERE show_id = ? AND season_num = ?", (0, 0)),
+    ("SELECT watch_time, sessions FROM plex_rollup_library WHERE library_id = ?", ("",)),
+    ("SELECT * FROM plex_watched_media WHERE media_guid = ? AND media_type = ?", ("", "")),
+    ("SELECT * FROM plex_watched_media WHERE media_guid = ? AND guild_id = ?", ("", 0)),
+    ("SELECT * FROM plex_watched_media WHERE title = ? AND guild_id = ? AND media_type = ?", ("", 0, "")),
+    ("SELECT events.account_id, SUM(events.watch_time) FROM plex_history_events AS events "
+     "JOIN plex_watched_media AS media ON media.media_id = events.media_id "
+     "WHERE media.media_type = 'episode' AND media.show_id = ? GROUP BY events.account_id", (0,)),
+    ("SELECT show.media_id, SUM(events.watch_time) FROM plex_watched_media AS media "
+     "JOIN plex_history_events AS events ON events.media_id = media.media_id "
+     "JOIN plex_watched_media AS show ON show.media_type = 'show' "
+     "WHERE media.media_type = 'episode' AND show.media_id = media.show_id AND show.library_id = ? "
+     "GROUP BY show.media_id", (0,)),
+    ("SELECT media.media_id, SUM(events.watch_time) FROM plex_watched_media AS media "
+     "JOIN plex_history_events AS events ON events.media_id = media.media_id "
+     "WHERE events.account_id = ? AND media.media_type = 'movie' GROUP BY media.media_id", (0,)),
+    ("SELECT outbox_id FROM plex_history_outbox WHERE next_attempt <= ? AND channel_id NOT IN (?) "
+     "ORDER BY +outbox_id LIMIT ?", (0, 0, 50)),
+    ("SELECT MIN(next_attempt) FROM plex_history_outbox WHERE channel_id NOT IN (?)", (0,)),
+]
+
+# A plan step that reads a whole table rather than searching it or an index, e.g. "SCAN plex_history_events"
+_table_scan = re.compile(r"^SCAN (TABLE )?(?P<table>\w+)(?!.*INDEX)")
+
+
+class QueryPlanError(Exception):
+    pass
+
+
+def check_query_plans(database):
+    """Raise QueryPlanError if any of the HOT_QUERIES would be answered with a full table scan"""
+    scans = []
+    for query, parameters in HOT_QUERIES:
+        for row in database.cursor().execute(f"EXPLAIN QUERY PLAN {query}", parameters).fetchall():
+            match = _table_scan.match(row[3])
+            if match:
+                scans.append(f"{match.group('table')} in: {query}")
+    if scans:
+        raise QueryPlanError("Hot queries fall back to a full table scan:\n" + "\n".join(scans))
+
+
+def _rollup_statements(row: str, sign: str) -> str:
+    """The statements that add (sign "+") or remove (sign "-") one history event, row is NEW or OLD, from every
+    rollup table"""
+    sessions = f"{sign}1"
+    watch_time = f"{sign}IFNULL({row}.watch_time, 0)"
+    session_duration = f"{sign}IFNULL({row}.session_duration, 0)"
+    media = f"FROM plex_watched_media WHERE media_id = {row}.media_id"
+    return f"""
+        INSERT INTO plex_rollup_user (account_id, sessions, watch_time, session_duration)
+            VALUES (IFNULL({row}.account_id, -1), {sessions}, {watch_time}, {session_duration})
+            ON CONFLICT (account_id) DO UPDATE SET sessions = sessions + excluded.sessions,
+            watch_time = watch_time + excluded.watch_time,
+            session_duration = session_duration + excluded.session_duration;
+        INSERT INTO plex_rollup_media (media_id, sessions, watch_time)
+            VALUES ({row}.media_id, {sessions}, {watch_time})
+            ON CONFLICT (media_id) DO UPDATE SET sessions = sessions + excluded.sessions,
+            watch_time = watch_time + excluded.watch_time;
+        INSERT INTO plex_rollup_show (show_id, season_num, sessions, watch_time)
+            SELECT show_id, IFNULL(season_num, -1), {sessions}, {watch_time} {media} AND show_id IS NOT NULL
+            ON CONFLICT (show_id, season_num) DO UPDATE SET sessions = sessions + excluded.sessions,
+            watch_time = watch_time + excluded.watch_time;
+        INSERT INTO plex_rollup_library (library_id, sessions, watch_time)
+            SELECT library_id, {sessions}, {watch_time} {media}
+            ON CONFLICT (library_id) DO UPDATE SET sessions = sessions + excluded.sessions,
+            watch_time = watch_time + excluded.watch_time;"""
+
 
 def preform_migrations(database):
     def find_media(title, media_type, season_num, ep_num, media_year):
@@ -127,6 +207,77 @@ def preform_migrations(database):
         ])
         table_version.set(version=1)
 
+    # Store the Plex ratingKey of watched media so it can be fetched directly instead of searched for by guid
+    database.update_table("plex_watched_media", 1,
+                          ["ALTER TABLE plex_watched_media ADD COLUMN rating_key INTEGER DEFAULT NULL"])
+
+    # Indexes for the stats and history lookups, the account index also covers the per user sums and ordering
+    database.update_table("plex_history_events", 2,
+                          ["CREATE INDEX IF NOT EXISTS ix_plex_history_events_account ON plex_history_events "
+                           "(account_id, history_time, media_id, watch_time, session_duration)",
+                           "CREATE INDEX IF NOT EXISTS ix_plex_history_events_media ON plex_history_events "
+                           "(media_id, account_id, watch_time)",
+                           "CREATE INDEX IF NOT EXISTS ix_plex_history_events_device ON plex_history_events "
+                           "(account_id, device_id, watch_time)",
+                           "CREATE INDEX IF NOT EXISTS ix_plex_history_events_time ON plex_history_events "
+                           "(history_time)"])
+    database.update_table("plex_watched_media", 2,
+                          ["CREATE INDEX IF NOT EXISTS ix_plex_watched_media_guid ON plex_watched_media "
+                           "(media_guid, media_type, guild_id)",
+                           "CREATE INDEX IF NOT EXISTS ix_plex_watched_media_show ON plex_watched_media "
+                           "(show_id, season_num, media_type)",
+                           "CREATE INDEX IF NOT EXISTS ix_plex_watched_media_library ON plex_watched_media "
+                           "(library_id, media_type)",
+                           "CREATE INDEX IF NOT EXISTS ix_plex_watched_media_title ON plex_watched_media "
+                           "(title, media_type, guild_id)"])
+
+    # Running totals of plex_history_events per user, media, show season and library. The triggers keep them in
+    # step with every insert, update and delete in the same transaction, so the stats commands read one row
+    # instead of aggregating the whole history. Events with no account are counted under account -1.
+    database.update_table("plex_history_events", 3, [
+        "CREATE TABLE IF NOT EXISTS plex_rollup_user (account_id INTEGER PRIMARY KEY, sessions INTEGER NOT NULL, "
+        "watch_time INTEGER NOT NULL, session_duration INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS plex_rollup_media (media_id INTEGER PRIMARY KEY, sessions INTEGER NOT NULL, "
+        "watch_time INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS plex_rollup_show (show_id INTEGER, season_num INTEGER, "
+        "sessions INTEGER NOT NULL, watch_time INTEGER NOT NULL, PRIMARY KEY (show_id, season_num))",
+        "CREATE TABLE IF NOT EXISTS plex_rollup_library (library_id TEXT PRIMARY KEY, sessions INTEGER NOT NULL, "
+        "watch_time INTEGER NOT NULL)",
+        "INSERT INTO plex_rollup_user SELECT IFNULL(account_id, -1), COUNT(*), IFNULL(SUM(watch_time), 0), "
+        "IFNULL(SUM(session_duration), 0) FROM plex_history_events GROUP BY IFNULL(account_id, -1)",
+        "INSERT INTO plex_rollup_media SELECT media_id, COUNT(*), IFNULL(SUM(watch_time), 0) "
+        "FROM plex_history_events GROUP BY media_id",
+        "INSERT INTO plex_rollup_show SELECT media.show_id, IFNULL(media.season_num, -1), COUNT(*), "
+        "IFNULL(SUM(events.watch_time), 0) FROM plex_history_events AS events "
+        "JOIN plex_watched_media AS media ON media.media_id = events.media_id WHERE media.show_id IS NOT NULL "
+        "GROUP BY media.show_id, IFNULL(media.season_num, -1)",
+        "INSERT INTO plex_rollup_library SELECT media.library_id, COUNT(*), IFNULL(SUM(events.watch_time), 0) "
+        "FROM plex_history_events AS events JOIN plex_watched_media AS media ON media.media_id = events.media_id "
+        "GROUP BY media.library_id",
+        "CREATE TRIGGER IF NOT EXISTS tr_plex_history_events_rollup_insert AFTER INSERT ON plex_history_events "
+        f"BEGIN {_rollup_statements('NEW', '+')} END",
+        "CREATE TRIGGER IF NOT EXISTS tr_plex_history_events_rollup_delete AFTER DELETE ON plex_history_events "
+        f"BEGIN {_rollup_statements('OLD', '-')} END",
+        "CREATE TRIGGER IF NOT EXISTS tr_plex_history_events_rollup_update AFTER UPDATE OF account_id, media_id, "
+        "watch_time, session_duration ON plex_history_events "
+        f"BEGIN {_rollup_statements('OLD', '-')} {_rollup_statements('NEW', '+')} END"])
+
+    # History messages waiting to be sent, written in the same transaction as their event and removed once the
+    # message ID is in plex_history_messages. Rows with no next_attempt have been given up on.
+    database.create_table("plex_history_outbox", {"outbox_id": "INTEGER PRIMARY KEY AUTOINCREMENT",
+                                                  "guild_id": "INTEGER NOT NULL", "channel_id": "INTEGER NOT NULL",
+                                                  "event_id": "INTEGER NOT NULL", "payload": "TEXT NOT NULL",
+                                                  "attempts": "INTEGER NOT NULL", "next_attempt": "FLOAT",
+                                                  "created": "FLOAT", "last_error": "TEXT"})
+    database.update_table("plex_history_outbox", 1,
+                          ["CREATE INDEX IF NOT EXISTS ix_plex_history_outbox_due ON plex_history_outbox "
+                           "(next_attempt)"])
+    try:
+        check_query_plans(database)
+    except QueryPlanError as e:
+        # Slow, not broken, so don't stop the bot starting over it, the maint query_plans command re-runs the check
+        logging.error(str(e))
+
 
     # table_version = database.table_version_table.get_row(table_name="plex_watched_media")
     # if table_version["version"] == 0:  # Set the guild_id from plex_watched_media to be a foreign key to plex_servers
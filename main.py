@@ -11,14 +11,15 @@ from ConcurrentDatabase.Database import Database, CreateTableLink
 
 from discord.ext import commands
 from discord.utils import oauth_url
-from wrappers_utils.PlexServer import PlexServer
+from wrappers_utils.PlexServer import PlexServer, GuildPlexServer
 import discord
 
 import database_migrations
 import utils
-from wrappers_utils.BotExceptions import PlexNotReachable, PlexNotLinked
+from wrappers_utils.BotExceptions import PlexNotReachable, PlexNotLinked, PlexExecutorBusy
+from wrappers_utils.DatabaseGateway import DatabaseGateway
 from wrappers_utils.DiscordAssociations import DiscordAssociations
-from wrappers_utils.PlexContext import PlexContext, plex_servers, discord_associations
+from wrappers_utils.PlexContext import PlexContext, plex_servers, server_pool, discord_associations
 
 activity = PlexServer.activities
 
@@ -31,6 +32,13 @@ class PlexBot(commands.Bot):
         await self.close()
         # self.loop.stop()
 
+    async def close(self):
+        await super().close()
+        # Anything the cogs queued while shutting down still gets written
+        await self.db.close()
+        for server in set(server_pool.values()):
+            server.device_activity.flush()
+
     async def shutdown(self):
         """Shuts down the bot"""
         await self.close()
@@ -41,6 +49,8 @@ class PlexBot(commands.Bot):
         self.database.create_table("plex_servers", {"guild_id": "INTEGER PRIMARY KEY", "server_url": "TEXT",
                                                     "server_token": "TEXT"})
         self.database.update_table("plex_servers", 1, ["""ALTER TABLE plex_servers ADD COLUMN webserver_path TEXT"""])
+        self.database.update_table("plex_servers", 2, ["""ALTER TABLE plex_servers ADD COLUMN poll_min_interval FLOAT""",
+                                                       """ALTER TABLE plex_servers ADD COLUMN poll_max_interval FLOAT"""])
         self.database.create_table("discord_associations", {"guild_id": "INTEGER", "discord_user_id": "INTEGER",
                                                             "plex_id": "INTEGER", "plex_email": "TEXT",
                                                             "plex_username": "TEXT",
@@ -96,6 +106,8 @@ class PlexBot(commands.Bot):
         self.database = Database("plex_bot.db")
         self.backup_database = sqlite3.connect("plex_bot.db.bak")
         self.database_init()
+        # Cogs should await their queries through this rather than using self.database on the event loop
+        self.db = DatabaseGateway(self.database)
         print(self.database.table_links)
         self.session_watchers = []
         # self.database.execute('''CREATE TABLE IF NOT EXISTS bot_config (token TEXT, prefix TEXT)''')
@@ -132,22 +144,40 @@ class PlexBot(commands.Bot):
                 logging.error(f"Failed to load cog {cog}: {e}")
                 logging.exception(e)
 
-    async def fetch_plex(self, guild: discord.Guild, passive=False) -> PlexServer:
+    def connect_plex(self, guild: discord.Guild) -> GuildPlexServer:
+        """Creates the guild's view of its plex server, guilds linked to the same server and token share one
+        connection from the server pool"""
+        guild_id = guild.id
+        server_entry = self.database.get_table("plex_servers").get_row(guild_id=guild_id)
+        if server_entry is None:
+            raise PlexNotLinked()
+        pool_key = (server_entry["server_url"], server_entry["server_token"])
+        server = server_pool.get(pool_key)
+        if server is None:
+            logging.debug(f"Connecting to plex server {server_entry['server_url']} for guild {guild_id}")
+            server = PlexServer(server_entry["server_url"], server_entry["server_token"],
+                                event_loop=self.loop, database=self.database)
+            server_pool[pool_key] = server
+        else:
+            logging.debug(f"Guild {guild_id} is sharing the connection to {server.friendlyName}")
+        # The poller is shared too, if the guilds ask for different limits the shortest one wins
+        for setting in ("poll_min_interval", "poll_max_interval"):
+            configured = server_entry[setting]
+            if configured is not None and (getattr(server, setting) is None or configured < getattr(server, setting)):
+                setattr(server, setting, configured)
+        plex_servers[guild_id] = GuildPlexServer(server, guild, DiscordAssociations(self, guild))
+        server.add_view(plex_servers[guild_id])
+        return plex_servers[guild_id]
+
+    async def fetch_plex(self, guild: discord.Guild, passive=False) -> GuildPlexServer:
         """Allows for getting a plex instance for a guild if ctx is not available"""
         guild_id = guild.id
         if guild_id not in plex_servers:
-            server_entry = self.database.get_table("plex_servers").get_row(guild_id=guild_id)
-            if server_entry is None:
-                logging.warning(f"No plex server found for guild {guild_id}")
-                raise PlexNotLinked()
             try:
-                logging.debug(f"Connecting to plex server {server_entry['server_url']} for guild {guild_id}")
-                plex_servers[guild_id] = PlexServer(server_entry["server_url"], server_entry["server_token"],
-                                                    event_loop=self.loop,
-                                                    discord_associations=DiscordAssociations(self, guild),
-                                                    database=self.database, host_guild=guild)
-                plex_servers[guild_id].baseurl = server_entry["server_url"]
-                plex_servers[guild_id].token = server_entry["server_token"]
+                self.connect_plex(guild)
+            except PlexNotLinked:
+                logging.warning(f"No plex server found for guild {guild_id}")
+                raise
             except Exception as e:
                 logging.error(f"Failed to connect to plex server for guild {guild_id}: {e}")
                 logging.exception(e)
@@ -255,6 +285,9 @@ class PlexBot(commands.Bot):
             await context.send('{}, The target Plex media server is currently offline!'.format(context.author.mention))
         elif isinstance(exception, PlexContext.PlexNotFound):
             await context.send('{}, No Plex media server found for this guild!'.format(context.author.mention))
+        elif isinstance(getattr(exception, "original", exception), PlexExecutorBusy):
+            await context.send('{}, The Plex media server is busy with other requests, please try again in a bit!'
+                               .format(context.author.mention))
         elif isinstance(exception, commands.CommandNotFound):
             pass  # Silent ignore
         else:
@@ -1,5 +1,6 @@
 import datetime
 import re
+import time
 import traceback
 
 import langcodes
@@ -17,6 +18,7 @@ __all__ = ['clean', 'is_clean', 'get_season', 'base_info_layer', 'rating_str', '
 from discord.ui import Select
 
 from wrappers_utils.CombinedUser import CombinedUser
+from wrappers_utils.ShowTree import ShowTree
 
 from loguru import logger as logging
 
@@ -115,8 +117,8 @@ def translate(lang):
         return f"{lang}*"
 
 
-async def session_embed(plex):
-    plex_sessions = plex.sessions()
+async def session_embed(plex, max_age: float = None):
+    plex_sessions = await plex.session_poller.latest(max_age=max_age)
 
     if not plex.online:
         embed = discord.Embed(title="Server Offline",
@@ -179,14 +181,7 @@ def get_stream_parts(media: plexapi.media.Media) -> typing.Tuple[plexapi.media.V
 
 
 def make_session_entry(plex, session, embed):
-    if not session.isFullObject:
-        session.reload(checkFiles=False)
-        if not session.isFullObject:
-            embed.add_field(name="Session Error",
-                            value=f"Session `{session.id}` is not a full object and could not be reloaded")
-            return
-
-    if isinstance(session.session, list):
+    if isinstance(session.session, list) and len(session.session) > 0:
         session_instance = session.session[0]
     elif isinstance(session.session, plexapi.media.Session):
         session_instance = session.session
@@ -423,44 +418,107 @@ def get_from_guid(library, guid):
         return None
 
 
+def _search_for_rating_key(search_content, rating_key: int):
+    for content in search_content:
+        if isinstance(content, plexapi.video.Movie):
+            if content.ratingKey == rating_key:
+                return content
+        elif isinstance(content, plexapi.video.Show):
+            if content.ratingKey == rating_key:
+                return content
+            for season in content.seasons():
+                if season.ratingKey == rating_key:
+                    return season
+                for episode in season.episodes():
+                    if episode.ratingKey == rating_key:
+                        return episode
+    return None
+
+
+def fetch_from_media_index(library: plexapi.library.LibrarySection, media_index):
+    """Find an item by its ratingKey without scanning the library
+
+    The item is fetched directly, and if Plex can't find it that way, looked for in the show the server's media
+    index says it belongs to. Returns None when neither finds it, scan_for_media_index does the rest.
+    """
+    server = library._server
+    index = getattr(server, "media_index", None)
+    rating_key = int(media_index)
+    if not getattr(server, "online", True):
+        return None
+    try:
+        item = server.fetchItem(rating_key)
+    except plexapi.exceptions.NotFound:
+        item = None
+    if item is not None:
+        if index is not None:
+            index.direct_hits += 1
+            index.add_item(item)
+        return item
+
+    entry = index.get(rating_key) if index is not None else None
+    show_key = None
+    if entry is not None:
+        show_key = entry.grandparent if entry.type == "episode" else entry.parent
+    if not show_key:
+        return None
+    started = time.monotonic()
+    try:
+        found = _search_for_rating_key([server.fetchItem(int(show_key))], rating_key)
+    except plexapi.exceptions.NotFound:
+        found = None
+    if found is not None:
+        index.record_scan(time.monotonic() - started, True)
+        index.add_item(found)
+    return found
+
+
+def scan_for_media_index(library: plexapi.library.LibrarySection, media_index, recent=False):
+    """Scan the library for an item fetch_from_media_index couldn't find, this walks the whole library so run it on
+    the server's heavy executor
+
+    The 50 most recently added items are looked through first if recent is set.
+    """
+    server = library._server
+    index = getattr(server, "media_index", None)
+    rating_key = int(media_index)
+    if not getattr(server, "online", True):
+        return None
+    logging.debug(f"Could not fetch {rating_key} directly, scanning {library.title}")
+    started = time.monotonic()
+    found = None
+    try:
+        if recent:
+            found = _search_for_rating_key(library.recentlyAdded(maxresults=50).__reversed__(), rating_key)
+        if found is None:
+            found = _search_for_rating_key(library.all(), rating_key)
+    except plexapi.exceptions.NotFound:
+        logging.warning(f"Could not find {media_index} in {library.title} using all()")
+    duration = time.monotonic() - started
+    if index is not None:
+        index.record_scan(duration, found is not None)
+        if found is not None:
+            index.add_item(found)
+    logging.warning(f"Scanned {library.title} for {rating_key} in {duration:.2f}s, "
+                    f"{'found' if found is not None else 'not found'}")
+    return found
+
+
 def get_from_media_index(library: plexapi.library.LibrarySection,
                          media_index, recent=False) -> typing.Union[plexapi.video.Movie,
                                                                    plexapi.video.Show,
                                                                    plexapi.video.Season,
                                                                    plexapi.video.Episode,
                                                                    None]:
-    try:
+    """Find an item by its ratingKey, fetching it directly and only scanning the library if Plex can't find it
 
-        def search(search_content):
-            for content in search_content:
-                if isinstance(content, plexapi.video.Movie):
-                    if content.ratingKey == int(media_index):
-                        return content
-                elif isinstance(content, plexapi.video.Show):
-                    if content.ratingKey == int(media_index):
-                        return content
-                    for season in content.seasons():
-                        if season.ratingKey == int(media_index):
-                            return season
-                        for episode in season.episodes():
-                            if episode.ratingKey == int(media_index):
-                                return episode
-            return None
-
-        if recent:
-            recent_content = library.recentlyAdded(maxresults=50).__reversed__()
-            found = search(recent_content)
-            if found is not None:
-                return found
-        logging.debug(f"Getting media from index {media_index}")
-        all_content = library.all()
-        found = search(all_content)
-        if found is not None:
-            return found
-        return None
-    except plexapi.exceptions.NotFound:
-        logging.warning(f"Could not find {media_index} in {library.title} using all()")
-        return None
+    The scan first looks through the show the server's media index says the item belongs to, then the 50 most
+    recently added items if recent is set, and only then the whole library.
+    """
+    found = fetch_from_media_index(library, media_index)
+    if found is None:
+        found = scan_for_media_index(library, media_index, recent)
+    return found
 
 
 def get_show(library, show_name):
@@ -508,39 +566,46 @@ def rating_formatter(rating):
         return f"{str(round(rating * 10)).zfill(2)}%"
 
 
-def get_afs_rating(content, database):
+def cached_episodes(content) -> list:
+    """content.episodes(), served from the show tree in the server's metadata cache"""
+    return ShowTree.of(content).episodes
+
+
+def cached_seasons(show) -> list:
+    """show.seasons(), served from the server's metadata cache"""
+    cache = getattr(show._server, "metadata_cache", None)
+    if cache is None:
+        return show.seasons()
+    return cache.get(show, "seasons", show.seasons)
+
+
+async def _afs_average(db, where: str, params: tuple) -> typing.Optional[int]:
+    """The average of the plex_afs_ratings matched by where, None if there aren't any"""
+    total, count = await db.read_one(f"SELECT SUM(ratings.rating), COUNT(ratings.rating) FROM plex_afs_ratings AS "
+                                     f"ratings JOIN plex_watched_media AS media ON media.media_id = ratings.media_id "
+                                     f"WHERE {where}", params)
+    return round(total / count) if count else None
+
+
+async def get_afs_rating(content, db):
     if content.type == "movie" or content.type == "episode":
-        media = database.get_table("plex_watched_media").get_row(media_guid=content.guid)
+        media = await db.read_one("SELECT media_id FROM plex_watched_media WHERE media_guid = ?", (content.guid,))
         if media is not None:
-            ratings = media.get("plex_afs_ratings")
-            total = sum([rating['rating'] for rating in ratings])
-            if len(ratings) == 0:
+            average = await _afs_average(db, "media.media_id = ?", (media[0],))
+            if average is None:
                 return "AFS: `N/A`"
-            return f"AFS :`{round(total / len(ratings))}%`"
+            return f"AFS :`{average}%`"
         return "AFS: `N/A`"
     elif content.type == "show":
         strings = []
-        media = database.get_table("plex_watched_media").get_row(media_guid=content.guid)
-        if media is not None:
-            ratings = media.get("plex_afs_ratings")
-            total = sum([rating['rating'] for rating in ratings])
-            if len(ratings) != 0:
-                strings.append(f"ASS: `{round(total / len(ratings))}%`")
-            else:
-                strings.append(f"ASS: `N/A`")
-        else:
-            strings.append("ASS: `N/A`")
+        media = await db.read_one("SELECT media_id FROM plex_watched_media WHERE media_guid = ?", (content.guid,))
+        if media is None:
+            return "ASS: `N/A` | AES: `N/A`"
+        average = await _afs_average(db, "media.media_id = ?", (media[0],))
+        strings.append(f"ASS: `{average}%`" if average is not None else "ASS: `N/A`")
         # If there is no rating for the show, get the average rating of all the episodes
-        ratings = []
-        for episode in content.episodes():
-            media = database.get_table("plex_watched_media").get_row(media_guid=episode.guid)
-            if media is not None:
-                ratings += media.get("plex_afs_ratings")
-        total = sum([rating['rating'] for rating in ratings])
-        if len(ratings) != 0:
-            strings.append(f"AES: `{round(total / len(ratings))}%`")
-        else:
-            strings.append("AES: `N/A`")
+        average = await _afs_average(db, "media.show_id = ?", (media[0],))
+        strings.append(f"AES: `{average}%`" if average is not None else "AES: `N/A`")
 
         return " | ".join(strings)
     else:
@@ -548,7 +613,7 @@ def get_afs_rating(content, database):
         return None
 
 
-def rating_str(content, database=None) -> str:
+async def rating_str(content, db=None) -> str:
     """Get the rating string for a media"""
 
     rating_strings = [f"`{content.contentRating}`" if hasattr(content, 'contentRating') else "`N/A`"]
@@ -556,8 +621,8 @@ def rating_str(content, database=None) -> str:
         rating_strings.append(f"Audience `{rating_formatter(content.audienceRating)}`")
     if hasattr(content, 'rating'):
         rating_strings.append(f"Critics  `{rating_formatter(content.rating)}`")
-    if database is not None:
-        rating_strings.append(get_afs_rating(content, database))
+    if db is not None:
+        rating_strings.append(await get_afs_rating(content, db))
 
     return " | ".join(rating_strings)
 
@@ -601,36 +666,23 @@ def safe_field(field_text: str) -> str:
 
 def get_series_duration(content: typing.Union[plexapi.video.Show, plexapi.video.Season]) -> int:
     """Get the total duration of a series"""
-    total_duration = 0
-    for episode in content.episodes():
-        try:
-            total_duration += episode.duration
-        except TypeError:
-            pass
-    return total_duration
+    return ShowTree.of(content).duration
 
 
 def get_series_size(content: typing.Union[plexapi.video.Show, plexapi.video.Season]) -> int:
     """Get the total size of a series"""
-    total_size = 0
-    for episode in content.episodes():
-        try:
-            for media in episode.media:
-                for part in media.parts:
-                    total_size += part.size
-        except TypeError:
-            logging.debug(f"Episode {episode.title} has no size")
-    return total_size
+    return ShowTree.of(content).size
 
 
 def make_episode_selector(season, callback) -> typing.Union[typing.List[Select], Button] or None:
     """Make an episode selector for a show"""
-    if len(season.episodes()) == 0:
+    episodes = cached_episodes(season)
+    if len(episodes) == 0:
         return None
-    elif len(season.episodes()) <= 25:
+    elif len(episodes) <= 25:
         select_things = Select(custom_id=f"content_search_{hash(season)}", placeholder="Select an episode",
                                max_values=1)
-        for result in season.episodes():
+        for result in episodes:
             select_things.add_option(
                 label=f"Episode {result.index}: {result.title}",
                 value=f"e_{result.grandparentTitle}_{result.parentIndex}_{result.index}_{hash(result)}",
@@ -638,7 +690,7 @@ def make_episode_selector(season, callback) -> typing.Union[typing.List[Select],
             )
     else:
         # If there are more than 25 episodes, make a selector for every 25 episodes
-        split_episodes = [season.episodes()[i: i + 25] for i in range(0, len(season.episodes()), 25)]
+        split_episodes = [episodes[i: i + 25] for i in range(0, len(episodes), 25)]
         select_things = []
         for i in range(len(split_episodes)):
             select = Select(custom_id=f"content_search_{hash(season)}_{i}", placeholder="Select an episode",
@@ -665,9 +717,10 @@ def make_episode_selector(season, callback) -> typing.Union[typing.List[Select],
 
 def make_season_selector(show, callback) -> typing.Union[typing.List[Select], Button] or None:
     """Make a season selector for a show"""
-    if len(show.seasons()) == 0:
+    seasons = cached_seasons(show)
+    if len(seasons) == 0:
         return None
-    elif len(show.seasons()) <= 25:
+    elif len(seasons) <= 25:
         # select_things = [Select(
         #     custom_id=f"content_search_{hash(show)}",
         #     placeholder="Select a season",
@@ -682,7 +735,7 @@ def make_season_selector(show, callback) -> typing.Union[typing.List[Select], Bu
         select_things = Select(custom_id=f"content_search_{hash(show)}", placeholder="Select a season",
                                max_values=1)
         select_things.callback = callback
-        for result in show.seasons():
+        for result in seasons:
             select_things.add_option(
                 label=f"Season {result.index}",
                 value=f"s_{result.parentTitle}_{result.index}_{hash(result)}",
@@ -690,7 +743,7 @@ def make_season_selector(show, callback) -> typing.Union[typing.List[Select], Bu
             )
     else:
         # If there are more than 25 seasons, make a selector for every 25 seasons
-        split_seasons = [show.seasons()[i: i + 25] for i in range(0, len(show.seasons()), 25)]
+        split_seasons = [seasons[i: i + 25] for i in range(0, len(seasons), 25)]
         select_things = []
         for i in range(len(split_seasons)):
             select = Select(custom_id=f"content_search_{hash(show)}_{i}", placeholder="Select a season",
@@ -721,12 +774,12 @@ def make_season_selector(show, callback) -> typing.Union[typing.List[Select], Bu
     return view
 
 
-def base_info_layer(embed, content, database=None, full=True):
+async def base_info_layer(embed, content, db=None, full=True):
     """Make the base info layer for a media"""
 
     media_info = get_media_info(content.media)
 
-    embed.add_field(name="Ratings", value=rating_str(content, database), inline=False)
+    embed.add_field(name="Ratings", value=await rating_str(content, db), inline=False)
     rounded_duration = round(content.duration / 1000)  # Convert time to seconds and round
 
     if hasattr(content, 'genres'):
@@ -734,13 +787,13 @@ def base_info_layer(embed, content, database=None, full=True):
         embed.add_field(name="Runtime", value=f"{datetime.timedelta(seconds=rounded_duration)}", inline=True)
     else:
         embed.add_field(name="Runtime", value=f"{datetime.timedelta(seconds=rounded_duration)}", inline=True)
-        count = get_session_count(content, database)
+        count = await get_session_count(content, db)
         embed.add_field(name="Watch Sessions",
                         value=f"{'No sessions' if count == 0 else ('Not Available' if count == -1 else count)}",
                         inline=True)
 
-    if database:
-        embed.add_field(name="Watch Time", value=f"{get_watch_time(content, database)}", inline=True)
+    if db:
+        embed.add_field(name="Watch Time", value=f"{await get_watch_time(content, db)}", inline=True)
     actors = content.roles
     if len(actors) == 0:
         embed.add_field(name="Cast", value="No information available", inline=False)
@@ -757,7 +810,7 @@ def base_info_layer(embed, content, database=None, full=True):
                     value=safe_field("\n".join(subtitle_details(content, max_subs=6 if full else 2))), inline=False)
 
 
-def base_user_layer(user: CombinedUser, database):
+async def base_user_layer(user: CombinedUser, db):
     accountID = user.plex_user.id
     embed = discord.Embed(title=f"User: {user.display_name(plex_only=True)} - {user.plex_user.id}", color=0x00ff00)
     embed.set_author(name=f"{user.display_name(discord_only=True)} ({user.full_discord_username})",
@@ -768,16 +821,10 @@ def base_user_layer(user: CombinedUser, database):
     # - The total duration of the media items the user has watched
     # - How many devices the user has watched on
 
-    # Get the number of media items the user has watched
-    num_media = database.get(
-        '''SELECT COUNT(*) FROM plex_history_events WHERE account_id = ?''', (accountID,))[0][0]
-
-    # Get the total duration of the media sessions the user has watched
-    session_duration = database.get(
-        '''SELECT SUM(session_duration) FROM plex_history_events WHERE account_id = ?''', (accountID,))[0][0]
-
-    media_duration = database.get(
-        '''SELECT SUM(watch_time) FROM plex_history_events WHERE account_id = ?''', (accountID,))[0][0]
+    # Get the number of media sessions, their total duration and the watch time of the media in them
+    totals = await db.read_one(
+        '''SELECT sessions, session_duration, watch_time FROM plex_rollup_user WHERE account_id = ?''', (accountID,))
+    num_media, session_duration, media_duration = totals if totals else (0, None, None)
 
     if session_duration is None:
         session_duration = "Unknown"
@@ -789,51 +836,52 @@ def base_user_layer(user: CombinedUser, database):
     else:
         media_duration = datetime.timedelta(seconds=round(media_duration / 1000))
 
+    devices = await user.fetch_devices(db)
     embed.description = f"{user.mention()} has spent `{session_duration}` watching `{num_media}` media sessions " \
-                        f"totaling `{media_duration}` on `{len(user.devices)}` devices"
+                        f"totaling `{media_duration}` on `{len(devices)}` devices"
 
     # Display the last 6 media items the user has watched
 
     # In order to get the last 6 media items the user has watched, we need to get the last 6 history events
     # And then using the foreign key (media_id) we can get the media item from plex_watched_media
 
-    history_table = database.get_table("plex_history_events")
-    media_table = database.get_table("plex_watched_media")
-    history_events = history_table.select(f"account_id = '{accountID}'", order_by="history_time DESC", limit=6)
+    history_events = await db.read(
+        '''SELECT events.history_time, events.watch_time, events.session_duration, media.media_id, media.media_type,
+        media.title, media.media_year, media.show_id, media.season_num, media.ep_num, show.title
+        FROM plex_history_events AS events JOIN plex_watched_media AS media ON media.media_id = events.media_id
+        LEFT JOIN plex_watched_media AS show ON show.media_id = media.show_id
+        WHERE events.account_id = ? ORDER BY events.history_time DESC LIMIT 6''', (accountID,))
     media_list = []
-    for row in history_events:
-        media = row.get("plex_watched_media")[0] if len(row.get("plex_watched_media")) > 0 else None
-        if media is None:
-            continue
-        timestamp = datetime.datetime.fromtimestamp(int(row['history_time']), tz=datetime.timezone.utc)
+    for history_time, watch_time, session_time, media_id, media_type, title, year, show_id, season_num, ep_num, \
+            show_title in history_events:
+        timestamp = datetime.datetime.fromtimestamp(int(history_time), tz=datetime.timezone.utc)
         dynamic_time = f"<t:{round(timestamp.timestamp())}:f>"
-        media_duration = datetime.timedelta(seconds=round((row["watch_time"] / 1000)))
+        media_duration = datetime.timedelta(seconds=round((watch_time / 1000)))
         if media_duration < datetime.timedelta(seconds=1):
             media_duration = "Unknown"
-        session_duration = datetime.timedelta(seconds=round(row["session_duration"] / 1000))
-        if media['media_type'] == "episode":
-            show = media_table.get_row(media_id=media['show_id'])
-            if show is None:
-                logging.warning(f"Could not find show with id {media['show_id']} for media {media}")
+        session_duration = datetime.timedelta(seconds=round(session_time / 1000))
+        if media_type == "episode":
+            if show_title is None:
+                logging.warning(f"Could not find show with id {show_id} for media {media_id}")
                 continue
-            media_list.append(f"`{show['title']} (S{str(media['season_num']).zfill(2)}E"
-                              f"{str(media['ep_num']).zfill(2)})` `[{media_duration}]`\n"
+            media_list.append(f"`{show_title} (S{str(season_num).zfill(2)}E"
+                              f"{str(ep_num).zfill(2)})` `[{media_duration}]`\n"
                               f"└─>{dynamic_time} for `{session_duration}`")
         else:
-            media_list.append(f"`{media['title']} ({media['media_year']})` `[{media_duration}]`\n"
+            media_list.append(f"`{title} ({year})` `[{media_duration}]`\n"
                               f"└─>{dynamic_time} for `{session_duration}`")
     embed.add_field(name="Last 6 media sessions", value=stringify(media_list, separator='\n'), inline=False)
 
     # Display the last 6 devices the user has watched on
-    last_devices = user.devices[:6]
+    last_devices = devices[:6]
     device_list = []
 
     for device in last_devices:
         # For each device calculate the total duration the user has watched on that device
         dynamic_time = f"<t:{round(device.last_seen)}:f>"
-        device_duration = database.get("""
+        device_duration = (await db.read_stats("""
         SELECT SUM(watch_time) FROM plex_history_events WHERE account_id = ? AND device_id = ?
-        """, (accountID, device.clientIdentifier))[0][0]
+        """, (accountID, device.clientIdentifier)))[0][0]
         if device_duration is None:
             duration_string = "Unknown"
         else:
@@ -868,66 +916,61 @@ def text_progress_bar_maker(duration: float, end: float, start: float = 0, lengt
     return bar
 
 
-def get_watch_time(content, db) -> datetime.timedelta:
+async def get_watch_time(content, db) -> datetime.timedelta:
     """Get the total watch time of a piece of content from the plex_history_events table"""
-    media_table = db.get_table("plex_watched_media")
     if isinstance(content, plexapi.video.Movie):
-        media = media_table.get_row(media_guid=content.guid, media_type="movie")
+        media = await db.read_one("SELECT media_id FROM plex_watched_media WHERE media_guid = ? AND media_type = ?",
+                                  (content.guid, "movie"))
         if media is None:
             return datetime.timedelta(seconds=0)
-        result = db.get('''SELECT SUM(watch_time) FROM plex_history_events WHERE media_id = ?''', (media['media_id'],))
+        result = await db.read_one('''SELECT watch_time FROM plex_rollup_media WHERE media_id = ?''', (media[0],))
     elif isinstance(content, plexapi.video.Show):
-        media = media_table.get_row(media_guid=content.guid, media_type="show")
+        media = await db.read_one("SELECT media_id FROM plex_watched_media WHERE media_guid = ? AND media_type = ?",
+                                  (content.guid, "show"))
         if media is None:
             logging.warning(f"Could not find {content.title} in the database")
             return datetime.timedelta(seconds=0)
-        result = db.get(
-            f'''SELECT SUM(watch_time) FROM plex_history_events WHERE media_id in 
-            (SELECT media_id FROM plex_watched_media WHERE show_id = {media['media_id']})''')
+        result = await db.read_one('''SELECT SUM(watch_time) FROM plex_rollup_show WHERE show_id = ?''', (media[0],))
     elif isinstance(content, plexapi.video.Season):
-        media = media_table.get_row(media_guid=content.parentGuid, media_type="show")
+        media = await db.read_one("SELECT media_id FROM plex_watched_media WHERE media_guid = ? AND media_type = ?",
+                                  (content.parentGuid, "show"))
         if media is None:
             logging.warning(f"Could not find {content.title} in the database")
             return datetime.timedelta(seconds=0)
-        result = db.get(
-            '''SELECT SUM(watch_time) FROM plex_history_events WHERE media_id in 
-            (SELECT media_id FROM plex_watched_media WHERE show_id = ? AND season_num = ?)''',
-            (media['media_id'], content.seasonNumber))
+        result = await db.read_one('''SELECT watch_time FROM plex_rollup_show WHERE show_id = ? AND season_num = ?''',
+                                   (media[0], content.seasonNumber))
     elif isinstance(content, plexapi.video.Episode):
-        media = media_table.get_row(media_guid=content.guid, media_type="episode")
+        media = await db.read_one("SELECT media_id FROM plex_watched_media WHERE media_guid = ? AND media_type = ?",
+                                  (content.guid, "episode"))
         if media is None:
             return datetime.timedelta(seconds=0)
-        result = db.get('''SELECT SUM(watch_time) FROM plex_history_events WHERE media_id = ?''', (media['media_id'],))
+        result = await db.read_one('''SELECT watch_time FROM plex_rollup_media WHERE media_id = ?''', (media[0],))
     else:
         raise TypeError("content must be a plexapi video object")
-    print(result)
-    if result[0][0] is None:
+    if not result or result[0] is None:
         logging.warning(f"Watch time for {content.title} was None")
         return datetime.timedelta(seconds=0)
-    return datetime.timedelta(seconds=round(result[0][0] / 1000))
+    return datetime.timedelta(seconds=round(result[0] / 1000))
 
 
-def get_session_count(content, db) -> int:
+async def get_session_count(content, db) -> int:
     """Get the total number of sessions of a piece of content from the plex_history_events table"""
-    media_table = db.get_table("plex_watched_media")
     if isinstance(content, plexapi.video.Movie):
-        media = media_table.get_row(media_guid=content.guid)
+        media = await db.read_one("SELECT media_id FROM plex_watched_media WHERE media_guid = ?", (content.guid,))
         if media is None:
             return -1
-        result = db.get('''SELECT COUNT(*) FROM plex_history_events WHERE media_id = ?''', (media['media_id'],))
+        result = await db.read_one('''SELECT sessions FROM plex_rollup_media WHERE media_id = ?''', (media[0],))
     elif isinstance(content, plexapi.video.Show):
-        media = media_table.get_row(media_guid=content.guid)
+        media = await db.read_one("SELECT media_id FROM plex_watched_media WHERE media_guid = ?", (content.guid,))
         if media is None:
             return -1
-        result = db.get(
-            f'''SELECT COUNT(*) FROM plex_history_events WHERE media_id in 
-            (SELECT media_id FROM plex_watched_media WHERE show_id = {media['media_id']})''')
+        result = await db.read_one('''SELECT SUM(sessions) FROM plex_rollup_show WHERE show_id = ?''', (media[0],))
     elif isinstance(content, plexapi.video.Episode):
-        media = media_table.get_row(media_guid=content.guid)
+        media = await db.read_one("SELECT media_id FROM plex_watched_media WHERE media_guid = ?", (content.guid,))
         if media is None:
             return -1
-        result = db.get('''SELECT COUNT(*) FROM plex_history_events WHERE media_id = ?''', (media['media_id'],))
+        result = await db.read_one('''SELECT sessions FROM plex_rollup_media WHERE media_id = ?''', (media[0],))
     else:
         raise TypeError("content must be a plexapi video object")
 
-    return result[0][0]
+    return result[0] or 0 if result else 0
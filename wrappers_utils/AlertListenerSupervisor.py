@@ -0,0 +1,145 @@
+import asyncio
+import collections
+import random
+import time
+
+from loguru import logger as logging
+
+from wrappers_utils.HeartbeatAlertListener import HeartbeatAlertListener
+
+
+class AlertListenerSupervisor:
+    """Keeps one HeartbeatAlertListener running for a Plex server, restarting it with a backoff when it dies
+
+    The listener's thread signals the supervisor when it exits, so nothing is polled while the socket is healthy.
+    Restarts back off exponentially while the listener keeps failing quickly, and once max_restarts have happened
+    within restart_window seconds the supervisor gives up until it is started again. The supervisor stops by itself
+    when the server goes offline, the server's plex_connect event is what starts it back up.
+    """
+
+    base_delay = 1
+    max_delay = 120
+    stable_after = 60  # A listener that stays up this long resets the backoff
+    max_restarts = 10
+    restart_window = 3600
+    rate_window = 60  # Seconds of events used to work out events_per_second
+
+    def __init__(self, server, callback, error_callback, ping_interval: float = 30, ping_timeout: float = 10,
+                 dead_after: float = 120) -> None:
+        self.server = server
+        self.callback = callback
+        self.error_callback = error_callback
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.dead_after = dead_after
+        self.listener = None  # type: HeartbeatAlertListener | None
+        self.state = "stopped"
+        self.started_at = None  # time.monotonic() the current listener connected
+        self.reconnects = 0
+        self.failures = 0  # Consecutive restarts without the listener staying up for stable_after
+        self.restart_times = collections.deque()
+        self.events = 0
+        self.event_times = collections.deque()  # Appended to from the listener thread
+        self.task = None  # type: asyncio.Task | None
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    @property
+    def uptime(self) -> float:
+        return time.monotonic() - self.started_at if self.started_at is not None else 0.0
+
+    @property
+    def events_per_second(self) -> float:
+        cutoff = time.monotonic() - self.rate_window
+        while self.event_times and self.event_times[0] < cutoff:
+            self.event_times.popleft()
+        return len(self.event_times) / self.rate_window
+
+    def start(self) -> None:
+        if not self.running:
+            self.restart_times.clear()
+            self.failures = 0
+            self.task = asyncio.get_event_loop().create_task(self.supervisor())
+
+    def stop(self) -> None:
+        if self.running:
+            self.task.cancel()
+
+    def _on_event(self, data) -> None:
+        self.events += 1
+        self.event_times.append(time.monotonic())
+        self.callback(data)
+
+    def _delay(self) -> float:
+        return min(self.max_delay, self.base_delay * 2 ** self.failures) * random.uniform(0.5, 1.0)
+
+    async def _run_listener(self) -> None:
+        """Run one listener until its thread exits or it misses its heartbeat"""
+        loop = asyncio.get_running_loop()
+        exited = asyncio.Event()
+        self.listener = HeartbeatAlertListener(self.server, self._on_event, self.error_callback,
+                                               ping_interval=self.ping_interval, ping_timeout=self.ping_timeout,
+                                               on_exit=lambda: loop.call_soon_threadsafe(exited.set))
+        self.listener.name = f"EventListener-{self.server.friendlyName}"
+        self.listener.start()
+        self.server.alert_listener = self.listener
+        self.started_at = time.monotonic()
+        self.state = "running"
+        logging.info(f"Started event listener for {self.server.friendlyName}")
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(exited.wait(), timeout=self.ping_interval)
+                    logging.warning(f"Event listener for {self.server.friendlyName} has stopped")
+                    return
+                except asyncio.TimeoutError:
+                    pass
+                # A quiet server is fine, only restart if the websocket has stopped answering pings
+                if self.listener.heartbeat_age > self.dead_after:
+                    logging.warning(f"Event listener for {self.server.friendlyName} hasn't had a heartbeat in "
+                                    f"{self.listener.heartbeat_age:.0f} seconds, restarting event listener")
+                    return
+        finally:
+            if self.listener.is_alive():
+                self.listener.stop()
+            self.server.alert_listener = None
+
+    async def supervisor(self):
+        try:
+            while True:
+                try:
+                    await self._run_listener()
+                except Exception as e:
+                    logging.error(f"Error in event listener for {self.server.friendlyName}: {e}")
+                    logging.exception(e)
+                if not self.server.online:
+                    logging.warning(f"Plex server {self.server.friendlyName} is offline, discontinuing attempts to "
+                                    f"restart event listener")
+                    self.state = "offline"
+                    return
+                self.failures = 0 if self.uptime >= self.stable_after else self.failures + 1
+                now = time.monotonic()
+                self.restart_times.append(now)
+                while self.restart_times and self.restart_times[0] < now - self.restart_window:
+                    self.restart_times.popleft()
+                if len(self.restart_times) > self.max_restarts:
+                    logging.error(f"Event listener for {self.server.friendlyName} restarted {self.max_restarts} "
+                                  f"times in {self.restart_window} seconds, giving up")
+                    self.state = "failed"
+                    return
+                self.state = "restarting"
+                self.started_at = None
+                await asyncio.sleep(self._delay())
+                self.reconnects += 1
+        except asyncio.CancelledError:
+            self.state = "stopped"
+            raise
+        finally:
+            self.started_at = None
+
+    def status(self) -> dict:
+        return {"state": self.state, "uptime": self.uptime, "reconnects": self.reconnects,
+                "events": self.events, "events_per_second": self.events_per_second,
+                "heartbeat_age": self.listener.heartbeat_age if self.listener is not None else None}
@@ -8,3 +8,7 @@ class PlexNotReachable(Exception):
 
 class PlexOffline(Exception):
     pass
+
+
+class PlexExecutorBusy(Exception):
+    pass
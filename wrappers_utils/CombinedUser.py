@@ -1,6 +1,5 @@
 import datetime
 
-import ConcurrentDatabase
 import discord
 import plexapi
 
@@ -49,8 +48,9 @@ class CombinedUser:
         self.linked = True
 
     def _load_sys_user(self) -> bool:
+        accounts = self.plex_server.metadata_cache.get(None, "systemAccounts", self.plex_server.systemAccounts)
         if self.__plex_unknown__ is not None:
-            for user in self.plex_server.systemAccounts():
+            for user in accounts:
                 if user.name == self.__plex_unknown__:
                     self.plex_system_account = user
                     return True
@@ -58,7 +58,7 @@ class CombinedUser:
                     self.plex_system_account = user
                     return True
         if self.__plex_username__ is not None:
-            for user in self.plex_server.systemAccounts():
+            for user in accounts:
                 if user.name == self.__plex_username__:
                     self.plex_system_account = user
                     return True
@@ -67,7 +67,7 @@ class CombinedUser:
                 self.plex_system_account = self.plex_server.systemAccount(self.__plex_id__)
                 return True
         if self.__plex_email__ is not None:
-            for user in self.plex_server.systemAccounts():
+            for user in accounts:
                 if user.email == self.__plex_email__:
                     self.plex_system_account = user
                     return True
@@ -168,44 +168,42 @@ class CombinedUser:
         else:
             return ""
 
-    @property
-    def devices(self):
+    async def fetch_devices(self, db):
         """Sort through all plex devices and return those that are associated with this user"""
         if self.plex_user is None:
             return []
         else:
-            rows = self.plex_server.database.get("SELECT * FROM plex_devices "
-                                                 "WHERE account_id = ? AND last_seen < ? ORDER BY last_seen",
-                                                 (self.plex_user.id, datetime.datetime.now()
-                                                  - datetime.timedelta(days=7)))
-            all_devices = self.plex_server.systemDevices()
-            ids = [row[1] for row in rows]
-            devices = [device for device in all_devices if device.clientIdentifier in ids]
+            rows = await db.read("SELECT * FROM plex_devices "
+                                 "WHERE account_id = ? AND last_seen < ? ORDER BY last_seen",
+                                 (self.plex_user.id, datetime.datetime.now() - datetime.timedelta(days=7)))
+            all_devices = await self.plex_server.aio.systemDevices()
+            last_seen = {row[1]: row[2] for row in rows}
+            # Sightings that haven't been written to plex_devices yet are newer than what's there
+            for device_id, seen in self.plex_server.device_activity.pending_for(self.plex_user.id).items():
+                last_seen[device_id] = max(seen, last_seen.get(device_id, seen))
+            devices = [device for device in all_devices if device.clientIdentifier in last_seen]
             # Add a last seen attribute to the devices
             for device in devices:
-                for row in rows:
-                    if device.clientIdentifier == row[1]:
-                        device.last_seen = row[2]
+                device.last_seen = last_seen[device.clientIdentifier]
             # Sort the devices by last seen
             devices.sort(key=lambda x: x.last_seen, reverse=True)
             return devices
 
-    @property
-    def sessions(self) -> list[ConcurrentDatabase.DynamicEntry]:
-        table = self.plex_server.database.get_table("plex_history_events")
-        sessions = table.get_rows(account_id=self.plex_user.id)
-        return sessions
+    async def sessions(self, db) -> list:
+        return await db.read("SELECT * FROM plex_history_events WHERE account_id = ?", (self.plex_user.id,))
 
-    @property
-    def total_watch_time(self) -> int:
-        return self.plex_server.database.get("SELECT SUM(watch_time) FROM plex_history_events WHERE account_id = ?",
-                                             (self.plex_user.id,))[0][0]
+    async def session_count(self, db) -> int:
+        result = await db.read_one("SELECT sessions FROM plex_rollup_user WHERE account_id = ?", (self.plex_user.id,))
+        return result[0] if result else 0
 
-    @property
-    def unique_media_count(self) -> int:
-        return self.plex_server.database.get("SELECT COUNT(DISTINCT media_id) FROM plex_history_events "
-                                                  "WHERE account_id = ?",
-                                                  (self.plex_user.id,))[0][0]
+    async def total_watch_time(self, db) -> int:
+        result = await db.read_one("SELECT watch_time FROM plex_rollup_user WHERE account_id = ?",
+                                   (self.plex_user.id,))
+        return result[0] if result else 0
+
+    async def unique_media_count(self, db) -> int:
+        return (await db.read_stats("SELECT COUNT(DISTINCT media_id) FROM plex_history_events WHERE account_id = ?",
+                                    (self.plex_user.id,)))[0][0]
 
     def _compare_plex_info(self, other: str):
         if self.plex_user is not None:
@@ -0,0 +1,267 @@
+import asyncio
+import concurrent.futures
+import queue
+import sqlite3
+import threading
+import time
+import typing
+
+from loguru import logger as logging
+
+
+class _Statements:
+    """Statements the writer runs as one unit, they either all commit or none of them do"""
+    __slots__ = ("statements", "future")
+
+    def __init__(self, statements: typing.List[tuple], future: asyncio.Future) -> None:
+        self.statements = statements
+        self.future = future
+
+
+class _Call:
+    """A function the writer runs on its own, for the ConcurrentDatabase table methods which commit themselves"""
+    __slots__ = ("func", "args", "kwargs", "future")
+
+    def __init__(self, func, args, kwargs, future: asyncio.Future) -> None:
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+
+
+def _resolve(future: asyncio.Future, result=None, error: BaseException = None) -> None:
+    def resolve():
+        if future.done():  # The caller gave up waiting
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    future.get_loop().call_soon_threadsafe(resolve)
+
+
+class ReaderPool:
+    """A few threads each with their own read-only connection to the database"""
+
+    def __init__(self, name: str, path: str, workers: int, pragmas: typing.Dict[str, typing.Any],
+                 timeout: float) -> None:
+        self.name = name
+        self.path = path
+        self.pragmas = pragmas
+        self.timeout = timeout
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self.reads = 0
+        self.read_time = 0.0
+        self.max_read_time = 0.0
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=self.timeout,
+                                         check_same_thread=False)
+            for pragma, value in self.pragmas.items():
+                connection.execute(f"PRAGMA {pragma}={value}")
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def _read(self, sql: str, params: tuple) -> list:
+        started = time.monotonic()
+        cursor = self._connection().execute(sql, params)
+        try:
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+            elapsed = time.monotonic() - started
+            self.reads += 1
+            self.read_time += elapsed
+            self.max_read_time = max(self.max_read_time, elapsed)
+
+    async def read(self, sql: str, params: tuple) -> list:
+        return await asyncio.get_running_loop().run_in_executor(self.pool, self._read, sql, params)
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=True)
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+
+    def stats(self) -> dict:
+        return {"reads": self.reads, "read_time": round(self.read_time, 2),
+                "max_read_time": round(self.max_read_time, 2)}
+
+
+class DatabaseGateway:
+    """Gets the bot's SQLite work off the Discord event loop
+
+    Writes are queued to a single writer thread which owns the bot's ConcurrentDatabase connection. Statements that
+    are queued together are committed in one transaction, each under its own savepoint so one bad statement only
+    fails its own caller. Functions passed to call() run on the same thread between batches, that's how the
+    DynamicTable methods are used without their cached entries going stale.
+
+    Reads run on pools of read-only connections. The database is put into WAL mode so they see everything that has
+    been committed and never wait on the writer, and the statistics queries get a pool of their own so a long
+    aggregate can't hold up the lookups interactions are waiting on.
+    """
+
+    readers = 2
+    stats_readers = 2
+    max_batch = 64
+    read_timeout = 10
+
+    # WAL only needs the log synced at checkpoints, a crash can lose the last commits but never corrupts the database
+    writer_pragmas = {"journal_mode": "WAL", "synchronous": "NORMAL", "cache_size": -16000, "temp_store": "MEMORY",
+                      "mmap_size": 268435456}
+    reader_pragmas = {"cache_size": -8000, "temp_store": "MEMORY", "mmap_size": 268435456, "query_only": 1}
+
+    def __init__(self, database) -> None:
+        self.database = database
+        self.path = database.database_name
+        # These apply to the bot's own connection, which everything not using the gateway still shares
+        for pragma, value in self.writer_pragmas.items():
+            self.database.run(f"PRAGMA {pragma}={value}")
+        self._queue = queue.Queue()
+        self.read_pool = ReaderPool("db-reader", self.path, self.readers, self.reader_pragmas, self.read_timeout)
+        self.stats_pool = ReaderPool("db-stats", self.path, self.stats_readers, self.reader_pragmas,
+                                     self.read_timeout)
+        self.closed = False
+        self.batches = 0
+        self.statements = 0
+        self.calls = 0
+        self.failed = 0
+        self.largest_batch = 0
+        self._writer = threading.Thread(target=self._write_loop, name="db-writer", daemon=True)
+        self._writer.start()
+
+    # Reads
+
+    async def read(self, sql: str, params: tuple = ()) -> list:
+        """Run a read only query on a reader connection and return all of its rows"""
+        if self.closed:
+            raise RuntimeError("Database gateway is closed")
+        return await self.read_pool.read(sql, params)
+
+    async def read_one(self, sql: str, params: tuple = ()) -> typing.Optional[tuple]:
+        rows = await self.read(sql, params)
+        return rows[0] if rows else None
+
+    async def read_stats(self, sql: str, params: tuple = ()) -> list:
+        """Run a statistics query, anything aggregating over the history, on the statistics readers"""
+        if self.closed:
+            raise RuntimeError("Database gateway is closed")
+        return await self.stats_pool.read(sql, params)
+
+    # Writes
+
+    def _submit(self, job) -> asyncio.Future:
+        if self.closed:
+            raise RuntimeError("Database gateway is closed")
+        self._queue.put(job)
+        return job.future
+
+    async def write(self, sql: str, params: tuple = ()) -> int:
+        """Queue a statement for the writer, returns the rowid of the last row it inserted"""
+        return (await self.transaction([(sql, params)]))[-1]
+
+    async def transaction(self, statements: typing.List[tuple]) -> typing.List[int]:
+        """Queue (sql, params) statements that must commit together, returns the last inserted rowid of each"""
+        return await self._submit(_Statements(list(statements), asyncio.get_running_loop().create_future()))
+
+    async def call(self, func, *args, **kwargs):
+        """Run a function against the database on the writer thread and return its result"""
+        return await self._submit(_Call(func, args, kwargs, asyncio.get_running_loop().create_future()))
+
+    def _write_loop(self) -> None:
+        pending = None
+        while True:
+            job = pending if pending is not None else self._queue.get()
+            pending = None
+            if job is None:
+                break
+            if isinstance(job, _Call):
+                self._run_call(job)
+                continue
+            batch = [job]
+            while len(batch) < self.max_batch:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if not isinstance(job, _Statements):
+                    pending = job
+                    break
+                batch.append(job)
+            self._run_batch(batch)
+        logging.info("Database writer stopped")
+
+    def _run_call(self, job: _Call) -> None:
+        self.calls += 1
+        try:
+            result = job.func(*job.args, **job.kwargs)
+        except Exception as e:
+            self.failed += 1
+            _resolve(job.future, error=e)
+        else:
+            _resolve(job.future, result)
+
+    def _run_batch(self, batch: typing.List[_Statements]) -> None:
+        results = []
+        self.database.lock.acquire()
+        try:
+            cursor = self.database.cursor()
+            try:
+                if not self.database.in_transaction:
+                    cursor.execute("BEGIN")
+                for job in batch:
+                    cursor.execute("SAVEPOINT gateway_job")
+                    try:
+                        rowids = []
+                        for sql, params in job.statements:
+                            cursor.execute(sql, params)
+                            rowids.append(cursor.lastrowid)
+                    except sqlite3.Error as e:
+                        cursor.execute("ROLLBACK TO gateway_job")
+                        results.append((job, None, e))
+                    else:
+                        results.append((job, rowids, None))
+                    cursor.execute("RELEASE gateway_job")
+                self.database.commit()
+            except sqlite3.Error as e:
+                logging.error(f"Database Error: batch of {len(batch)} failed to commit {e}")
+                self.database.rollback()
+                results = [(job, None, e) for job in batch]
+            finally:
+                cursor.close()
+        finally:
+            self.database.lock.release()
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, len(batch))
+        for job, rowids, error in results:
+            self.statements += len(job.statements)
+            if error is not None:
+                self.failed += 1
+                _resolve(job.future, error=error)
+            else:
+                _resolve(job.future, rowids)
+
+    # Lifecycle
+
+    async def close(self) -> None:
+        """Let the writer finish what's queued and close the reader connections"""
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.put(None)
+        await asyncio.get_running_loop().run_in_executor(None, self._writer.join)
+        self.read_pool.close()
+        self.stats_pool.close()
+
+    def stats(self) -> dict:
+        return {"writer": {"queued": self._queue.qsize(), "batches": self.batches, "statements": self.statements,
+                           "calls": self.calls, "failed": self.failed, "largest_batch": self.largest_batch},
+                "reads": self.read_pool.stats(), "stats_reads": self.stats_pool.stats()}
@@ -0,0 +1,88 @@
+import asyncio
+import datetime
+import threading
+import typing
+
+from loguru import logger as logging
+
+
+class DeviceActivity:
+    """Remembers when each of a server's devices was last seen and writes it to plex_devices in batches
+
+    Every new SessionWatcher marks its device as seen, instead of a database round trip each time the sightings are
+    kept here, newest wins, and upserted together every flush_interval seconds or when the bot shuts down. seen() is
+    called from the executor threads so the pending sightings are only touched under the lock.
+    """
+
+    flush_interval = 60
+
+    upsert = """INSERT INTO plex_devices (account_id, device_id, last_seen) VALUES (?, ?, ?)
+                ON CONFLICT (account_id, device_id) DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen)"""
+
+    def __init__(self, database, event_loop: asyncio.AbstractEventLoop) -> None:
+        self.database = database
+        self.event_loop = event_loop
+        self.pending = {}  # type: typing.Dict[typing.Tuple[int, str], float]  # (account, device) -> last seen
+        self._lock = threading.Lock()
+        self._flush_scheduled = False
+        self.sightings = 0
+        self.flushes = 0
+        self.rows_written = 0
+
+    def seen(self, account_id: int, device_id: str, when: float = None) -> None:
+        when = when if when is not None else datetime.datetime.now().timestamp()
+        with self._lock:
+            key = (account_id, device_id)
+            self.pending[key] = max(when, self.pending.get(key, when))
+            self.sightings += 1
+            schedule = not self._flush_scheduled
+            self._flush_scheduled = True
+        if schedule and self.event_loop is not None:
+            self.event_loop.call_soon_threadsafe(self.event_loop.create_task, self._flush_later())
+
+    def pending_for(self, account_id: int) -> typing.Dict[str, float]:
+        """The sightings of an account's devices that haven't been written yet, device_id -> last seen"""
+        with self._lock:
+            return {device_id: last_seen for (account, device_id), last_seen in self.pending.items()
+                    if account == account_id}
+
+    async def _flush_later(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await asyncio.get_running_loop().run_in_executor(None, self.flush)
+            with self._lock:
+                if not self.pending:
+                    self._flush_scheduled = False
+                    return
+
+    def flush(self) -> int:
+        """Write the pending sightings in one transaction, this blocks"""
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        rows = [(account_id, device_id, last_seen) for (account_id, device_id), last_seen in pending.items()]
+        self.database.lock.acquire()
+        try:
+            cursor = self.database.cursor()
+            try:
+                cursor.executemany(self.upsert, rows)
+                self.database.commit()
+            finally:
+                cursor.close()
+        except Exception as e:
+            logging.error(f"Failed to write {len(rows)} device sightings, they'll be retried: {e}")
+            self.database.rollback()
+            with self._lock:
+                for key, last_seen in pending.items():
+                    self.pending[key] = max(last_seen, self.pending.get(key, last_seen))
+            return 0
+        finally:
+            self.database.lock.release()
+        self.flushes += 1
+        self.rows_written += len(rows)
+        return len(rows)
+
+    def stats(self) -> dict:
+        return {"pending": len(self.pending), "sightings": self.sightings, "flushes": self.flushes,
+                "rows_written": self.rows_written}
@@ -1,37 +1,122 @@
 import asyncio
 import functools
+import threading
+import time
 
 from loguru import logger as logging
 
 
+class EventStats:
+    """Dispatch counters for a single event name"""
+
+    def __init__(self):
+        self.triggered = 0
+        self.dispatched = 0
+        self.coalesced = 0
+        self.queued = 0  # Triggered but not yet dispatched on the event loop
+        self.max_queued = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def to_dict(self) -> dict:
+        average = self.total_latency / self.dispatched if self.dispatched else 0.0
+        return {"triggered": self.triggered, "dispatched": self.dispatched, "coalesced": self.coalesced,
+                "queued": self.queued, "max_queued": self.max_queued, "avg_latency": round(average, 4),
+                "max_latency": round(self.max_latency, 4)}
+
+
 class EventManager:
+    """Dispatches events to the methods decorated with on_event of every registered instance
+
+    Handlers are bound to their instances once, when the instance is registered, so triggering an event is a single
+    dict lookup. trigger_event is safe to call from any thread, the handlers are always started on the event loop.
+    A trigger identical to the last one queued for the same arguments, and still waiting to be dispatched, is
+    coalesced into it rather than queued again, so a burst of the same event runs its handlers once.
+    """
+
     def __init__(self):
-        self.event_handlers = {}
+        self.event_handlers = {}  # Event name -> functions decorated with on_event
+        self.bound_handlers = {}  # Event name -> handlers bound to a registered instance
         self.instances = []
+        self.stats = {}  # Event name -> EventStats
+        self._pending = {}  # Event arguments -> (event name, sequence) of the last event queued with them
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._tasks = set()
 
     def add_event_handler(self, event_name, handler):
         if event_name not in self.event_handlers:
             self.event_handlers[event_name] = []
         self.event_handlers[event_name].append(handler)
 
-    def add_instance(self, cls):
-        self.instances.append(cls)
+    def _instance_handlers(self, instance):
+        for cls in type(instance).__mro__:
+            for attribute in vars(cls).values():
+                event_name = getattr(attribute, "__event_name__", None)
+                if event_name is not None:
+                    yield event_name, attribute.__get__(instance, type(instance))
+
+    def add_instance(self, instance):
+        self.instances.append(instance)
+        for event_name, handler in self._instance_handlers(instance):
+            self.bound_handlers.setdefault(event_name, []).append(handler)
+
+    def remove_instance(self, instance):
+        if instance in self.instances:
+            self.instances.remove(instance)
+        for handlers in self.bound_handlers.values():
+            handlers[:] = [handler for handler in handlers if handler.__self__ is not instance]
 
-    def trigger_event(self, event_name, event_loop, *args, **kwargs):
-        # Check if the event loop is running
-        if not event_loop.is_running():
-            logging.warning("Event loop is not running, cannot trigger event")
+    def trigger_event(self, event_name, event_loop, *args, coalesce=True, **kwargs):
+        """Queue event_name to be dispatched on event_loop, may be called from any thread"""
+        if event_loop is None or event_loop.is_closed() or not event_loop.is_running():
+            logging.warning(f"Event loop is not running, cannot trigger {event_name}")
             return
-        if event_name in self.event_handlers:
-            for handler in self.event_handlers[event_name]:
-                # Find the instance that the handler belongs to
-                for instance in self.instances:
-                    if handler.__qualname__.startswith(instance.__class__.__qualname__):
-                        # Run the handler in a separate thread
-                        # print(f"Running {handler.__qualname__} with"
-                        #       f" args self={instance}, *args={args}, **kwargs={kwargs}")
-                        event_loop.create_task(handler(instance, *args, **kwargs))
-                        break
+        key = None
+        if coalesce:
+            try:
+                key = (args, frozenset(kwargs.items()))
+                hash(key)
+            except TypeError:
+                key = None  # Unhashable arguments are never coalesced
+        with self._lock:
+            stats = self.stats.setdefault(event_name, EventStats())
+            stats.triggered += 1
+            if key is not None and self._pending.get(key, (None,))[0] == event_name:
+                stats.coalesced += 1
+                return
+            self._sequence += 1
+            sequence = self._sequence
+            if key is not None:
+                self._pending[key] = (event_name, sequence)
+            stats.queued += 1
+            stats.max_queued = max(stats.max_queued, stats.queued)
+        event_loop.call_soon_threadsafe(self._dispatch, event_name, key, sequence, time.monotonic(), args, kwargs)
+
+    def _dispatch(self, event_name, key, sequence, triggered_at, args, kwargs):
+        latency = time.monotonic() - triggered_at
+        with self._lock:
+            if key is not None and self._pending.get(key) == (event_name, sequence):
+                del self._pending[key]
+            stats = self.stats[event_name]
+            stats.queued -= 1
+            stats.dispatched += 1
+            stats.total_latency += latency
+            stats.max_latency = max(stats.max_latency, latency)
+        for handler in self.bound_handlers.get(event_name, ()):
+            task = asyncio.get_running_loop().create_task(handler(*args, **kwargs))
+            self._tasks.add(task)
+            task.add_done_callback(self._handler_done)
+
+    def _handler_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.opt(exception=task.exception()).error(
+                f"Event handler {task.get_coro().__qualname__} raised {task.exception()}")
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {event_name: stats.to_dict() for event_name, stats in self.stats.items()}
 
 
 event_manager = EventManager()
@@ -49,6 +134,7 @@ def on_event(event_name):
         def wrapper(*args, **kwargs):
             return func(*args, **kwargs)
 
+        wrapper.__event_name__ = event_name
         return wrapper
 
     return decorator
@@ -0,0 +1,45 @@
+import time
+
+import plexapi.alert
+import websocket
+from loguru import logger as logging
+
+
+class HeartbeatAlertListener(plexapi.alert.AlertListener):
+    """An AlertListener that pings its websocket so a dead connection can be told apart from a quiet server
+
+    Every ping_interval seconds a websocket ping is sent, if the pong doesn't arrive within ping_timeout the socket
+    is closed and the thread exits. last_heartbeat is updated by every pong and message, so heartbeat_age can be
+    checked to catch a socket that has hung without closing. on_exit, if given, is called from the listener's thread
+    once it has stopped for any reason.
+    """
+
+    def __init__(self, server, callback=None, callbackError=None, ping_interval: float = 30,
+                 ping_timeout: float = 10, on_exit=None) -> None:
+        super().__init__(server, callback, callbackError)
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.on_exit = on_exit
+        self.last_heartbeat = time.monotonic()
+
+    @property
+    def heartbeat_age(self) -> float:
+        return time.monotonic() - self.last_heartbeat
+
+    def run(self):
+        url = self._server.url(self.key, includeToken=True).replace('http', 'ws')
+        logging.debug(f"Starting alert listener for {self._server.friendlyName}")
+        try:
+            self._ws = websocket.WebSocketApp(url, on_message=self._onMessage, on_error=self._onError,
+                                              on_open=self._heartbeat, on_pong=self._heartbeat)
+            self._ws.run_forever(ping_interval=self.ping_interval, ping_timeout=self.ping_timeout)
+        finally:
+            if self.on_exit is not None:
+                self.on_exit()
+
+    def _heartbeat(self, *args) -> None:
+        self.last_heartbeat = time.monotonic()
+
+    def _onMessage(self, *args):
+        self._heartbeat()
+        super()._onMessage(*args)
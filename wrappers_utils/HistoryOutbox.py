@@ -0,0 +1,217 @@
+import asyncio
+import collections
+import json
+import random
+import time
+import typing
+
+import aiohttp
+import discord
+
+from loguru import logger as logging
+
+
+class HistoryOutbox:
+    """Delivers the history messages queued in plex_history_outbox
+
+    PlexHistory writes a watch event and its outbox row in the same transaction, so an event can't end up without a
+    message because Discord was down or rate limiting the bot. This worker sends whatever is due, each channel's
+    messages in the order they were queued and no faster than Discord's per channel bucket allows. Once a message is
+    sent its ID is stored in plex_history_messages and the outbox row is removed, again in one transaction.
+
+    A failed send is retried with backoff and holds back the rest of that channel so messages stay in order. Rows that
+    can never be sent, the channel is gone or the bot can't post in it, or that have failed max_attempts times are
+    kept with no next_attempt for history_outbox to show and requeue.
+    """
+
+    batch_size = 50
+    poll_interval = 60  # Seconds between checks for due retries when nothing new has been queued
+    channel_rate = 5  # Messages per channel_period seconds in one channel
+    channel_period = 5
+    base_delay = 5
+    max_delay = 900
+    max_attempts = 12
+    thumbnail_timeout = 10
+    bad_thumbnail = "https://cdn.discordapp.com/attachments/1191806535861538948/1191806693621911572/bad_thumb.png"
+
+    enqueue_sql = """INSERT INTO plex_history_outbox (guild_id, channel_id, event_id, payload, attempts, next_attempt,
+                     created) VALUES (?, ?, ?, ?, 0, ?, ?)"""
+
+    def __init__(self, bot, view_factory: typing.Callable[[], discord.ui.View]) -> None:
+        self.bot = bot
+        self.view_factory = view_factory
+        self._wake = asyncio.Event()
+        self._task = None  # type: typing.Optional[asyncio.Task]
+        self._web_session = None  # type: typing.Optional[aiohttp.ClientSession]
+        self.blocked_until = {}  # type: typing.Dict[int, float]  # channel_id -> time.time() it can be sent to
+        self.recent_sends = collections.defaultdict(collections.deque)  # channel_id -> monotonic send times
+        self.delivered = 0
+        self.retried = 0
+        self.dead = 0
+
+    @classmethod
+    def enqueue_statement(cls, guild_id: int, channel_id: int, event_id: int, embed: discord.Embed) -> tuple:
+        """The (sql, params) that queues a message, run it in the same transaction as the event it's for"""
+        now = time.time()
+        return cls.enqueue_sql, (guild_id, channel_id, event_id, json.dumps(embed.to_dict()), now, now)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._web_session is not None:
+            await self._web_session.close()
+            self._web_session = None
+
+    def wake(self) -> None:
+        """Something new has been queued, deliver it now rather than at the next poll"""
+        self._wake.set()
+
+    def backoff(self, attempts: int) -> float:
+        return min(self.max_delay, self.base_delay * 2 ** attempts) * random.uniform(0.5, 1.0)
+
+    async def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            wait = self.poll_interval
+            try:
+                wait = await self.deliver_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Error delivering queued history messages: {e}")
+                logging.exception(e)
+            if wait <= 0:
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def deliver_due(self) -> float:
+        """Send one batch of due messages, returns how long until there might be more to send"""
+        now = time.time()
+        blocked = [channel_id for channel_id, until in self.blocked_until.items() if until > now]
+        rows = await self.bot.db.read(
+            "SELECT outbox_id, guild_id, channel_id, event_id, payload, attempts FROM plex_history_outbox "
+            f"WHERE next_attempt <= ? AND channel_id NOT IN ({', '.join('?' * len(blocked))}) "
+            # The unary plus keeps the planner from walking the whole table in outbox_id order, it finds the few
+            # due rows through ix_plex_history_outbox_due and sorts just those
+            "ORDER BY +outbox_id LIMIT ?", (now, *blocked, self.batch_size))
+        channels = collections.OrderedDict()
+        for row in rows:
+            channels.setdefault(row[2], []).append(row)
+        if channels:
+            await asyncio.gather(*(self._deliver_channel(channel_id, channel_rows)
+                                   for channel_id, channel_rows in channels.items()))
+        if len(rows) == self.batch_size:
+            return 0
+        # Rows in blocked channels can be due already, wake for them when their channel's block runs out instead
+        now = time.time()
+        blocked = [channel_id for channel_id, until in self.blocked_until.items() if until > now]
+        wake_at = [self.blocked_until[channel_id] for channel_id in blocked]
+        next_attempt = await self.bot.db.read_one(
+            "SELECT MIN(next_attempt) FROM plex_history_outbox "
+            f"WHERE channel_id NOT IN ({', '.join('?' * len(blocked))})", tuple(blocked))
+        if next_attempt is not None and next_attempt[0] is not None:
+            wake_at.append(next_attempt[0])
+        if not wake_at:
+            return self.poll_interval
+        return max(0.5, min(self.poll_interval, min(wake_at) - now))
+
+    async def _deliver_channel(self, channel_id: int, rows: list) -> None:
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            try:
+                channel = await self.bot.fetch_channel(channel_id)
+            except (discord.NotFound, discord.Forbidden) as e:
+                for row in rows:
+                    await self._give_up(row, f"Channel unavailable: {e}")
+                return
+            except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                await self._retry_channel(channel_id, rows, e)
+                return
+        for index, row in enumerate(rows):
+            outbox_id, guild_id, _, event_id, payload, attempts = row
+            await self._wait_for_bucket(channel_id)
+            try:
+                embed = discord.Embed.from_dict(json.loads(payload))
+                await self._check_thumbnail(embed)
+                message = await channel.send(embed=embed, view=self.view_factory())
+            except discord.RateLimited as e:
+                # Over discord.py's own limit for waiting on a bucket, come back when it has reset
+                self.blocked_until[channel_id] = time.time() + e.retry_after
+                await self._reschedule(rows[index:], time.time() + e.retry_after)
+                return
+            except (discord.NotFound, discord.Forbidden) as e:
+                await self._give_up(row, str(e))
+                continue
+            except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                await self._retry_channel(channel_id, rows[index:], e)
+                return
+            self.recent_sends[channel_id].append(time.monotonic())
+            await self.bot.db.transaction([
+                ("INSERT INTO plex_history_messages (guild_id, message_id, event_id) VALUES (?, ?, ?)",
+                 (guild_id, message.id, event_id)),
+                ("DELETE FROM plex_history_outbox WHERE outbox_id = ?", (outbox_id,))])
+            self.delivered += 1
+
+    async def _wait_for_bucket(self, channel_id: int) -> None:
+        sends = self.recent_sends[channel_id]
+        while sends and time.monotonic() - sends[0] >= self.channel_period:
+            sends.popleft()
+        if len(sends) >= self.channel_rate:
+            await asyncio.sleep(self.channel_period - (time.monotonic() - sends[0]))
+            sends.popleft()
+
+    async def _check_thumbnail(self, embed: discord.Embed) -> None:
+        """Swap the thumbnail for the placeholder if Plex isn't serving an image at its URL"""
+        thumb_url = embed.thumbnail.url if embed.thumbnail else None
+        if not thumb_url:
+            return
+        if self._web_session is None or self._web_session.closed:
+            self._web_session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.thumbnail_timeout))
+        # noinspection PyBroadException
+        try:
+            async with self._web_session.get(thumb_url) as r:
+                if r.status == 200:
+                    return
+                logging.warning(f"Bad thumb URL: {thumb_url}")
+        except Exception as e:
+            logging.warning(f"Error validating thumb URL: {thumb_url} - {e}")
+        embed.set_thumbnail(url=self.bad_thumbnail)
+
+    async def _retry_channel(self, channel_id: int, rows: list, error: Exception) -> None:
+        """Back off the first row and hold the rest of the channel's queue behind it"""
+        outbox_id, attempts = rows[0][0], rows[0][5] + 1
+        if attempts >= self.max_attempts:
+            await self._give_up(rows[0], f"Failed {attempts} times, last error: {error}")
+            return
+        retry_at = time.time() + self.backoff(attempts)
+        logging.warning(f"Couldn't send history message {outbox_id} to channel {channel_id}, "
+                        f"retrying in {retry_at - time.time():.0f}s: {error}")
+        self.blocked_until[channel_id] = retry_at
+        self.retried += 1
+        await self.bot.db.write("UPDATE plex_history_outbox SET attempts = ?, next_attempt = ?, last_error = ? "
+                                "WHERE outbox_id = ?", (attempts, retry_at, str(error), outbox_id))
+        await self._reschedule(rows[1:], retry_at)
+
+    async def _reschedule(self, rows: list, retry_at: float) -> None:
+        if rows:
+            await self.bot.db.transaction([("UPDATE plex_history_outbox SET next_attempt = ? WHERE outbox_id = ?",
+                                            (retry_at, row[0])) for row in rows])
+
+    async def _give_up(self, row: tuple, reason: str) -> None:
+        logging.error(f"Giving up on history message {row[0]} for event {row[3]} in channel {row[2]}: {reason}")
+        self.dead += 1
+        await self.bot.db.write("UPDATE plex_history_outbox SET attempts = attempts + 1, next_attempt = NULL, "
+                                "last_error = ? WHERE outbox_id = ?", (reason, row[0]))
+
+    def stats(self) -> dict:
+        return {"delivered": self.delivered, "retried": self.retried, "dead": self.dead,
+                "blocked_channels": sum(1 for until in self.blocked_until.values() if until > time.time())}
@@ -0,0 +1,65 @@
+import threading
+import time
+import typing
+
+
+class SectionCensus:
+    __slots__ = ("section_id", "duration", "top_level_count", "leaf_count", "storage", "taken_at")
+
+    def __init__(self, section_id: int, duration: int, top_level_count: int, leaf_count: int, storage: int) -> None:
+        self.section_id = section_id
+        self.duration = duration  # Milliseconds
+        self.top_level_count = top_level_count  # Movies, shows or artists
+        self.leaf_count = leaf_count  # Movies, episodes or tracks
+        self.storage = storage  # Bytes
+        self.taken_at = time.time()
+
+
+class LibraryCensus:
+    """Counts what's in each library section of a server without listing it, and remembers the counts
+
+    The counts come from Plex's own totals, totalViewSize asks for a zero length page of a section so the counts
+    for shows and episodes are two small requests whatever the size of the library. A section's census is kept
+    until a library timeline event says something in it has been added, finished processing or been deleted.
+    """
+
+    # The type of the leaves of each kind of section
+    leaf_types = {"show": "episode", "artist": "track", "movie": "movie", "photo": "photo"}
+
+    def __init__(self) -> None:
+        self.sections = {}  # type: typing.Dict[int, SectionCensus]
+        self._lock = threading.Lock()
+
+    def count(self, section) -> SectionCensus:
+        """The census of a section, taking it if there isn't one cached, this blocks"""
+        section_id = int(section.key)
+        census = self.sections.get(section_id)
+        if census is not None:
+            return census
+        # The section may have come from the metadata cache, totalDuration and totalStorage come from a cached
+        # property of it so drop that to have them fetched again alongside the counts
+        section.__dict__.pop("_getTotalDurationStorage", None)
+        top_level_count = section.totalViewSize(includeCollections=False)
+        leaf_type = self.leaf_types.get(section.type)
+        if leaf_type is None or leaf_type == section.type:
+            leaf_count = top_level_count
+        else:
+            leaf_count = section.totalViewSize(libtype=leaf_type, includeCollections=False)
+        census = SectionCensus(section_id, section.totalDuration or 0, top_level_count, leaf_count,
+                               section.totalStorage or 0)
+        with self._lock:
+            self.sections[section_id] = census
+        return census
+
+    def invalidate(self, section_id) -> None:
+        with self._lock:
+            self.sections.pop(int(section_id), None)
+
+    def invalidate_timeline_entry(self, entry: dict) -> None:
+        # Items being created (0) and metadata downloads (1-4) are followed by a 5 or 9 once the item is settled
+        if entry.get('sectionID') is not None and int(entry.get('state', -1)) in (5, 9):
+            self.invalidate(entry['sectionID'])
+
+    def clear(self) -> None:
+        with self._lock:
+            self.sections.clear()
@@ -11,10 +11,11 @@ from discord.ui import View, Button, Select
 from plexapi.sync import VIDEO_QUALITY_12_MBPS_1080p
 
 from utils import stringify, get_series_duration, base_info_layer, get_watch_time, get_session_count, safe_field, \
-    rating_str, cleanup_url, get_series_size, get_all_library, get_from_media_index
+    rating_str, cleanup_url, get_series_size, get_all_library, get_from_media_index, cached_seasons
 from loguru import logger as logging
 
 from wrappers_utils.Modals import ReviewModal
+from wrappers_utils.ShowTree import ShowTree
 
 
 class PlexSearchView(View):
@@ -80,10 +81,10 @@ class PlexSearchView(View):
             await interaction.response.defer()
             self.stop()
         elif interaction.data["custom_id"] == "add_review":
-            row = self.client.database.get_table("plex_watched_media").get_row(guild_id=interaction.guild.id,
-                                                                               media_guid=self.current_content.guid)
+            row = await self.client.db.read_one("SELECT media_id FROM plex_watched_media WHERE guild_id = ? AND "
+                                                "media_guid = ?", (interaction.guild.id, self.current_content.guid))
             if row:
-                await interaction.response.send_modal(ReviewModal(row["media_id"]))
+                await interaction.response.send_modal(ReviewModal(row[0]))
             else:
                 await interaction.response.send_message("This media has not been watched yet", ephemeral=True)
         elif interaction.data["custom_id"] == "optimize":
@@ -103,9 +104,9 @@ class PlexSearchView(View):
             await asyncio.sleep(0.5)
             view.set_message(await interaction.message.edit(content=None, embed=embed, view=view))
 
-    def get_transcode_session(self, background_task):
+    async def get_transcode_session(self, background_task):
         task_key = background_task.key.replace("/transcode/sessions/", "")
-        transcode_sessions = self.context.plex.transcodeSessions()
+        transcode_sessions = await self.context.plex.aio.transcodeSessions()
         for session in transcode_sessions:
             if session.key == task_key:
                 return session
@@ -113,12 +114,12 @@ class PlexSearchView(View):
 
     async def update_optimization_message(self, msg, media, media_id):
         # Find the optimization task
-        background_tasks = self.context.plex.backgroundSessions()
+        background_tasks = await self.context.plex.aio.backgroundSessions()
         while len(background_tasks) > 0:
-            background_tasks = self.context.plex.backgroundSessions()
+            background_tasks = await self.context.plex.aio.backgroundSessions()
             for task in background_tasks:
                 if int(task.ratingKey) == int(media_id):
-                    transcode_session = self.get_transcode_session(task)
+                    transcode_session = await self.get_transcode_session(task)
                     progress = float(task.progress) if task.progress is not None else 0.0
                     embed = discord.Embed(title="Optimize Media",
                                           description=f"Transcoding `{media.title} ({media.year})`",
@@ -148,8 +149,8 @@ class PlexSearchView(View):
 
     async def optimize_media(self, media, interaction: Interaction):
         """Optimize media for streaming"""
-        optimized_items = self.context.plex.optimizedItems()
-        in_progress_items = self.context.plex.backgroundSessions()
+        optimized_items = await self.context.plex.aio.run(self.context.plex.optimizedItems)
+        in_progress_items = await self.context.plex.aio.backgroundSessions()
         print(optimized_items)
         if any(int(item.id) == int(media.ratingKey) for item in optimized_items):
             embed = discord.Embed(title="Optimize Media",
@@ -211,8 +212,9 @@ class PlexSearchView(View):
                 if label not in labels:
                     labels.append(label)
                     if result.type == "season":
+                        # leafCount comes with the season listing, no need to fetch each season's episodes
                         select_thing.add_option(label=label, value=str(self.results.index(result)),
-                                                description=f"Episodes: {len(result.episodes())}")
+                                                description=f"Episodes: {result.leafCount}")
                     else:
                         select_thing.add_option(label=label, value=str(self.results.index(result)))
                 else:
@@ -234,14 +236,14 @@ async def media_details(content, self=None, ctx=None, requester=None, full=True)
         if full:
             embed.add_field(name="Summary", value=content.summary, inline=False)
 
-        base_info_layer(embed, content, database=self.bot.database, full=full)
+        await base_info_layer(embed, content, db=self.bot.db, full=full)
         if self and requester:
             view = PlexSearchView(requester, self, ctx, "content", content, content)
 
     elif isinstance(content, plexapi.video.Show):  # ----------------------------------------------------------
         """Format the embed being sent for a show"""
 
-        rating_string = rating_str(content, database=self.bot.database)
+        rating_string = await rating_str(content, db=self.bot.db)
 
         embed = discord.Embed(title=f"{safe_field(content.title)}",
                               description=f"{content.tagline if content.tagline else 'No Tagline'}", color=0x00ff00)
@@ -255,46 +257,48 @@ async def media_details(content, self=None, ctx=None, requester=None, full=True)
             embed.add_field(name="Network", value=content.network, inline=True)
         else:
             embed.add_field(name="Studio", value="Unknown", inline=True)
-        size = await self.bot.loop.run_in_executor(None, get_series_size, content)
-        embed.add_field(name="Size", value=humanize.naturalsize(size), inline=True)
+        tree = await content._server.aio.run(ShowTree.of, content)
+        embed.add_field(name="Size", value=humanize.naturalsize(tree.size), inline=True)
         embed.add_field(name="Originally Aired", value=content.originallyAvailableAt.strftime("%B %d, %Y"),
                         inline=True)
 
         embed.add_field(name="Average Episode Runtime",
                         value=f"{datetime.timedelta(milliseconds=content.duration)}", inline=True)
         embed.add_field(name="Total Duration",
-                        value=f"{datetime.timedelta(seconds=round(get_series_duration(content) / 1000))}",
+                        value=f"{datetime.timedelta(seconds=round(tree.duration / 1000))}",
                         inline=True)
-        embed.add_field(name="Watch Time", value=f"{get_watch_time(content, self.bot.database)}", inline=True)
+        embed.add_field(name="Watch Time", value=f"{await get_watch_time(content, self.bot.db)}", inline=True)
         embed.add_field(name="Total Seasons", value=content.childCount, inline=True)
-        embed.add_field(name="Total Episodes", value=f"{len(content.episodes())}", inline=True)
-        count = get_session_count(content, self.bot.database)
+        embed.add_field(name="Total Episodes", value=f"{tree.episode_count}", inline=True)
+        count = await get_session_count(content, self.bot.db)
         embed.add_field(name="Total Sessions",
                         value=f"{'No sessions' if count == 0 else ('Not Available' if count == -1 else count)}",
                         inline=True)
         if self and requester:
-            view = PlexSearchView(requester, self, ctx, "season", content.seasons(), content)
+            seasons = await content._server.aio.run(cached_seasons, content)
+            view = PlexSearchView(requester, self, ctx, "season", seasons, content)
 
     elif isinstance(content, plexapi.video.Season):  # ------------------------------------------------------
         """Format the embed being sent for a season"""
         embed = discord.Embed(title=f"{content.parentTitle}",
                               description=f"Season {content.index}", color=0x00ff00)
-        embed.add_field(name=f"Episodes: {len(content.episodes())}",
-                        value=stringify(content.episodes(), separator="\n")[:1024], inline=False)
+        tree = await content._server.aio.run(ShowTree.of, content)
+        embed.add_field(name=f"Episodes: {tree.episode_count}",
+                        value=stringify(tree.episodes, separator="\n")[:1024], inline=False)
         embed.add_field(name="Total Duration",
-                        value=f"{datetime.timedelta(seconds=round(get_series_duration(content) / 1000))}",
+                        value=f"{datetime.timedelta(seconds=round(tree.duration / 1000))}",
                         inline=True)
-        embed.add_field(name="Watch Time", value=f"{get_watch_time(content, self.bot.database)}", inline=True)
-        embed.add_field(name="Total Size", value=humanize.naturalsize(get_series_size(content)), inline=True)
+        embed.add_field(name="Watch Time", value=f"{await get_watch_time(content, self.bot.db)}", inline=True)
+        embed.add_field(name="Total Size", value=humanize.naturalsize(tree.size), inline=True)
         if self and requester:
-            view = PlexSearchView(requester, self, ctx, "episode", content.episodes(), content)
+            view = PlexSearchView(requester, self, ctx, "episode", tree.episodes, content)
 
     elif isinstance(content, plexapi.video.Episode):  # ------------------------------------------------------
         """Format the embed being sent for an episode"""
         embed = discord.Embed(title=f"{content.grandparentTitle}\n{content.title} "
                                     f"(S{content.parentIndex}E{content.index})",
                               description=f"{content.summary}" if full else "", color=0x00ff00)
-        base_info_layer(embed, content, database=self.bot.database, full=full)
+        await base_info_layer(embed, content, db=self.bot.db, full=full)
         if self and requester:
             view = PlexSearchView(requester, self, ctx, "content", content, content)
     else:
@@ -302,7 +306,8 @@ async def media_details(content, self=None, ctx=None, requester=None, full=True)
 
     ###############################################################################################################
 
-    db_entry = self.bot.database.get_table("plex_watched_media").get_row(media_guid=content.guid)
+    db_entry = await self.bot.db.read_one("SELECT media_id FROM plex_watched_media WHERE media_guid = ?",
+                                          (content.guid,))
 
     # if inter is not None:
     #     await inter.disable_components()
@@ -328,7 +333,7 @@ async def media_details(content, self=None, ctx=None, requester=None, full=True)
         embed.set_author(name=f"Requested by: {requester.display_name}", icon_url=requester.display_avatar.url)
 
     embed.set_footer(text=f"Located in {content.librarySectionTitle}, "
-                          f"Media ID: {db_entry['media_id'] if db_entry else 'N/A'}, "
+                          f"Media ID: {db_entry[0] if db_entry else 'N/A'}, "
                           f"Plex ID: {content.ratingKey}")
 
     return embed, view
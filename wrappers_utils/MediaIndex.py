@@ -0,0 +1,88 @@
+import threading
+import typing
+
+
+class IndexEntry:
+    __slots__ = ("type", "parent", "grandparent", "section")
+
+    def __init__(self, type: typing.Optional[str], parent: typing.Optional[int], grandparent: typing.Optional[int],
+                 section: typing.Optional[int]) -> None:
+        self.type = type
+        self.parent = parent
+        self.grandparent = grandparent
+        self.section = section
+
+
+class MediaIndex:
+    """What the bot knows about a server's ratingKeys, their type and where they sit in their show
+
+    It's fed by library timeline events and by every item get_from_media_index resolves, and used to narrow the
+    fallback scan down to one show when fetchItem can't find an item. It also keeps the lookup counters shown by
+    plex_status. Timeline events arrive on the alert listener's thread so every change takes the lock.
+    """
+
+    # Plex's numeric metadata types, as used by timeline entries
+    timeline_types = {1: "movie", 2: "show", 3: "season", 4: "episode"}
+    max_entries = 50000
+
+    def __init__(self) -> None:
+        self.entries = {}  # type: typing.Dict[int, IndexEntry]
+        self._lock = threading.Lock()
+        self.direct_hits = 0
+        self.scan_hits = 0
+        self.misses = 0
+        self.scans = 0
+        self.scan_time = 0.0
+        self.max_scan_time = 0.0
+
+    def get(self, rating_key) -> typing.Optional[IndexEntry]:
+        return self.entries.get(int(rating_key))
+
+    def _set(self, rating_key: int, entry: IndexEntry) -> None:
+        with self._lock:
+            if rating_key not in self.entries and len(self.entries) >= self.max_entries:
+                # Drop the oldest entry, dicts keep insertion order
+                del self.entries[next(iter(self.entries))]
+            self.entries[rating_key] = entry
+
+    def add_item(self, item) -> None:
+        """Index a plexapi or SessionSnapshot item"""
+        self._set(int(item.ratingKey), IndexEntry(item.type, getattr(item, "parentRatingKey", None),
+                                                  getattr(item, "grandparentRatingKey", None),
+                                                  getattr(item, "librarySectionID", None)))
+
+    def add_timeline_entry(self, entry: dict) -> None:
+        """Index a library timeline entry from the alert listener, deletions remove the item"""
+        try:
+            rating_key = int(entry['itemID'])
+        except (KeyError, TypeError, ValueError):
+            return
+        if int(entry.get('state', -1)) == 9:
+            self.remove(rating_key)
+            return
+        existing = self.entries.get(rating_key)
+        parent = entry.get('parentItemID')
+        grandparent = entry.get('rootItemID')
+        self._set(rating_key, IndexEntry(
+            self.timeline_types.get(int(entry.get('type', 0)), existing.type if existing else None),
+            int(parent) if parent else (existing.parent if existing else None),
+            int(grandparent) if grandparent else (existing.grandparent if existing else None),
+            int(entry['sectionID']) if entry.get('sectionID') is not None else None))
+
+    def remove(self, rating_key) -> None:
+        with self._lock:
+            self.entries.pop(int(rating_key), None)
+
+    def record_scan(self, duration: float, found: bool) -> None:
+        self.scans += 1
+        self.scan_time += duration
+        self.max_scan_time = max(self.max_scan_time, duration)
+        if found:
+            self.scan_hits += 1
+        else:
+            self.misses += 1
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "direct_hits": self.direct_hits, "scan_hits": self.scan_hits,
+                "misses": self.misses, "scans": self.scans, "scan_time": round(self.scan_time, 2),
+                "max_scan_time": round(self.max_scan_time, 2)}
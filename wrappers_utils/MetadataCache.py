@@ -0,0 +1,102 @@
+import collections
+import threading
+import time
+import typing
+
+
+class MetadataCache:
+    """An LRU cache of the lists and show trees the bot fetches from one Plex server
+
+    Entries are keyed by the parent's ratingKey, its updatedAt and what was fetched, so an item that Plex has
+    updated is never served from an old entry. Library timeline events invalidate the item they're about along with
+    its parent and grandparent, which is what catches episodes being added to a show whose own updatedAt hasn't
+    changed. Server wide lists such as the library sections use a ratingKey of None and just expire after ttl.
+
+    The cache holds at most max_entries lists and max_items items across all of them, least recently used entries
+    are dropped first. It's used from the executor threads so every access takes the lock.
+    """
+
+    max_entries = 512
+    max_items = 20000
+    ttl = 600
+
+    def __init__(self) -> None:
+        self.entries = collections.OrderedDict()  # (ratingKey, updatedAt, kind) -> (monotonic expiry, value)
+        self.keys = {}  # type: typing.Dict[typing.Optional[int], typing.Set[tuple]]  # ratingKey -> its entries
+        self.items = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _size(value) -> int:
+        return len(value) if hasattr(value, "__len__") else 1
+
+    def get(self, item, kind: str, loader: typing.Callable[[], typing.Any]):
+        """Return the cached result of loader for item, calling it and caching the result on a miss
+
+        item may be None for server wide lists
+        """
+        rating_key = int(item.ratingKey) if item is not None else None
+        updated_at = getattr(item, "updatedAt", None) if item is not None else None
+        key = (rating_key, updated_at, kind)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = loader()
+        with self._lock:
+            self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.keys.setdefault(rating_key, set()).add(key)
+            self.items += self._size(value)
+            while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.items > self.max_items):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+        return value
+
+    def _remove(self, key) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.items -= self._size(entry[1])
+        keys = self.keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys[key[0]]
+
+    def invalidate(self, rating_key) -> None:
+        """Drop every entry for a ratingKey, None drops the server wide lists"""
+        with self._lock:
+            keys = self.keys.get(int(rating_key) if rating_key is not None else None)
+            if not keys:
+                return
+            for key in list(keys):
+                self._remove(key)
+            self.invalidations += 1
+
+    def invalidate_timeline_entry(self, entry: dict, media_index=None) -> None:
+        """Drop everything a library timeline entry could have changed, the item, its season and its show"""
+        related = {entry.get('itemID'), entry.get('parentItemID'), entry.get('rootItemID')}
+        indexed = media_index.get(entry['itemID']) if media_index is not None and entry.get('itemID') else None
+        if indexed is not None:
+            related.update((indexed.parent, indexed.grandparent))
+        for rating_key in related:
+            if rating_key:
+                self.invalidate(rating_key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entries.clear()
+            self.keys.clear()
+            self.items = 0
+
+    def stats(self) -> dict:
+        return {"entries": len(self.entries), "items": self.items, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "invalidations": self.invalidations}
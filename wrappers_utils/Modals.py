@@ -13,10 +13,11 @@ class ReviewModal(discord.ui.Modal):
     async def on_submit(self, interaction: discord.Interaction):  # pylint: disable=arguments-differ
         """Handles when a modal is submitted"""
         review = self.review_value.value
+        db = interaction.client.db
         table = interaction.client.database.get_table("plex_afs_ratings")
         if not review:
             # Used to indicate if the user wants to delete their review
-            table.delete(media_id=self.media_id, user_id=interaction.user.id)
+            await db.call(table.delete, media_id=self.media_id, user_id=interaction.user.id)
             await interaction.response.send_message("Review deleted", ephemeral=True)
             return
 
@@ -29,10 +30,10 @@ class ReviewModal(discord.ui.Modal):
             return
         logging.info(f"Review: {review}")
 
-        row = table.get_row(media_id=self.media_id, user_id=interaction.user.id)
+        row = await db.call(table.get_row, media_id=self.media_id, user_id=interaction.user.id)
         if row:
-            row.set(rating=review)
+            await db.call(row.set, rating=review)
             await interaction.response.send_message("Review updated", ephemeral=True)
         else:
-            table.add(media_id=self.media_id, user_id=interaction.user.id, rating=review)
+            await db.call(table.add, media_id=self.media_id, user_id=interaction.user.id, rating=review)
             await interaction.response.send_message("Review added", ephemeral=True)
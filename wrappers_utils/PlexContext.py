@@ -1,11 +1,11 @@
 import traceback
 
 from discord.ext import commands
-from wrappers_utils.PlexServer import PlexServer
 
-from wrappers_utils.DiscordAssociations import DiscordAssociations
+from wrappers_utils.BotExceptions import PlexNotLinked
 
-plex_servers = {}
+plex_servers = {}  # Guild ID -> GuildPlexServer
+server_pool = {}  # (server_url, server_token) -> PlexServer shared by every guild linked to it
 discord_associations = {}
 
 
@@ -24,17 +24,12 @@ class PlexContext(commands.Context):
     def _get_plex(self):
         guild_id = self.guild.id
         if guild_id not in plex_servers:
-            row = self.table.get_row(guild_id=guild_id)
-            if row:
-                try:
-                    plex_servers[guild_id] = PlexServer(row["server_url"], row["token"],
-                                                        associations=DiscordAssociations(self, self.guild),
-                                                        database=self.bot.database,
-                                                        host_guild=self.guild)
-                except Exception as e:
-                    raise self.PlexOffline("Plex server is offline") from e
-            else:
+            try:
+                self.bot.connect_plex(self.guild)
+            except PlexNotLinked:
                 raise self.PlexNotFound("Plex server not found")
+            except Exception as e:
+                raise self.PlexOffline("Plex server is offline") from e
 
         return plex_servers[guild_id]
 
@@ -0,0 +1,103 @@
+import asyncio
+import concurrent.futures
+import time
+
+from loguru import logger as logging
+
+from wrappers_utils.BotExceptions import PlexExecutorBusy
+
+
+class ExecutorLane:
+    """One thread pool of a PlexExecutor along with the limits and counters for it"""
+
+    def __init__(self, name: str, max_workers: int, max_pending: int, reject_when_full: bool) -> None:
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.reject_when_full = reject_when_full
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = asyncio.Semaphore(max_pending)
+        self.pending = 0  # Jobs submitted to the pool that haven't finished yet
+        self.waiting = 0  # Jobs waiting for a pending slot before they can be submitted
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.busy_time = 0.0
+        self.max_wait = 0.0
+
+    async def run(self, func, *args, **kwargs):
+        if self.reject_when_full and self._slots.locked():
+            self.rejected += 1
+            raise PlexExecutorBusy(f"{self.name} already has {self.pending} jobs pending")
+        queued_at = time.monotonic()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.pending += 1
+        try:
+            started = []
+
+            def job():
+                started.append(time.monotonic())
+                return func(*args, **kwargs)
+
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(self.pool, job)
+            except Exception:
+                self.failed += 1
+                raise
+            self.completed += 1
+            return result
+        finally:
+            if started:
+                self.max_wait = max(self.max_wait, started[0] - queued_at)
+                self.busy_time += time.monotonic() - started[0]
+            self.pending -= 1
+            self._slots.release()
+
+    def stats(self) -> dict:
+        return {"pending": self.pending, "waiting": self.waiting, "completed": self.completed, "failed": self.failed,
+                "rejected": self.rejected, "busy_time": round(self.busy_time, 2), "max_wait": round(self.max_wait, 2)}
+
+    def shutdown(self) -> None:
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class PlexExecutor:
+    """The threads blocking plexapi work for a single server runs on
+
+    Light jobs, single requests to the server, run on a small pool and wait their turn once max_pending are in
+    flight. Heavy jobs, library scans and anything else that walks a whole library, get their own even smaller pool
+    so they can never hold up the light ones, and are rejected with PlexExecutorBusy once that pool is backed up
+    rather than piling up behind each other.
+    """
+
+    light_workers = 4
+    light_max_pending = 32
+    heavy_workers = 1
+    heavy_max_pending = 3
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.light = ExecutorLane(f"plex-{name}", self.light_workers, self.light_max_pending, reject_when_full=False)
+        self.heavy = ExecutorLane(f"plex-{name}-heavy", self.heavy_workers, self.heavy_max_pending,
+                                  reject_when_full=True)
+
+    async def run(self, func, *args, **kwargs):
+        return await self.light.run(func, *args, **kwargs)
+
+    async def run_heavy(self, func, *args, **kwargs):
+        started = time.monotonic()
+        result = await self.heavy.run(func, *args, **kwargs)
+        logging.debug(f"Heavy job {getattr(func, '__qualname__', func)} on {self.name} took "
+                      f"{time.monotonic() - started:.2f}s")
+        return result
+
+    def stats(self) -> dict:
+        return {"light": self.light.stats(), "heavy": self.heavy.stats()}
+
+    def shutdown(self) -> None:
+        self.light.shutdown()
+        self.heavy.shutdown()
@@ -1,74 +1,194 @@
 import asyncio
-import time
+import os
+import sys
+import typing
 
 import plexapi.server
 import requests
-import threading
 
 from loguru import logger as logging
 
+from wrappers_utils.DeviceActivity import DeviceActivity
 from wrappers_utils.EventDecorator import event_manager
+from wrappers_utils.LibraryCensus import LibraryCensus
+from wrappers_utils.MediaIndex import MediaIndex
+from wrappers_utils.MetadataCache import MetadataCache
+from wrappers_utils.PlexExecutor import PlexExecutor
+from wrappers_utils.ReconnectionSupervisor import reconnection_supervisor
+from wrappers_utils.SessionPoller import SessionPoller
+from wrappers_utils.SessionSnapshot import SessionSnapshot
+
+_plexapi_dir = os.sep + "plexapi" + os.sep
+
+
+class AsyncPlexServer:
+    """Awaitable versions of the PlexServer calls the cogs make most, each one runs on the server's own executor
+
+    Every server gets its own PlexExecutor so a slow or unreachable server, or a library scan on one, only ties up
+    that server's threads and never the event loop or another guild's lookups.
+    """
+
+    def __init__(self, server) -> None:
+        self.server = server
+        self._executor = None
+
+    @property
+    def executor(self) -> PlexExecutor:
+        # Created on first use so the thread names carry the server's name rather than name_not_loaded
+        if self._executor is None:
+            self._executor = PlexExecutor(self.server.friendlyName)
+        return self._executor
+
+    async def run(self, func, *args, **kwargs):
+        """Run any blocking plexapi call on this server's executor"""
+        return await self.executor.run(func, *args, **kwargs)
+
+    async def run_heavy(self, func, *args, **kwargs):
+        """Run a long blocking job such as a library scan, raises PlexExecutorBusy if too many are already queued"""
+        return await self.executor.run_heavy(func, *args, **kwargs)
+
+    async def sessions(self):
+        return await self.run(self.server.sessions)
+
+    async def sessionSnapshots(self):
+        return await self.run(self.server.sessionSnapshots)
+
+    async def search(self, query, mediatype=None, limit=None, sectionId=None):
+        return await self.run(self.server.search, query, mediatype=mediatype, limit=limit, sectionId=sectionId)
+
+    async def sections(self):
+        return await self.run(self.server.metadata_cache.get, None, "sections", self.server.library.sections)
+
+    async def section(self, title):
+        return await self.run(self.server.library.section, title)
+
+    async def sectionByID(self, sectionID):
+        return await self.run(self.server.library.sectionByID, sectionID)
+
+    async def fetchItem(self, ekey, cls=None, **kwargs):
+        return await self.run(self.server.fetchItem, ekey, cls, **kwargs)
+
+    async def fetchItems(self, ekey, cls=None, **kwargs):
+        return await self.run(self.server.fetchItems, ekey, cls, **kwargs)
+
+    async def systemDevices(self):
+        return await self.run(self.server.systemDevices)
+
+    async def systemAccounts(self):
+        return await self.run(self.server.metadata_cache.get, None, "systemAccounts", self.server.systemAccounts)
+
+    async def myPlexAccount(self):
+        return await self.run(self.server.myPlexAccount)
+
+    async def transcodeSessions(self):
+        return await self.run(self.server.transcodeSessions)
+
+    async def backgroundSessions(self):
+        return await self.run(self.server.backgroundSessions)
+
+    async def butlerTasks(self):
+        return await self.run(self.server.butlerTasks)
+
+    async def runButlerTask(self, task):
+        return await self.run(self.server.runButlerTask, task)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
 
 
 class PlexServer(plexapi.server.PlexServer):
+    """A connection to one Plex server, shared by every guild linked to it
+
+    Guilds never use this directly, they each get a GuildPlexServer view of it from the server pool.
+    """
 
     def __init__(self, *args, **kwargs):
         self.event_loop = kwargs.pop("event_loop", None)
-        self.associations = kwargs.pop("discord_associations", None)
         self.database = kwargs.pop("database", None)
         self.friendlyName = "name_not_loaded"
-        self.host_guild = kwargs.pop("host_guild", None)
+        self.views = []  # type: typing.List[GuildPlexServer]
+        self.poll_min_interval = kwargs.pop("poll_min_interval", None)  # None uses the SessionPoller defaults
+        self.poll_max_interval = kwargs.pop("poll_max_interval", None)
         self.offline_reason = None
-        self._background_thread = None
+        self.alert_listener = None  # Set by PlexEvents while it has a websocket open to this server
+        self._session_poller = None
+        self.media_index = MediaIndex()
+        self.metadata_cache = MetadataCache()
+        self.library_census = LibraryCensus()
+        self.device_activity = DeviceActivity(self.database, self.event_loop)
+        self.aio = AsyncPlexServer(self)
         try:
             super().__init__(*args, timeout=1, **kwargs)
             self._online = True
             self._timeout = 10
-            event_manager.trigger_event("plex_connect", self.event_loop, plex=self)
+            self._trigger_view_event("plex_connect")
         except requests.exceptions.ConnectionError as e:
             self._server_offline(e)
 
+    def add_view(self, view: "GuildPlexServer") -> None:
+        """Attach a guild to this connection, the guild gets a plex_connect event straight away if we're online"""
+        self.views.append(view)
+        if getattr(self, "_online", False):
+            event_manager.trigger_event("plex_connect", self.event_loop, plex=view)
+
+    def _trigger_view_event(self, event_name: str) -> None:
+        for view in self.views:
+            event_manager.trigger_event(event_name, self.event_loop, plex=view)
+
     def backgroundSessions(self):
         """ Returns a list of all active :class:`~plexapi.media.BackgroundSession` objects. """
         return self.fetchItems('/status/sessions/background')
 
+    @property
+    def session_poller(self) -> SessionPoller:
+        """The shared poller for this server's sessions, started the first time it's needed"""
+        if self._session_poller is None:
+            self._session_poller = SessionPoller(self)
+        return self._session_poller
+
+    def sessionSnapshots(self):
+        """ Returns a :class:`~wrappers_utils.SessionSnapshot.SessionSnapshot` for every active session,
+            parsed from a single request to /status/sessions. """
+        if not self._online:
+            return []
+        try:
+            data = self.query('/status/sessions')
+        except requests.exceptions.ConnectTimeout as e:
+            self._server_offline(e)
+            return []
+        except requests.exceptions.ConnectionError as e:
+            self._server_offline(e)
+            return []
+        return [SessionSnapshot(self, elem) for elem in data if elem.attrib.get('sessionKey')]
+
     def _server_offline(self, exception=None):
-        """Called when the server goes offline"""
+        """Called when the server goes offline, may be called from any thread"""
+        was_online = getattr(self, "_online", True)
+        self._online = False
+        if not was_online:
+            return  # Already being reconnected by the supervisor
         if type(exception) == requests.exceptions.ConnectTimeout:
             logging.error(f"Plex server {self.friendlyName} has gone offline, timed out")
         elif type(exception) == requests.exceptions.ConnectionError:
             logging.error(f"Plex server {self.friendlyName} has gone offline, connection error")
         else:
             logging.error(f"Plex server {self.friendlyName} has gone offline, {exception}")
-        # logging.warning(f"Plex server {self.friendlyName} has gone offline, {exception}")
-        self._online = False
-        event_manager.trigger_event("plex_disconnect", self.event_loop, plex=self)
-        if self._background_thread is None or not self._background_thread.is_alive():
-            self._background_thread = threading.Thread(target=self._reconnection_thread, daemon=True)
-            self._background_thread.start()
-
-    def _reconnection_thread(self):
-        """Check if the server is back online"""
-        logging.info(f"Starting reconnection thread for {self.friendlyName}")
-        while not self._online:
-            try:
-                super().__init__(self._baseurl, self._token, timeout=1)
-                self._online = True
-                self._timeout = 10
-                event_manager.trigger_event("plex_connect", self.event_loop, plex=self)
-                logging.info(f"Plex server {self.friendlyName} has come back online")
-            except requests.exceptions.ConnectTimeout:
-                pass
-            except requests.exceptions.ConnectionError:
-                pass
-            except plexapi.exceptions.BadRequest:
-                pass
-            except Exception as e:
-                logging.error(f"Unknown error in reconnection thread for {self.friendlyName}, {e} - {type(e)}")
-                logging.exception(e)
-                pass
-            finally:
-                time.sleep(5)
+        self._trigger_view_event("plex_disconnect")
+        reconnection_supervisor.server_offline(self)
+
+    def restore(self, connection: plexapi.server.PlexServer) -> None:
+        """Bring the server back online with the data from a freshly made connection, called on the event loop"""
+        if hasattr(self, "_invalidateCachedProperties"):
+            self._invalidateCachedProperties()
+        # Set up the PlexObject state as well as the data, a server that was offline at startup never got that far
+        super(plexapi.server.PlexServer, self).__init__(self, connection._data, self.key)
+        self.metadata_cache.clear()  # Anything could have changed while we couldn't see the server
+        self.library_census.clear()
+        self._online = True
+        self._timeout = 10
+        self.offline_reason = None
+        self._trigger_view_event("plex_connect")
 
     @property
     def online(self):
@@ -79,6 +199,33 @@ class PlexServer(plexapi.server.PlexServer):
         while not self._online:
             await asyncio.sleep(1)
 
+    def query(self, key, *args, **kwargs):
+        self._check_blocking_call(key)
+        return super().query(key, *args, **kwargs)
+
+    _reported_blocking_calls = set()
+
+    @classmethod
+    def _check_blocking_call(cls, key) -> None:
+        """Log when a request to plex is made from the event loop thread, once for each place it's called from"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return  # Not on an event loop thread, blocking is fine here
+        # Walk the raw frames out to the first one outside plexapi and this file, nothing is formatted until the call
+        # site turns out to be one that hasn't been reported yet
+        frame = sys._getframe(1)
+        while frame is not None and (_plexapi_dir in frame.f_code.co_filename
+                                     or frame.f_code.co_filename == __file__):
+            frame = frame.f_back
+        site = (frame.f_code.co_filename, frame.f_lineno) if frame is not None else key
+        if site in cls._reported_blocking_calls:
+            return
+        cls._reported_blocking_calls.add(site)
+        location = f"{site[0]}:{site[1]} in {frame.f_code.co_name}" if frame is not None else "unknown caller"
+        logging.warning(f"Blocking Plex request {key} made on the event loop thread from {location}, "
+                        f"use the PlexServer.aio equivalent instead")
+
     def fetchItem(self, ekey, cls=None, **kwargs):
         if not self._online:
             return None
@@ -102,3 +249,30 @@ class PlexServer(plexapi.server.PlexServer):
         except requests.exceptions.ConnectionError as e:
             self._server_offline(e)
             return []
+
+
+class GuildPlexServer:
+    """One guild's view of a shared PlexServer connection
+
+    The guild specific state, its discord associations and the guild itself, lives here. Everything else is read
+    from and written to the shared connection, so the view can be used anywhere a PlexServer is expected.
+    """
+
+    _own_attributes = ("connection", "host_guild", "associations")
+
+    def __init__(self, connection: PlexServer, guild, associations) -> None:
+        self.connection = connection
+        self.host_guild = guild
+        self.associations = associations
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def __setattr__(self, name, value):
+        if name in self._own_attributes:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.connection, name, value)
+
+    def __repr__(self):
+        return f"<GuildPlexServer {self.host_guild} -> {self.connection.friendlyName}>"
@@ -0,0 +1,86 @@
+import asyncio
+import random
+import time
+
+import plexapi.server
+from loguru import logger as logging
+
+
+class ReconnectionSupervisor:
+    """Brings offline Plex servers back online, one task for every server the bot knows about
+
+    Offline servers are probed on /identity, which is cheap enough to hit often, with a jittered exponential
+    backoff between attempts. Only once a probe succeeds is a complete new connection built, off the event loop,
+    and its data copied into the existing PlexServer on the loop so nothing ever sees a half initialised server.
+    """
+
+    base_delay = 5
+    max_delay = 300
+    probe_timeout = 3
+
+    def __init__(self) -> None:
+        self.offline = {}  # type: dict  # PlexServer -> (attempts, monotonic time of the next probe)
+        self._wake = None  # type: asyncio.Event | None
+        self.task = None  # type: asyncio.Task | None
+
+    def server_offline(self, server) -> None:
+        """Start supervising a server, safe to call from any thread"""
+        if server.event_loop is None:
+            logging.warning(f"Plex server {server.friendlyName} has no event loop, it won't be reconnected")
+            return
+        server.event_loop.call_soon_threadsafe(self._add, server)
+
+    def _add(self, server) -> None:
+        if server not in self.offline:
+            self.offline[server] = (0, time.monotonic() + self.base_delay)
+        if self.task is None or self.task.done():
+            self._wake = asyncio.Event()
+            self.task = asyncio.get_event_loop().create_task(self.supervisor())
+        self._wake.set()
+
+    def delay(self, attempts: int) -> float:
+        return min(self.max_delay, self.base_delay * 2 ** attempts) * random.uniform(0.5, 1.0)
+
+    async def supervisor(self):
+        while self.offline:
+            now = time.monotonic()
+            for server, (attempts, next_probe) in list(self.offline.items()):
+                if next_probe > now:
+                    continue
+                try:
+                    if await self.reconnect(server):
+                        del self.offline[server]
+                        continue
+                except Exception as e:
+                    logging.error(f"Unknown error reconnecting to {server.friendlyName}, {e} - {type(e)}")
+                    logging.exception(e)
+                self.offline[server] = (attempts + 1, time.monotonic() + self.delay(attempts + 1))
+            if not self.offline:
+                break
+            wait = min(next_probe for _, next_probe in self.offline.values()) - time.monotonic()
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=max(wait, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def reconnect(self, server) -> bool:
+        if not await server.aio.run(self.probe, server):
+            return False
+        # The server answered, build a complete connection to it before anything is swapped in
+        fresh = await server.aio.run(plexapi.server.PlexServer, server._baseurl, server._token,
+                                     session=server._session, timeout=self.probe_timeout)
+        server.restore(fresh)
+        logging.info(f"Plex server {server.friendlyName} has come back online")
+        return True
+
+    def probe(self, server) -> bool:
+        try:
+            response = server._session.get(server.url("/identity"), headers=server._headers(),
+                                           timeout=self.probe_timeout)
+            return response.status_code == 200
+        except Exception:
+            return False
+
+
+reconnection_supervisor = ReconnectionSupervisor()
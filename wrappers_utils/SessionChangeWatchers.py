@@ -1,4 +1,6 @@
+import collections
 import datetime
+import time
 import typing
 
 import discord
@@ -7,10 +9,23 @@ import asyncio
 
 from loguru import logger as logging
 
+from wrappers_utils.SessionSnapshot import SessionSnapshot
+
+WatcherKey = typing.Tuple[str, str, str]
+
+
+def watcher_key(session) -> WatcherKey | None:
+    """The (guid, username, machineIdentifier) triple that identifies one viewing of a session"""
+    device_id = getattr(session.player, "machineIdentifier", None)
+    if device_id is None:
+        logging.warning(f"machineIdentifier returned None for {session.title} {session.usernames}")
+        return None
+    return session.guid, session.usernames[0], device_id
+
 
 class SessionWatcher:
 
-    def __init__(self, session: plexapi.video.Video, server, callback) -> None:
+    def __init__(self, session: SessionSnapshot, server, callback) -> None:
 
         try:
             logging.info(f"Creating SessionWatcher for {session.title} ({session.year}) [{session.guid}] "
@@ -20,11 +35,6 @@ class SessionWatcher:
             self.callback = callback
             self.server = server
 
-            if not session.isFullObject:
-                session.reload(checkFiles=False)
-                if not session.isFullObject:
-                    raise Exception("Session is still partial")
-
             media = session.media[0]
 
             # self.initial_media = copy(media)
@@ -32,15 +42,17 @@ class SessionWatcher:
             self.initial_session = session
             self.session = session
             self.guid = session.guid
+            self.session_key = str(session.sessionKey)
+            self.key = watcher_key(session)
+            self.state = session.players[0].state if session.players else None
 
             # Get the hardware ID of the device that is playing the video
             self.device_id = session.player.machineIdentifier
             self.account_id = session.player.userID
             if self.account_id == 1:  # Btw nic, I still hate you for this
                 self.account_id = self.server.myPlexAccount().id
-            table = self.server.database.get_table("plex_devices")
-            table.update_or_add(device_id=self.device_id, account_id=self.account_id,
-                                last_seen=datetime.datetime.now().timestamp())
+            # Written to plex_devices in the next batch rather than here
+            self.server.device_activity.seen(self.account_id, self.device_id)
 
             self.end_offset = self.session.viewOffset
 
@@ -48,6 +60,7 @@ class SessionWatcher:
             self.alive_time = datetime.datetime.utcnow()
             self.watch_time = 0
             self.last_update = datetime.datetime.utcnow()
+            self.expired = False
 
         except Exception as e:
             logging.error(f"Error creating SessionWatcher for {session.title}"
@@ -55,127 +68,237 @@ class SessionWatcher:
             logging.exception(e)
             raise e
 
-    async def refresh_session(self, session: plexapi.video.Video) -> None:
+    async def refresh_session(self, session: SessionSnapshot) -> None:
         self.session = session
         self.media = session.media[0]
+        self.session_key = str(session.sessionKey)
+        self.end_offset = self.session.viewOffset
+        self._update_state(self.session.players[0].state)
 
-        if not self.session.isFullObject:
-            self.session.reload(checkFiles=False)
-            if not self.session.isFullObject:
-                raise Exception("Session is still partial")
+    def apply_notification(self, state: str, view_offset: int) -> None:
+        """Update the watcher from a PlaySessionStateNotification instead of a full session poll"""
+        if view_offset is not None:
+            self.end_offset = int(view_offset)
+        self._update_state(state)
 
-        self.end_offset = self.session.viewOffset
+    def _update_state(self, state: str) -> None:
         # Check if the media is playing
-        if self.session.players[0].state == "playing":
+        if state == "playing":
             # Add the time since the last update to the watch time
             self.watch_time += (datetime.datetime.utcnow() - self.last_update).total_seconds()
+        self.state = state
         self.last_update = datetime.datetime.utcnow()
 
     async def session_expired(self):
+        if self.expired:  # Both the poll and a stopped notification can expire the same session
+            return
+        self.expired = True
         await self.callback(self)
 
-    def _session_compare(self, other, attribute: str) -> bool | None:
-        if hasattr(self.session, attribute) and hasattr(other, attribute):
-            return getattr(self.session, attribute) == getattr(other, attribute)
-        return None
-
-    def _user_compare(self, other) -> bool | None:
-        if hasattr(self.session, "usernames") and hasattr(other, "usernames"):
-            return self.session.usernames[0] == other.usernames[0]
-        return None
-
     def __str__(self):
         return f"{self.session.title}@{self.server.friendlyName}"
 
-    def __eq__(self, other):
-        if isinstance(other, SessionWatcher):  # This comparison happens when a session is being closed
-            return self.guid == other.guid and self._user_compare(other) and self.device_id == other.device_id
-        else:
-            try:  # This comparison happens when a session is being created
-                if getattr(other.player, "machineIdentifier", None) is None:
-                    logging.warning(f"machineIdentifier returned None for {other.title} {self.account_id}")
-                    return False
-                return self._session_compare(other, "title") and self._user_compare(other) and \
-                    self._session_compare(other, "guid") and \
-                    self.device_id == getattr(other.player, "machineIdentifier", None)
-            except Exception as e:
-                logging.error(f"Error comparing {self} to {other}")
-                logging.exception(e)
-                return False
-
     def __iter__(self):
         yield self
 
 
 class SessionChangeWatcher:
-    """Binds to a plexapi.Server and fires events when sessions start or stop"""
+    """Binds to a plexapi.Server and fires events when sessions start or stop
 
-    max_sessions = 15
+    Sessions come from the server's shared SessionPoller. While the server's alert listener is running, session
+    start, progress and stop are driven by the "playing" notifications it receives and the watcher only needs the
+    poller to run every reconcile_interval seconds as a safety net. Without a listener it asks for poll_interval.
+
+    Limits are applied as throttles, sessions over max_sessions or max_per_user are not tracked until a slot frees
+    up and at most max_new_per_tick watchers are created per poll. Expired watchers are handed to the callback
+    through a bounded queue so a slow callback holds up expiry instead of piling up tasks.
+    """
+
+    max_sessions = 500
     max_per_user = 2
+    max_new_per_tick = 25
+    callback_queue_size = 100
+    callback_workers = 2
+    poll_interval = 1.5
+    reconcile_interval = 60
+    stopped_session_ttl = 30  # How long a stopped sessionKey is ignored by the reconciliation poll
 
     def __init__(self, server_object: plexapi.server, callback: typing.Callable, channel: discord.TextChannel) -> None:
         self.server = server_object
-        self.watchers = []
+        self.watchers = {}  # type: typing.Dict[WatcherKey, SessionWatcher]
+        self.session_keys = {}  # type: typing.Dict[str, WatcherKey]  # Plex sessionKey -> watcher key
+        self.throttled = set()  # type: typing.Set[WatcherKey]
+        self.backlogged = False
+        self.callbacks_backed_up = False
         self.callbacktoback = callback
         self.failback = None
         self.channel = channel
+        self.stopped_sessions = {}  # type: typing.Dict[str, float]
+        self.poller = server_object.session_poller
+        self.poller.request_interval(self, lambda: self.interval)
+        self.callback_queue = asyncio.Queue(maxsize=self.callback_queue_size)
+        self.workers = [asyncio.get_event_loop().create_task(self.callback_worker())
+                        for _ in range(self.callback_workers)]
         self.task = asyncio.get_event_loop().create_task(self.observer())
         logging.info(f"Created SessionChangeWatcher for {self.server.friendlyName}")
 
+    @property
+    def event_driven(self) -> bool:
+        """True while the server's alert listener is delivering playing notifications"""
+        listener = getattr(self.server, "alert_listener", None)
+        return listener is not None and listener.is_alive()
+
+    @property
+    def interval(self) -> float:
+        if self.backlogged or not self.event_driven:
+            return self.poll_interval
+        return self.reconcile_interval
+
+    def request_reconcile(self) -> None:
+        """Have the poller fetch the sessions immediately"""
+        self.poller.refresh()
+
+    async def on_playing(self, notifications: typing.List[dict]) -> None:
+        """Handle the PlaySessionStateNotification entries of a "playing" alert"""
+        for notification in notifications:
+            try:
+                session_key = str(notification.get("sessionKey"))
+                state = notification.get("state")
+                watcher = self.watchers.get(self.session_keys.get(session_key))
+                if watcher is None:
+                    if state != "stopped" and session_key not in self.stopped_sessions:
+                        # A session we don't know about yet, fetch it from the server
+                        self.request_reconcile()
+                    continue
+                watcher.apply_notification(state, notification.get("viewOffset"))
+                if state == "stopped":
+                    self.stopped_sessions[session_key] = time.monotonic()
+                    await watcher.session_expired()
+            except Exception as e:
+                logging.error(f"Error handling playing notification {notification}: {e}")
+                logging.exception(e)
+
+    def _throttle(self, key: WatcherKey, reason: str) -> None:
+        if key not in self.throttled:
+            self.throttled.add(key)
+            logging.warning(f"Not tracking session {key[0]} for {key[1]} ({key[2]}) on "
+                            f"{self.server.friendlyName}: {reason}")
+
+    async def _start_watcher(self, key: WatcherKey, session) -> None:
+        try:
+            # Creating a watcher can ask plex.tv for the owner's account, keep that off the event loop
+            watcher = await self.server.aio.run(SessionWatcher, session, self.server, self.callback)
+        except Exception as e:
+            logging.error(f"Error creating watcher for session {session.title}: {e}")
+            logging.exception(e)
+            return
+        self.watchers[key] = watcher
+        self.session_keys[watcher.session_key] = key
+        self.throttled.discard(key)
+
     async def observer(self):
+        generation = None
         while self.server is not None:
-            if len(self.watchers) > self.max_sessions:
-                logging.error(f"SessionChangeWatcher for {self.server.friendlyName} exceeded max sessions,"
-                              f"terminating watcher")
-                return
             try:
-                sessions = self.server.sessions()
+                sessions = await self.poller.wait_for_update(after=generation)
+                generation = self.poller.generation
+                # Forget stopped sessions once plex has had time to drop them from /status/sessions
+                now = time.monotonic()
+                for session_key, stopped_at in list(self.stopped_sessions.items()):
+                    if now - stopped_at > self.stopped_session_ttl:
+                        del self.stopped_sessions[session_key]
+                sessions = [session for session in sessions
+                            if str(session.sessionKey) not in self.stopped_sessions]
+                live = {}
                 for session in sessions:
+                    key = watcher_key(session)
+                    if key is not None:
+                        live[key] = session
+
+                for key in live.keys() & self.watchers.keys():
+                    watcher = self.watchers.get(key)
+                    if watcher is None:
+                        continue
                     try:
-                        already_exists = False
-                        for watcher in self.watchers:
-                            if watcher == session:
-                                await watcher.refresh_session(session)
-                                already_exists = True
-                                break
-                        if not already_exists:
-                            watcher = SessionWatcher(session, self.server, self.callback)
-                            self.watchers.append(watcher)
+                        self.session_keys.pop(watcher.session_key, None)
+                        await watcher.refresh_session(live[key])
+                        self.session_keys[watcher.session_key] = key
                     except Exception as e:
-                        logging.error(f"Error refreshing session {session.title}: {e}")
+                        logging.error(f"Error refreshing session {live[key].title}: {e}")
                         logging.exception(e)
 
-                for watcher in self.watchers:
+                for key in self.watchers.keys() - live.keys():
+                    watcher = self.watchers.get(key)
+                    if watcher is None:  # Already removed by a stopped notification while we were awaiting
+                        continue
                     try:
-                        session_still_exists = False
-                        for session in sessions:
-                            if watcher == session:
-                                session_still_exists = True
-                                break
-                        if not session_still_exists:
-                            await watcher.session_expired()
+                        await watcher.session_expired()
                     except Exception as e:
-                        logging.error(f"Error checking for continued existence of session {watcher.session.title}: {e}")
+                        logging.error(f"Error expiring session {watcher.session.title}: {e}")
                         logging.exception(e)
 
+                # Start new watchers last so slots freed by expired sessions can be reused this tick
+                self.throttled &= live.keys()
+                per_user = collections.Counter(key[1] for key in self.watchers)
+                starting = []
+                backlogged = False
+                for key in live.keys() - self.watchers.keys():
+                    if len(starting) >= self.max_new_per_tick:
+                        # More new sessions than we can start in one tick, poll again soon for the rest. Sessions
+                        # throttled on an earlier tick count too, they may fit in slots freed since then
+                        backlogged = True
+                        break
+                    if len(self.watchers) + len(starting) >= self.max_sessions:
+                        self._throttle(key, f"server is at the {self.max_sessions} session limit")
+                        continue
+                    if per_user[key[1]] >= self.max_per_user:
+                        self._throttle(key, f"user is at the {self.max_per_user} session limit")
+                        continue
+                    per_user[key[1]] += 1
+                    starting.append(key)
+                self.backlogged = backlogged
+                if starting:
+                    await asyncio.gather(*(self._start_watcher(key, live[key]) for key in starting))
+
             except Exception as e:
                 logging.error(f"Error checking sessions: {e}")
                 logging.exception(e)
-            finally:
-                await asyncio.sleep(1.5)
+                await asyncio.sleep(self.poll_interval)
 
     async def bot_shutdown(self):
         logging.info(f"Shutting down SessionChangeWatcher for {self.server.friendlyName}")
-        for watcher in self.watchers:
+        self.task.cancel()
+        self.poller.release(self)
+        for watcher in list(self.watchers.values()):
             logging.info(f"Dumping session {watcher.session.title} for {watcher.session.usernames[0]}")
             await watcher.session_expired()
-        self.task.cancel()
+        try:
+            await asyncio.wait_for(self.callback_queue.join(), timeout=30)
+        except asyncio.TimeoutError:
+            logging.warning(f"Gave up waiting on {self.callback_queue.qsize()} history callbacks for "
+                            f"{self.server.friendlyName}")
+        for worker in self.workers:
+            worker.cancel()
 
     async def callback(self, watcher: SessionWatcher):
-        try:
-            await self.callbacktoback(watcher, self.channel)
-        except Exception as e:
-            logging.error(f"Error in callback: {e}")
-            logging.exception(e)
-        finally:
-            self.watchers.remove(watcher)
+        # Drop the watcher from the registry straight away so a new session with the same key isn't merged into it
+        self.watchers.pop(watcher.key, None)
+        self.session_keys.pop(watcher.session_key, None)
+        if self.callback_queue.full() and not self.callbacks_backed_up:
+            self.callbacks_backed_up = True
+            logging.warning(f"History callbacks for {self.server.friendlyName} are backing up, "
+                            f"{self.callback_queue.qsize()} waiting")
+        await self.callback_queue.put(watcher)
+
+    async def callback_worker(self):
+        while True:
+            watcher = await self.callback_queue.get()
+            try:
+                await self.callbacktoback(watcher, self.channel)
+            except Exception as e:
+                logging.error(f"Error in callback: {e}")
+                logging.exception(e)
+            finally:
+                self.callback_queue.task_done()
+                if self.callback_queue.empty():
+                    self.callbacks_backed_up = False
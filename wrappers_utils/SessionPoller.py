@@ -0,0 +1,140 @@
+import asyncio
+import time
+import typing
+
+from loguru import logger as logging
+
+from wrappers_utils.SessionSnapshot import SessionSnapshot
+
+
+class SessionPoller:
+    """Polls /status/sessions for one server and publishes the result to everything that needs it
+
+    Consumers register how often they need fresh data with request_interval() and the poller runs at the shortest
+    requested interval, so one request per interval is shared by the status loop, activity embeds, the sessions
+    command and the history watcher. Each poll is published as a tuple which consumers must treat as read only.
+
+    The interval adapts to activity, it doubles for every consecutive poll that finds no sessions and drops to the
+    minimum for a few polls after a session starts or stops. It is always kept between the server's
+    poll_min_interval and poll_max_interval, which are stored in plex_servers.
+    """
+
+    default_interval = 10
+    default_min_interval = 1.5
+    default_max_interval = 120
+    tighten_polls = 3  # Polls to run at the minimum interval after the set of sessions changes
+
+    def __init__(self, server) -> None:
+        self.server = server
+        self.snapshot = ()  # type: typing.Tuple[SessionSnapshot, ...]
+        self.updated_at = 0.0  # time.monotonic() of the last successful poll
+        self.generation = 0  # Incremented on every publish
+        self.idle_polls = 0
+        self.tightened_polls = 0
+        self.intervals = {}  # type: typing.Dict[typing.Hashable, typing.Union[float, typing.Callable[[], float]]]
+        self._published = asyncio.Event()
+        self._wake = asyncio.Event()
+        self.task = asyncio.get_event_loop().create_task(self.poller())
+
+    @property
+    def min_interval(self) -> float:
+        return self.server.poll_min_interval or self.default_min_interval
+
+    @property
+    def max_interval(self) -> float:
+        return max(self.server.poll_max_interval or self.default_max_interval, self.min_interval)
+
+    @property
+    def requested_interval(self) -> float:
+        if not self.intervals:
+            return self.default_interval
+        return min(value() if callable(value) else value for value in self.intervals.values())
+
+    @property
+    def interval(self) -> float:
+        if self.tightened_polls > 0:
+            interval = self.min_interval
+        else:
+            interval = self.requested_interval * 2 ** self.idle_polls
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.updated_at
+
+    def request_interval(self, owner: typing.Hashable, interval: typing.Union[float, typing.Callable[[], float]]):
+        """Ask for the sessions to be polled at least every interval seconds, interval may be a callable"""
+        new_owner = owner not in self.intervals
+        self.intervals[owner] = interval
+        if new_owner:
+            self._wake.set()
+
+    def release(self, owner: typing.Hashable) -> None:
+        self.intervals.pop(owner, None)
+
+    def refresh(self) -> None:
+        """Poll immediately instead of waiting for the interval to elapse"""
+        self._wake.set()
+
+    async def wait_for_update(self, timeout: float = None, after: int = None) -> typing.Tuple[SessionSnapshot, ...]:
+        """Wait for the next poll to be published and return it
+
+        If after is given, return straight away when a newer generation than it has already been published
+        """
+        if after is not None and self.generation > after:
+            return self.snapshot
+        await asyncio.wait_for(self._published.wait(), timeout=timeout)
+        return self.snapshot
+
+    async def latest(self, max_age: float = None) -> typing.Tuple[SessionSnapshot, ...]:
+        """Return the last published sessions, polling first if they are older than max_age seconds"""
+        if max_age is not None and self.age > max_age:
+            self.refresh()
+            try:
+                return await self.wait_for_update(timeout=self.server._timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Timed out waiting for fresh sessions from {self.server.friendlyName}")
+        return self.snapshot
+
+    def _adapt(self, snapshot: typing.Tuple[SessionSnapshot, ...]) -> None:
+        previous = {session.sessionKey for session in self.snapshot}
+        current = {session.sessionKey for session in snapshot}
+        if self.generation > 0 and previous != current:
+            self.tightened_polls = self.tighten_polls
+        elif self.tightened_polls > 0:
+            self.tightened_polls -= 1
+        if current:
+            self.idle_polls = 0
+        elif self.requested_interval * 2 ** self.idle_polls < self.max_interval:
+            self.idle_polls += 1
+
+    def _publish(self, snapshot: typing.Tuple[SessionSnapshot, ...]) -> None:
+        self._adapt(snapshot)
+        self.snapshot = snapshot
+        self.updated_at = time.monotonic()
+        self.generation += 1
+        # Swap in a new event before waking the waiters so every waiter sees exactly this snapshot
+        published, self._published = self._published, asyncio.Event()
+        published.set()
+
+    async def poller(self):
+        while True:
+            try:
+                if self.server.online:
+                    snapshot = await self.server.aio.sessionSnapshots()
+                    # sessionSnapshots returns an empty list if the server dropped offline during the request,
+                    # don't publish that as every session having ended
+                    if self.server.online:
+                        self._publish(tuple(snapshot))
+            except Exception as e:
+                logging.error(f"Error polling sessions for {self.server.friendlyName}: {e}")
+                logging.exception(e)
+            finally:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+
+    def stop(self) -> None:
+        self.task.cancel()
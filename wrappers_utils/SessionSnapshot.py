@@ -0,0 +1,156 @@
+import typing
+from xml.etree.ElementTree import Element
+
+from plexapi import utils
+
+
+class StreamSnapshot:
+    """A single stream of the part being played"""
+
+    __slots__ = ("streamType", "codec", "title", "language", "selected")
+
+    def __init__(self, data: Element) -> None:
+        self.streamType = utils.cast(int, data.attrib.get("streamType"))
+        self.codec = data.attrib.get("codec")
+        self.title = data.attrib.get("title") or data.attrib.get("displayTitle")
+        self.language = data.attrib.get("language")
+        self.selected = utils.cast(bool, data.attrib.get("selected", "0"))
+
+    @property
+    def STREAMTYPE(self) -> int:  # Matches the plexapi stream classes so get_stream_parts works on both
+        return self.streamType
+
+
+class PartSnapshot:
+
+    __slots__ = ("streams",)
+
+    def __init__(self, data: Element) -> None:
+        self.streams = [StreamSnapshot(elem) for elem in data if elem.tag == "Stream"]
+
+
+class MediaSnapshot:
+
+    __slots__ = ("bitrate", "container", "videoCodec", "width", "height", "videoFrameRate", "audioCodec",
+                 "audioChannels", "parts")
+
+    def __init__(self, data: Element) -> None:
+        self.bitrate = utils.cast(int, data.attrib.get("bitrate"))
+        self.container = data.attrib.get("container")
+        self.videoCodec = data.attrib.get("videoCodec")
+        self.width = utils.cast(int, data.attrib.get("width"))
+        self.height = utils.cast(int, data.attrib.get("height"))
+        self.videoFrameRate = data.attrib.get("videoFrameRate")
+        self.audioCodec = data.attrib.get("audioCodec")
+        self.audioChannels = utils.cast(int, data.attrib.get("audioChannels"))
+        self.parts = [PartSnapshot(elem) for elem in data if elem.tag == "Part"]
+
+
+class PlayerSnapshot:
+
+    __slots__ = ("machineIdentifier", "state", "title", "model", "platform", "product", "relayed", "local", "userID")
+
+    def __init__(self, data: Element) -> None:
+        self.machineIdentifier = data.attrib.get("machineIdentifier")
+        self.state = data.attrib.get("state")
+        self.title = data.attrib.get("title")
+        self.model = data.attrib.get("model")
+        self.platform = data.attrib.get("platform")
+        self.product = data.attrib.get("product")
+        self.relayed = utils.cast(bool, data.attrib.get("relayed", "0"))
+        self.local = utils.cast(bool, data.attrib.get("local", "0"))
+        self.userID = utils.cast(int, data.attrib.get("userID"))
+
+
+class SessionInfoSnapshot:
+    """The <Session> element, bandwidth reservation and network location of the stream"""
+
+    __slots__ = ("id", "bandwidth", "location")
+
+    def __init__(self, data: Element) -> None:
+        self.id = data.attrib.get("id")
+        self.bandwidth = utils.cast(int, data.attrib.get("bandwidth"))
+        self.location = data.attrib.get("location") or ""
+
+
+class TranscodeSnapshot:
+
+    __slots__ = ("speed", "transcodeHwEncoding", "videoCodec", "audioCodec", "sourceVideoCodec", "sourceAudioCodec",
+                 "videoDecision", "audioDecision")
+
+    def __init__(self, data: Element) -> None:
+        self.speed = utils.cast(float, data.attrib.get("speed")) or 0.0
+        self.transcodeHwEncoding = data.attrib.get("transcodeHwEncoding")
+        self.videoCodec = data.attrib.get("videoCodec")
+        self.audioCodec = data.attrib.get("audioCodec")
+        self.sourceVideoCodec = data.attrib.get("sourceVideoCodec")
+        self.sourceAudioCodec = data.attrib.get("sourceAudioCodec")
+        self.videoDecision = data.attrib.get("videoDecision")
+        self.audioDecision = data.attrib.get("audioDecision")
+
+
+class SessionSnapshot:
+    """A read only copy of one entry of /status/sessions
+
+    Parsed straight from the XML so building it never costs more than the single request for the whole session
+    list, unlike plexapi's session objects which need a reload() per session before they are complete. The
+    attribute names match plexapi's so the snapshot can be used anywhere a session object was read from.
+    """
+
+    __slots__ = ("_server", "type", "title", "year", "guid", "key", "ratingKey", "sessionKey", "librarySectionID",
+                 "grandparentTitle", "grandparentGuid", "grandparentKey", "grandparentRatingKey", "parentTitle",
+                 "parentIndex", "index", "thumb", "viewOffset", "duration", "usernames", "players", "session",
+                 "media", "transcodeSessions")
+
+    def __init__(self, server, data: Element) -> None:
+        self._server = server
+        attrib = data.attrib
+        self.type = attrib.get("type")
+        self.title = attrib.get("title")
+        self.year = utils.cast(int, attrib.get("year"))
+        self.guid = attrib.get("guid")
+        self.key = attrib.get("key")
+        self.ratingKey = utils.cast(int, attrib.get("ratingKey"))
+        self.sessionKey = utils.cast(int, attrib.get("sessionKey"))
+        self.librarySectionID = utils.cast(int, attrib.get("librarySectionID"))
+        self.grandparentTitle = attrib.get("grandparentTitle")
+        self.grandparentGuid = attrib.get("grandparentGuid")
+        self.grandparentKey = attrib.get("grandparentKey")
+        self.grandparentRatingKey = utils.cast(int, attrib.get("grandparentRatingKey"))
+        self.parentTitle = attrib.get("parentTitle")
+        self.parentIndex = utils.cast(int, attrib.get("parentIndex"))
+        self.index = utils.cast(int, attrib.get("index"))
+        self.thumb = attrib.get("thumb")
+        self.viewOffset = utils.cast(int, attrib.get("viewOffset", 0))
+        self.duration = utils.cast(int, attrib.get("duration", 0))
+        self.usernames = []
+        self.players = []
+        self.session = []
+        self.media = []
+        self.transcodeSessions = []
+        for elem in data:
+            if elem.tag == "User":
+                self.usernames.append(elem.attrib.get("title"))
+            elif elem.tag == "Player":
+                self.players.append(PlayerSnapshot(elem))
+            elif elem.tag == "Session":
+                self.session.append(SessionInfoSnapshot(elem))
+            elif elem.tag == "Media":
+                self.media.append(MediaSnapshot(elem))
+            elif elem.tag == "TranscodeSession":
+                self.transcodeSessions.append(TranscodeSnapshot(elem))
+
+    @property
+    def player(self) -> typing.Optional[PlayerSnapshot]:
+        return self.players[0] if self.players else None
+
+    def show(self):
+        """Fetch the full show this episode belongs to, this is a request to the server"""
+        return self._server.fetchItem(self.grandparentKey)
+
+    def source(self):
+        """Fetch the full library item being played, this is a request to the server"""
+        return self._server.fetchItem(self.key)
+
+    def __repr__(self):
+        return f"<SessionSnapshot {self.sessionKey}:{self.title}>"
@@ -0,0 +1,49 @@
+import collections
+import typing
+
+from loguru import logger as logging
+
+
+class ShowTree:
+    """Every episode of a show or season from a single fetch, with the totals the embeds need worked out once
+
+    A show's episodes() is one allLeaves request and a season's is one children request, both include the media
+    parts, so the duration, size and per season episode counts all come from that one response.
+    """
+
+    def __init__(self, content, episodes: list) -> None:
+        self.content = content
+        self.episodes = episodes
+        self.seasons = collections.OrderedDict()  # Season ratingKey -> its episodes, in the order Plex returned
+        self.duration = 0
+        self.size = 0
+        for episode in episodes:
+            self.seasons.setdefault(episode.parentRatingKey, []).append(episode)
+            try:
+                self.duration += episode.duration
+            except TypeError:
+                pass
+            try:
+                for media in episode.media:
+                    for part in media.parts:
+                        self.size += part.size
+            except TypeError:
+                logging.debug(f"Episode {episode.title} has no size")
+
+    def __len__(self) -> int:
+        return len(self.episodes)
+
+    @property
+    def episode_count(self) -> int:
+        return len(self.episodes)
+
+    def season_episodes(self, season) -> list:
+        return self.seasons.get(season.ratingKey, [])
+
+    @classmethod
+    def of(cls, content) -> "ShowTree":
+        """The tree for a show or season, from the server's metadata cache if it has one, this blocks"""
+        cache = getattr(content._server, "metadata_cache", None)
+        if cache is None:
+            return cls(content, content.episodes())
+        return cache.get(content, "show_tree", lambda: cls(content, content.episodes()))